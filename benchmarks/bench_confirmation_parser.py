@@ -0,0 +1,65 @@
+"""
+Compare the streaming confirmation parser with the BeautifulSoup parsing it replaced, on the
+sample emails in benchmarks/emails/
+
+    python3 benchmarks/bench_confirmation_parser.py
+"""
+
+from pathlib import Path
+import re
+
+from bs4 import BeautifulSoup
+
+from harness import Result, measure
+
+from confirmation_parser import (
+    ETA_KEY,
+    INVOICE_NUMBER_KEY,
+    REGEX_SUB_FOR_NL,
+    ConfirmationFormatError,
+    parse_confirmation,
+)
+
+EMAIL_DIR = Path(__file__).parent / "emails"
+NUMBER = 200
+QUICK_NUMBER = 20
+
+
+def parse_with_soup(html: str) -> tuple[int, str] | None:
+    "The parsing emailing.process_email used to do"
+    text = BeautifulSoup(html, "html.parser").get_text()
+    text_split = re.sub(REGEX_SUB_FOR_NL, r"\n", text).split("\n")
+    try:
+        invoice_num = int(text_split[text_split.index(INVOICE_NUMBER_KEY) + 1])
+        eta = text_split[text_split.index(ETA_KEY) + 1]
+    except ValueError:
+        return None
+    return invoice_num, eta
+
+
+def parse_streaming(html: str) -> tuple[int, str] | None:
+    try:
+        c = parse_confirmation(html)
+    except ConfirmationFormatError:
+        return None
+    return c.invoice_number, c.eta_text
+
+
+def run(quick: bool = False) -> list[Result]:
+    number = QUICK_NUMBER if quick else NUMBER
+    results = list()
+    for path in sorted(EMAIL_DIR.glob("*.html")):
+        html = path.read_text()
+        if parse_streaming(html) != parse_with_soup(html):
+            raise ValueError(f"{path.name}: parsers disagree")
+
+        for parser, parse in (("soup", parse_with_soup), ("streaming", parse_streaming)):
+            params = dict(email=path.stem, parser=parser)
+            result = measure("email.parse", params, lambda: parse(html), number=number)
+            result.extra["bytes"] = len(html)
+            results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    run()
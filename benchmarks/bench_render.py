@@ -0,0 +1,67 @@
+"""
+Receipt rendering on synthetic pictures. This is the CPU bound part of
+slack_handlers.process_receipt, without the download, disk write and email.
+"""
+
+from datetime import date
+from io import BytesIO
+import random
+
+from PIL import Image, ImageDraw
+
+from harness import Result, measure
+
+from receipt_render import render_receipt
+
+# (name, width, height, format)
+PICTURES = (
+    ("screenshot", 1170, 2532, "PNG"),
+    ("phone_photo", 3024, 4032, "JPEG"),
+    ("scan", 5100, 6600, "JPEG"),
+)
+QUICK_PICTURES = PICTURES[:2]
+MESSAGES = dict(
+    short="Pizza for the build night",
+    long=" ".join(["Lumber, screws and paint for the set of the fall show."] * 40),
+)
+BYTE_BUDGETS = (None, 500_000)
+
+
+def make_picture(width: int, height: int, format: str) -> bytes:
+    "A receipt-like picture: a white page with lines of dark marks, on a noisy background"
+    rng = random.Random(width * height)
+    img = Image.effect_noise((width, height), 40).convert("RGB")
+    draw = ImageDraw.Draw(img)
+    margin = width // 8
+    draw.rectangle((margin, margin // 2, width - margin, height - margin // 2), fill="white")
+    line_height = max(height // 80, 4)
+    for y in range(margin, height - margin, line_height * 2):
+        x = margin * 1.2
+        while x < width - margin * 1.3:
+            word = rng.randrange(line_height, line_height * 6)
+            draw.rectangle((x, y, x + word, y + line_height), fill=(30, 30, 30))
+            x += word + line_height
+    with BytesIO() as bio:
+        img.save(bio, format=format)
+        return bio.getvalue()
+
+
+def run(quick: bool = False) -> list[Result]:
+    results = list()
+    for name, width, height, format in QUICK_PICTURES if quick else PICTURES:
+        data = make_picture(width, height, format)
+        for message_name, message in MESSAGES.items():
+            for budget in BYTE_BUDGETS:
+                params = dict(
+                    picture=name, message=message_name, byte_budget=budget or "none"
+                )
+                out: list[int] = list()
+
+                def render() -> None:
+                    rendered = render_receipt(data, "Bobby B.", 1234, message, date.today(), budget)
+                    out.append(len(rendered.jpeg))
+
+                result = measure("render.receipt", params, render, repeat=3)
+                result.extra.update(input_bytes=len(data), output_bytes=out[-1])
+                results.append(result)
+    return results
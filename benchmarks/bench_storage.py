@@ -0,0 +1,127 @@
+"""Load, append and lookup times of the receipt table at different sizes"""
+
+import csv
+from datetime import datetime, timedelta
+from pathlib import Path
+import random
+import tempfile
+from typing import Any
+
+from harness import Result, measure
+
+from storage import PersistentTable, Table, open_table, to_csv_value
+
+SIZES = (1_000, 100_000, 1_000_000)
+QUICK_SIZES = (1_000, 100_000)
+BACKENDS = ("csv", "sqlite")
+APPENDS = 50
+LOOKUPS = 10_000
+
+
+def convert_date(s: str) -> None | datetime:
+    return None if s == "" else datetime.fromisoformat(s)
+
+
+# The schema of the receipt tables in channels.py
+converters: dict[str, Any] = dict(
+    invoice=int,
+    slack_ts=None,
+    date_requested=convert_date,
+    date_payment_sent=convert_date,
+)
+FIELDNAMES = list(converters.keys())
+START = datetime(2023, 8, 30)
+
+
+def make_row(n: int) -> dict[str, Any]:
+    requested = START + timedelta(minutes=7 * n)
+    return dict(
+        invoice=n + 1,
+        # about two receipts per post
+        slack_ts=f"{1693455608 + 420 * (n // 2)}.{n // 2 % 1_000_000:06d}",
+        date_requested=requested,
+        date_payment_sent=requested + timedelta(days=3) if n % 5 else None,
+    )
+
+
+def write_csv(path: Path, size: int) -> None:
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+        writer.writeheader()
+        for n in range(size):
+            writer.writerow({k: to_csv_value(v) for k, v in make_row(n).items()})
+
+
+def open_receipt_table(path: Path, backend: str) -> Table:
+    "Open the table like channels.open_channel does"
+    return open_table(
+        str(path),
+        backend,
+        fieldnames=FIELDNAMES,
+        converters=converters,
+        unique_indexes=["invoice"],
+        indexes=["slack_ts", "date_requested"],
+    )
+
+
+def bench_size(directory: Path, size: int, backend: str) -> list[Result]:
+    params = dict(rows=size, backend=backend)
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"receipts_{size}.csv"
+    write_csv(path, size)
+    results = list()
+
+    def load() -> None:
+        t = open_receipt_table(path, backend)
+        # Closing a csv table rewrites the snapshot, and nothing was changed
+        if not isinstance(t, PersistentTable):
+            t.close()
+
+    # The first sqlite open migrates the csv, so time it separately
+    if backend == "sqlite":
+        results.append(measure("storage.migrate", params, load, repeat=1))
+    results.append(measure("storage.load", params, load, repeat=3))
+
+    table = open_receipt_table(path, backend)
+    rng = random.Random(size)
+    invoices = [rng.randrange(1, size + 1) for _ in range(LOOKUPS)]
+    slack_tss = [table[i - 1]["slack_ts"] for i in invoices]
+
+    def get_by() -> None:
+        for i in invoices:
+            table.get_by("invoice", i)
+
+    def get_all_by() -> None:
+        for ts in slack_tss:
+            table.get_all_by("slack_ts", ts)
+
+    day = START + timedelta(minutes=7 * size // 2)
+
+    def select_range() -> None:
+        table.select_range("date_requested", day, day + timedelta(days=1))
+
+    results.append(measure("storage.get_by", params, get_by, repeat=5, number=1))
+    results[-1].extra["per_lookup"] = results[-1].median / LOOKUPS
+    results.append(measure("storage.get_all_by", params, get_all_by, repeat=5))
+    results[-1].extra["per_lookup"] = results[-1].median / LOOKUPS
+    results.append(measure("storage.select_range", params, select_range, repeat=5))
+
+    next_row = [size]
+
+    def append() -> None:
+        table.append(**make_row(next_row[0]))
+        next_row[0] += 1
+
+    # Each append is written and fsynced to the journal
+    results.append(measure("storage.append", params, append, number=APPENDS, repeat=3))
+    table.close()
+    return results
+
+
+def run(quick: bool = False) -> list[Result]:
+    results = list()
+    with tempfile.TemporaryDirectory() as d:
+        for size in QUICK_SIZES if quick else SIZES:
+            for backend in BACKENDS:
+                results += bench_size(Path(d) / backend, size, backend)
+    return results
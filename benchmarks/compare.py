@@ -0,0 +1,57 @@
+"""
+Compare two result files of run.py. Exits with 1 if any benchmark got slower than the
+threshold.
+
+    python3 benchmarks/compare.py BASE.json NEW.json [--threshold 1.2]
+"""
+
+import argparse
+from pathlib import Path
+
+from harness import format_seconds, read_results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("base", type=Path)
+    parser.add_argument("new", type=Path)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="new/base median time above which a benchmark counts as a regression",
+    )
+    args = parser.parse_args()
+
+    base_meta, base = read_results(args.base)
+    new_meta, new = read_results(args.new)
+    print(f"base: {base_meta.get('commit')} {base_meta['time']}")
+    print(f"new:  {new_meta.get('commit')} {new_meta['time']}")
+    if base_meta["platform"] != new_meta["platform"]:
+        print("warning: the results are from different platforms")
+
+    regressions = 0
+    print(f"{'benchmark':<60} {'base':>10} {'new':>10} {'ratio':>7}")
+    for key in sorted(base.keys() & new.keys()):
+        ratio = new[key].median / base[key].median
+        flag = ""
+        if ratio > args.threshold:
+            flag = "  slower"
+            regressions += 1
+        elif ratio < 1 / args.threshold:
+            flag = "  faster"
+        print(
+            f"{key:<60} {format_seconds(base[key].median):>10}"
+            f" {format_seconds(new[key].median):>10} {ratio:>6.2f}x{flag}"
+        )
+    for key in sorted(base.keys() - new.keys()):
+        print(f"{key:<60} only in base")
+    for key in sorted(new.keys() - base.keys()):
+        print(f"{key:<60} only in new")
+
+    if regressions:
+        raise SystemExit(f"{regressions} benchmarks slower than {args.threshold}x")
+
+
+if __name__ == "__main__":
+    main()
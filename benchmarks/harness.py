@@ -0,0 +1,107 @@
+"""Timing and result files shared by the benchmarks"""
+
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+import json
+from pathlib import Path
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Callable
+
+SRC_DIR = Path(__file__).parent.parent / "src"
+# The bot's modules are imported by bare name
+sys.path.insert(0, str(SRC_DIR))
+
+
+@dataclass
+class Result:
+    # Benchmark name, e.g. storage.load
+    name: str
+    params: dict[str, Any]
+    # Seconds per operation, best and median of the repeats
+    best: float
+    median: float
+    repeat: int
+    number: int
+    # Anything else worth keeping, e.g. output sizes
+    extra: dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def key(self) -> str:
+        "Identifies the same benchmark across result files"
+        params = ",".join(f"{k}={v}" for k, v in sorted(self.params.items()))
+        return f"{self.name}[{params}]"
+
+
+def measure(
+    name: str,
+    params: dict[str, Any],
+    fn: Callable[[], Any],
+    number: int = 1,
+    repeat: int = 5,
+    setup: Callable[[], Any] | None = None,
+    teardown: Callable[[], Any] | None = None,
+) -> Result:
+    """
+    Time number calls of fn, repeat times. setup and teardown run around each repeat and are
+    not timed.
+    """
+    times = list()
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+        if teardown is not None:
+            teardown()
+    result = Result(name, params, min(times), statistics.median(times), repeat, number)
+    print(f"{result.key:<60} {format_seconds(result.median):>10}", flush=True)
+    return result
+
+
+def format_seconds(s: float) -> str:
+    for unit, scale in (("s", 1.0), ("ms", 1e-3), ("us", 1e-6)):
+        if s >= scale:
+            return f"{s / scale:.2f} {unit}"
+    return f"{s / 1e-9:.0f} ns"
+
+
+def git_commit() -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=SRC_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def write_results(path: Path, results: list[Result]) -> None:
+    data = dict(
+        meta=dict(
+            commit=git_commit(),
+            python=platform.python_version(),
+            machine=platform.machine(),
+            platform=platform.platform(),
+            time=datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        ),
+        results=[asdict(r) for r in results],
+    )
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(data, indent=2) + "\n")
+
+
+def read_results(path: Path) -> tuple[dict[str, Any], dict[str, Result]]:
+    "The metadata and the results by key of a result file"
+    data = json.loads(path.read_text())
+    results = [Result(**r) for r in data["results"]]
+    return data["meta"], {r.key: r for r in results}
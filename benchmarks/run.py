@@ -0,0 +1,46 @@
+"""
+Run the benchmarks and save the results as json, by default to
+benchmarks/results/<commit>.json. Compare two result files with compare.py.
+
+    python3 benchmarks/run.py [--quick] [--suite storage render email] [--output FILE]
+
+Nothing here needs network access or credentials.
+"""
+
+import argparse
+from importlib import import_module
+from pathlib import Path
+
+from harness import git_commit, write_results
+
+SUITES = dict(
+    storage="bench_storage",
+    render="bench_render",
+    email="bench_confirmation_parser",
+)
+RESULTS_DIR = Path(__file__).parent / "results"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the benchmarks")
+    parser.add_argument(
+        "--suite", nargs="+", choices=list(SUITES), default=list(SUITES), help="suites to run"
+    )
+    parser.add_argument(
+        "--quick", action="store_true", help="skip the largest inputs and repeat less"
+    )
+    parser.add_argument("--output", type=Path, help="result file")
+    args = parser.parse_args()
+
+    results = list()
+    for suite in args.suite:
+        print(f"== {suite}")
+        results += import_module(SUITES[suite]).run(quick=args.quick)
+
+    output = args.output or RESULTS_DIR / f"{git_commit() or 'results'}.json"
+    write_results(output, results)
+    print(f"Saved {len(results)} results to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""
+Runs the bot on one asyncio event loop. Slack events are handled by Bolt's AsyncApp, queued
+receipts are processed by coroutines and the IMAP watcher runs in the same loop, so many
+receipts and confirmations can be in flight without a thread for each. Libraries without
+async APIs run in threads and rendering runs in the process pool.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any
+
+import aiohttp
+from aiohttp import web
+from slack_bolt.async_app import AsyncApp
+from slack_bolt.context.say.async_say import AsyncSay
+from slack_sdk.http_retry.builtin_async_handlers import (
+    AsyncConnectionErrorRetryHandler,
+    AsyncRateLimitErrorRetryHandler,
+)
+from slack_sdk.web.async_client import AsyncWebClient
+
+import config
+from emailing import IMAP_CONNECTION_ERRORS, RENEW_ACCOUNT_SECONDS, ConfirmationWatcher
+from http_server import METRICS_PATH
+from job_queue import Job
+import metrics
+from receipt_render import ReceiptTooLarge
+from slack_client import (
+    CONNECTION_RETRIES,
+    RATE_LIMIT_RETRIES,
+    get_slack_client,
+    get_slack_poster,
+)
+from slack_handlers import (
+    BOT_DISPLAY_NAME,
+    BOT_ICON,
+    DOWNLOAD_CHUNK_BYTES,
+    DOWNLOAD_TIMEOUT_SECONDS,
+    ENQUEUE_TIMEOUT_SECONDS,
+    MAX_DOWNLOAD_BYTES,
+    forget_event,
+    get_channel_registry,
+    get_receipt_queue,
+    is_duplicate_event,
+    is_im,
+    process_job_data,
+    queue_receipts,
+    register_gauges,
+    receipt_reply,
+    receipt_too_large,
+)
+from user_cache import display_name, user_cache
+
+logger = logging.getLogger(__name__)
+
+# Workers also look for jobs this often, for retries that come due
+CLAIM_POLL_SECONDS = 5
+
+
+def create_async_app() -> AsyncApp:
+    client = AsyncWebClient(
+        token=config.get_slack_bot_token(),
+        retry_handlers=[
+            AsyncConnectionErrorRetryHandler(max_retry_count=CONNECTION_RETRIES),
+            AsyncRateLimitErrorRetryHandler(max_retry_count=RATE_LIMIT_RETRIES),
+        ],
+    )
+    return AsyncApp(client=client, signing_secret=config.get_slack_signing_secret())
+
+
+class AsyncReceiptWorkers:
+    """
+    Drains the receipt job queue with coroutines. Jobs are claimed without blocking, so
+    waiting for work does not hold a thread.
+    """
+
+    def __init__(self, client: AsyncWebClient, session: aiohttp.ClientSession, workers: int):
+        self.client = client
+        self.session = session
+        self.workers = workers
+        self._wake = asyncio.Event()
+
+    def notify(self) -> None:
+        "Wake the workers after jobs were queued"
+        self._wake.set()
+
+    async def run(self) -> None:
+        await asyncio.gather(*(self._worker() for _ in range(self.workers)))
+
+    async def _worker(self) -> None:
+        while True:
+            # The queue renames and writes job files, so it is used from a thread
+            job = await asyncio.to_thread(get_receipt_queue().claim, timeout=0)
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), CLAIM_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run_job(job)
+
+    async def _run_job(self, job: Job) -> None:
+        try:
+            await self.handle_receipt_job(job.payload)
+        except Exception:
+            logger.exception(f"Error handling job {job.id}")
+            await asyncio.to_thread(get_receipt_queue().fail, job)
+        else:
+            await asyncio.to_thread(get_receipt_queue().complete, job)
+
+    async def get_user_name(self, user: str) -> str:
+        name = user_cache.get_cached(user)
+        if name is not None:
+            return name
+        resp = await self.client.users_info(user=user)
+        user_dict = resp["user"]
+        if user_dict is None:
+            return display_name(None)
+        user_cache.put(user_dict)
+        return display_name(user_dict)
+
+    async def download_file(self, download_url: str) -> bytes:
+        "Download a file from slack in chunks, refusing files larger than MAX_DOWNLOAD_BYTES"
+        connect_timeout, read_timeout = DOWNLOAD_TIMEOUT_SECONDS
+        async with self.session.get(
+            download_url,
+            headers={"Authorization": f"Bearer {config.get_slack_bot_token()}"},
+            timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+        ) as r:
+            r.raise_for_status()
+            if r.content_length is not None and r.content_length > MAX_DOWNLOAD_BYTES:
+                raise ReceiptTooLarge(f"File is {r.content_length // 2**20} MB")
+
+            data = bytearray()
+            async for chunk in r.content.iter_chunked(DOWNLOAD_CHUNK_BYTES):
+                data += chunk
+                if len(data) > MAX_DOWNLOAD_BYTES:
+                    raise ReceiptTooLarge(f"File is over {MAX_DOWNLOAD_BYTES // 2**20} MB")
+        return bytes(data)
+
+    async def handle_receipt_job(self, job: dict[str, Any]) -> None:
+        """
+        The same as slack_handlers.handle_receipt_job. The user lookup and download are
+        coroutines, the rest of the pipeline runs in a thread.
+        """
+        receipt_num: int = job["receipt_number"]
+        channel = get_channel_registry().get(job["channel"])
+        if channel is None:
+            raise ValueError(f'Receipt #{receipt_num:05} is from unknown channel {job["channel"]}')
+
+        text = receipt_reply(receipt_num)
+
+        if channel.table.get_by("invoice", receipt_num) is None:
+            with metrics.receipt_stage_seconds.time("user_lookup"):
+                uname = await self.get_user_name(job["user"])
+
+            logger.info(f"Processing receipt #{receipt_num:05}")
+            try:
+                with metrics.receipt_stage_seconds.time("download"):
+                    file_data = await self.download_file(job["download_url"])
+                text = await asyncio.to_thread(process_job_data, job, channel, file_data, uname)
+            except ReceiptTooLarge as e:
+                text = receipt_too_large(receipt_num, e)
+            except Exception:
+                metrics.receipts_total.inc("error")
+                raise
+
+        with metrics.receipt_stage_seconds.time("reply"):
+            await self.post_reply(job, text)
+
+    async def post_reply(self, job: dict[str, Any], text: str) -> None:
+        "Reply through the slack poster, which keeps to slack's rate limits"
+        future = get_slack_poster().post_message(
+            job["channel"],
+            text,
+            thread_ts=job["ts"],
+            username=BOT_DISPLAY_NAME,
+            icon_emoji=BOT_ICON,
+        )
+        await asyncio.wrap_future(future)
+
+
+async def watch_emails() -> None:
+    """
+    Process payment confirmation emails. imap_tools only blocks, so each IMAP command runs in
+    a thread while the loop keeps serving slack.
+    """
+    channels = [c for c in get_channel_registry() if c.id is not None]
+    watcher = ConfirmationWatcher(
+        {c.id: c.table for c in channels}, {c.id: c.invoices for c in channels}
+    )
+    logger.info("Watching for emails.")
+    while True:
+        start_time = time.monotonic()
+        try:
+            await asyncio.to_thread(watcher.connect)
+            # Process anything that arrived while disconnected
+            await asyncio.to_thread(watcher.catch_up)
+            # log out every so often to renew the account
+            while (time.monotonic() - start_time) < RENEW_ACCOUNT_SECONDS:
+                if await asyncio.to_thread(watcher.wait):
+                    await asyncio.to_thread(watcher.catch_up)
+            await asyncio.to_thread(watcher.logout)
+        except IMAP_CONNECTION_ERRORS as e:
+            metrics.imap_reconnects_total.inc()
+            logger.error(f"IMAP error, reconnect in a minute: {e}")
+            await asyncio.sleep(60)
+        except Exception:
+            logger.exception("Unhandled exception in email watcher! Retrying...")
+            await asyncio.sleep(10)
+
+
+async def serve_metrics(request: web.Request) -> web.Response:
+    return web.Response(
+        body=metrics.registry.render().encode(), headers={"Content-Type": metrics.CONTENT_TYPE}
+    )
+
+
+async def run(port: int = 3000) -> None:
+    "Serve slack events and process receipts and emails until cancelled"
+    app = create_async_app()
+    async with aiohttp.ClientSession() as session:
+        workers = AsyncReceiptWorkers(app.client, session, config.get_receipt_workers())
+
+        @app.event({"type": "message"})
+        async def handle_message(
+            message: dict[str, Any], say: AsyncSay, body: dict[str, Any]
+        ) -> None:
+            # Off the loop, the cache takes a lock shared with the worker threads
+            if await asyncio.to_thread(is_duplicate_event, body):
+                return
+            try:
+                await handle_new_message(message, say)
+            except BaseException:
+                # Let slack's retry of this event through
+                await asyncio.to_thread(forget_event, body)
+                raise
+
+        async def handle_new_message(message: dict[str, Any], say: AsyncSay) -> None:
+            if get_channel_registry().get(message.get("channel")) is not None:
+                logger.info(f'Received reimbursement post from user {message["user"]}')
+                if "files" in message:
+                    # Writes the jobs to disk and may wait for room in the queue
+                    await asyncio.to_thread(queue_receipts, message, ENQUEUE_TIMEOUT_SECONDS)
+                    workers.notify()
+                elif "thread_ts" not in message:
+                    await say(
+                        "Please post the receipt",
+                        thread_ts=message["ts"],
+                        username=BOT_DISPLAY_NAME,
+                        icon_emoji=BOT_ICON,
+                    )
+            elif is_im(message):
+                await say("I am Reimbursement bot. Fight me.")
+            else:
+                logger.info(
+                    f'Unhandled message from user {message.get("user")}'
+                    f' on channel {message.get("channel")}'
+                )
+
+        @app.event("user_change")
+        async def handle_user_change(event: dict[str, Any]) -> None:
+            user_cache.handle_user_change(event)
+
+        web_app = app.web_app(port=port)
+        web_app.router.add_get(METRICS_PATH, serve_metrics)
+        register_gauges()
+        runner = web.AppRunner(web_app)
+        await runner.setup()
+        await web.TCPSite(runner, port=port).start()
+        logger.info(f"Listening for slack events on port {port}")
+
+        # cache user names so receipts do not wait on users_info
+        warm = asyncio.create_task(asyncio.to_thread(user_cache.warm, get_slack_client()))
+        try:
+            await asyncio.gather(workers.run(), watch_emails())
+        finally:
+            warm.cancel()
+            await runner.cleanup()
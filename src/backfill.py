@@ -0,0 +1,98 @@
+"""Re-drive reimbursement posts that were missed while the bot was down"""
+
+from datetime import datetime
+import logging
+from typing import Any, Iterator
+
+from slack_bolt.context.say.say import Say
+from slack_sdk import WebClient
+
+from channels import ReimbursementChannel
+from slack_handlers import handle_reimbursement_post, receipt_files
+
+logger = logging.getLogger(__name__)
+
+HISTORY_PAGE_SIZE = 200
+
+
+def parse_ts(s: str) -> str:
+    "Accept a slack timestamp or an ISO date and return a slack timestamp"
+    try:
+        float(s)
+        return s
+    except ValueError:
+        return f"{datetime.fromisoformat(s).timestamp():.6f}"
+
+
+def iter_replies(client: WebClient, channel_id: str, thread_ts: str) -> Iterator[dict[str, Any]]:
+    "Replies in a thread, without the parent message"
+    cursor = None
+    while True:
+        resp = client.conversations_replies(
+            channel=channel_id, ts=thread_ts, limit=HISTORY_PAGE_SIZE, cursor=cursor
+        )
+        for m in resp.get("messages", []):
+            if m["ts"] != thread_ts:
+                yield m
+        cursor = resp.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            return
+
+
+def iter_posts(
+    client: WebClient, channel_id: str, oldest: str, latest: str | None
+) -> Iterator[dict[str, Any]]:
+    "Messages and thread replies posted in a channel between oldest and latest"
+    cursor = None
+    while True:
+        resp = client.conversations_history(
+            channel=channel_id,
+            oldest=oldest,
+            latest=latest,
+            inclusive=True,
+            limit=HISTORY_PAGE_SIZE,
+            cursor=cursor,
+        )
+        for m in resp.get("messages", []):
+            yield m
+            if m.get("reply_count"):
+                yield from iter_replies(client, channel_id, m["ts"])
+        cursor = resp.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            return
+
+
+def backfill(
+    client: WebClient, channel: ReimbursementChannel, oldest: str, latest: str | None = None
+) -> int:
+    """
+    Queue receipts from posts between oldest and latest that are not in the channel's table.
+    Waits for room in the receipt queue, so the queue workers bound the concurrency. Returns
+    the number of posts queued.
+
+    A post is skipped once the table has a receipt for each of its pictures. Otherwise it is
+    handled again, and files that were queued before are skipped by their dedup keys, so a post
+    that was only partly queued gets its remaining files queued.
+    """
+    if channel.id is None:
+        raise ValueError(f"Channel {channel.name} has not been resolved")
+
+    queued = 0
+    for m in iter_posts(client, channel.id, oldest, latest):
+        # Only posts from people that have files can be receipts
+        if "user" not in m or "bot_id" in m or "files" not in m:
+            continue
+        files = receipt_files(m)
+        if not files or len(channel.table.get_all_by("slack_ts", m["ts"])) >= len(files):
+            continue
+
+        # history messages do not say which channel they are from
+        msg = dict(m, channel=channel.id)
+        logger.info(f"Backfilling post {m['ts']} from user {m['user']}")
+        handle_reimbursement_post(
+            msg, Say(client=client, channel=channel.id), client, msg, enqueue_timeout=None
+        )
+        queued += 1
+
+    logger.info(f"Backfilled {queued} posts in {channel.name}")
+    return queued
@@ -0,0 +1,174 @@
+"""Registry of the reimbursement channels the bot serves"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import datetime
+import logging
+from pathlib import Path
+import re
+import sys
+from typing import TYPE_CHECKING, Iterator
+
+import config
+from receipt_archive import ReceiptArchive
+from receipt_index import ReceiptIndex
+from storage import Sequence, Table, open_table, write_atomic
+
+if TYPE_CHECKING:
+    from slack_sdk import WebClient
+
+logger = logging.getLogger(__name__)
+
+CONVERSATIONS_LIST_PAGE_SIZE = 1000
+CHANNEL_ID_PATTERN = re.compile(r"^[CG][A-Z0-9]{8,}$")
+DATA_DIR = (Path(__file__).parent / "../data").resolve()
+# Name of the channel whose data is kept directly in the data directory
+DATA_DIR_OWNER_FILE = "data_dir_channel.txt"
+
+
+def convert_date(s: str) -> None | datetime:
+    if s == "":
+        return None
+    else:
+        return datetime.fromisoformat(s)
+
+
+converters = dict(
+    invoice=int,
+    slack_ts=None,
+    date_requested=convert_date,
+    date_payment_sent=convert_date,
+)
+
+
+@dataclass
+class ReimbursementChannel:
+    # Name or id from the configuration
+    name: str
+    # Slack channel id, None until the name is resolved
+    id: str | None
+    table: Table
+    sequence: Sequence
+    # Invoice numbers the channel hands out
+    invoices: range
+    # Hashes of the receipt pictures, to find receipts that were submitted before
+    hashes: ReceiptIndex
+    # Rendered receipts on disk
+    archive: ReceiptArchive
+
+
+def open_channel(
+    name: str, first_invoice: int, last_invoice: int | None, data_dir: Path
+) -> ReimbursementChannel:
+    "Open the receipt table and invoice sequence of a channel stored in data_dir"
+    data_dir.mkdir(parents=True, exist_ok=True)
+    table = open_table(
+        str(data_dir / "reimbursements.csv"),
+        config.get_storage_backend(),
+        fieldnames=list(converters.keys()),
+        converters=converters,
+        unique_indexes=["invoice"],
+        # one post can have several receipts
+        indexes=["slack_ts", "date_requested"],
+    )
+    # Receipt numbers are reserved up front so concurrent posts never get the same number.
+    # Workers record receipts as they finish, so the last row is not always the highest.
+    highest = max((r["invoice"] for r in table), default=0)
+    if last_invoice is not None and highest > last_invoice:
+        raise ValueError(
+            f"Channel {name} already has invoice {highest}, after the last of its range"
+            f" {last_invoice}"
+        )
+    sequence = Sequence(
+        str(data_dir / "invoice_sequence.txt"),
+        start=max(first_invoice, highest + 1),
+        end=last_invoice,
+    )
+    invoices = range(first_invoice, sys.maxsize if last_invoice is None else last_invoice + 1)
+    hashes = ReceiptIndex.open(str(data_dir / "receipt_hashes.csv"))
+    archive = ReceiptArchive.open(data_dir / "receipts")
+    channel_id = name if CHANNEL_ID_PATTERN.match(name) else None
+    return ReimbursementChannel(
+        name=name,
+        id=channel_id,
+        table=table,
+        sequence=sequence,
+        invoices=invoices,
+        hashes=hashes,
+        archive=archive,
+    )
+
+
+class ChannelRegistry:
+    """
+    The configured reimbursement channels, looked up by slack channel id. Channels can be
+    configured by id or by name. Names are resolved with resolve().
+
+    One channel keeps its data directly in data/ so existing data carries over, the first one
+    configured when the bot first ran. Its name is recorded in DATA_DIR_OWNER_FILE, so
+    reordering the configuration does not hand its data to another channel. Other channels
+    keep theirs in data/channels/<name>/.
+    """
+
+    def __init__(self, channels: list[ReimbursementChannel]):
+        if not channels:
+            raise ValueError("At least one reimbursement channel must be configured")
+        self.channels = channels
+        self._by_id: dict[str, ReimbursementChannel] = {c.id: c for c in channels if c.id}
+
+    @classmethod
+    def from_config(cls, data_dir: Path = DATA_DIR) -> "ChannelRegistry":
+        configured = config.get_reimbursement_channels()
+        owner_file = data_dir / DATA_DIR_OWNER_FILE
+        if owner_file.exists():
+            owner = owner_file.read_text().strip()
+        else:
+            owner = configured[0][0]
+            data_dir.mkdir(parents=True, exist_ok=True)
+            write_atomic(str(owner_file), owner)
+        if all(name != owner for name, _, _ in configured):
+            logger.warning(f"Channel {owner} with its data in {data_dir} is not configured")
+
+        channels = list()
+        for name, first_invoice, last_invoice in configured:
+            channel_dir = data_dir if name == owner else data_dir / "channels" / name
+            channels.append(open_channel(name, first_invoice, last_invoice, channel_dir))
+        return cls(channels)
+
+    @property
+    def primary(self) -> ReimbursementChannel:
+        return self.channels[0]
+
+    def __iter__(self) -> Iterator[ReimbursementChannel]:
+        return iter(self.channels)
+
+    def get(self, channel_id: str | None) -> ReimbursementChannel | None:
+        "Get the reimbursement channel with this id, or None if it is not one"
+        if channel_id is None:
+            return None
+        return self._by_id.get(channel_id)
+
+    def resolve(self, client: WebClient) -> None:
+        "Look up the ids of channels configured by name"
+        unresolved = {c.name.lstrip("#"): c for c in self.channels if c.id is None}
+        cursor = None
+        while unresolved:
+            resp = client.conversations_list(
+                types="public_channel,private_channel",
+                exclude_archived=True,
+                limit=CONVERSATIONS_LIST_PAGE_SIZE,
+                cursor=cursor,
+            )
+            for conv in resp.get("channels", []):
+                channel = unresolved.pop(conv["name"], None)
+                if channel is not None:
+                    channel.id = conv["id"]
+                    self._by_id[conv["id"]] = channel
+                    logger.info(f"Reimbursement channel #{conv['name']} is {conv['id']}")
+            cursor = resp.get("response_metadata", {}).get("next_cursor")
+            if not cursor:
+                break
+
+        for name in unresolved:
+            logger.error(f"Could not find reimbursement channel {name}")
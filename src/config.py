@@ -13,6 +13,24 @@ class ConfigVars(StrEnum):
     SLACK_BT = 'SLACK_BOT_TOKEN'
 
 
+class OptionalConfigVars(StrEnum):
+    STORAGE_BACKEND = 'STORAGE_BACKEND'
+    RECEIPT_WORKERS = 'RECEIPT_WORKERS'
+    RECEIPT_QUEUE_SIZE = 'RECEIPT_QUEUE_SIZE'
+    RENDER_PROCESSES = 'RENDER_PROCESSES'
+    MAIL_COALESCE_SECONDS = 'MAIL_COALESCE_SECONDS'
+    JPEG_BYTE_BUDGET = 'RECEIPT_JPEG_BYTE_BUDGET'
+    REIMBURSEMENT_CHANNELS = 'REIMBURSEMENT_CHANNELS'
+    CONFIRMATION_SENDER = 'PAYMENT_CONFIRMATION_SENDER'
+    SLACK_COALESCE_SECONDS = 'SLACK_COALESCE_SECONDS'
+    COMPACT_AFTER_DAYS = 'RECEIPT_COMPACT_AFTER_DAYS'
+    RETENTION_DAYS = 'RECEIPT_RETENTION_DAYS'
+
+
+STORAGE_BACKENDS = ('csv', 'sqlite')
+DEFAULT_REIMBURSEMENT_CHANNEL = 'C9NG0FSG4'
+
+
 def check_env_vars() -> None:
     '''Check that the necessary environment variables are set'''
     missing = []
@@ -52,6 +70,125 @@ def get_slack_bot_token() -> str:
     return os.environ[ConfigVars.SLACK_BT]
 
 
+def get_optional_int(var: OptionalConfigVars, default: int) -> int:
+    v = os.environ.get(var)
+    if v is None:
+        return default
+    try:
+        return int(v)
+    except ValueError:
+        raise ValueError(f'{var} must be an integer, not {v}')
+
+
+def get_optional_float(var: OptionalConfigVars, default: float) -> float:
+    v = os.environ.get(var)
+    if v is None:
+        return default
+    try:
+        return float(v)
+    except ValueError:
+        raise ValueError(f'{var} must be a number, not {v}')
+
+
+def get_storage_backend() -> str:
+    backend = os.environ.get(OptionalConfigVars.STORAGE_BACKEND, 'csv')
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(
+            f'{OptionalConfigVars.STORAGE_BACKEND} must be one of {STORAGE_BACKENDS}, not {backend}'
+        )
+    return backend
+
+
+def get_receipt_workers() -> int:
+    return get_optional_int(OptionalConfigVars.RECEIPT_WORKERS, 2)
+
+
+def get_receipt_queue_size() -> int:
+    return get_optional_int(OptionalConfigVars.RECEIPT_QUEUE_SIZE, 100)
+
+
+def get_render_processes() -> int:
+    'Number of processes rendering receipt images. 0 renders on the calling thread.'
+    return get_optional_int(OptionalConfigVars.RENDER_PROCESSES, os.cpu_count() or 1)
+
+
+def get_mail_coalesce_seconds() -> float:
+    'Receipts from one post sent within this many seconds are combined into one email'
+    return get_optional_float(OptionalConfigVars.MAIL_COALESCE_SECONDS, 0)
+
+
+def get_jpeg_byte_budget() -> int | None:
+    'Size receipt JPEGs should be kept under, or None to use a fixed quality'
+    budget = get_optional_int(OptionalConfigVars.JPEG_BYTE_BUDGET, 0)
+    return budget if budget > 0 else None
+
+
+def get_reimbursement_channels() -> list[tuple[str, int, int | None]]:
+    '''
+    Reimbursement channel names or ids with the first and last invoice number of each, from a
+    comma separated list of name[:first_invoice[-last_invoice]]. Each channel has its own range
+    of invoice numbers so payment emails can be matched to a channel. Only the first channel
+    may leave out its first invoice, it then starts at 1. A channel without a last invoice ends
+    before the next higher range, the last is None for the highest one.
+    '''
+    var = OptionalConfigVars.REIMBURSEMENT_CHANNELS
+    v = os.environ.get(var, DEFAULT_REIMBURSEMENT_CHANNEL)
+    channels: list[tuple[str, int, int | None]] = []
+    for entry in v.split(','):
+        name, _, numbers = entry.strip().partition(':')
+        if not name:
+            continue
+        if any(name == n for n, _, _ in channels):
+            raise ValueError(f'{var} lists channel {name} more than once')
+        if not numbers and channels:
+            raise ValueError(
+                f'{var} entry {entry} needs a first invoice, only the first channel starts at 1'
+            )
+        first, _, last = numbers.partition('-')
+        try:
+            channels.append((name, int(first) if first else 1, int(last) if last else None))
+        except ValueError:
+            raise ValueError(
+                f'{var} entry {entry} should be name, name:first_invoice or'
+                ' name:first_invoice-last_invoice'
+            )
+
+    # Check the ranges do not overlap and end each open range before the next one
+    ends = {name: last for name, _, last in channels}
+    ordered = sorted(channels, key=lambda c: c[1])
+    for (name, first, last), (next_name, next_first, _) in zip(ordered, ordered[1:]):
+        if first == next_first or (last is not None and last >= next_first):
+            raise ValueError(f'{var} gives {name} and {next_name} overlapping invoice numbers')
+        if last is None:
+            ends[name] = next_first - 1
+    for name, first, last in channels:
+        if last is not None and last < first:
+            raise ValueError(f'{var} gives {name} a last invoice before its first')
+    return [(name, first, ends[name]) for name, first, _ in channels]
+
+
+def get_confirmation_sender() -> str:
+    'Address payment confirmation emails come from, or empty to accept any sender'
+    return os.environ.get(OptionalConfigVars.CONFIRMATION_SENDER, '')
+
+
+def get_slack_coalesce_seconds() -> float:
+    'Bot messages to one thread sent within this many seconds are combined into one message'
+    return get_optional_float(OptionalConfigVars.SLACK_COALESCE_SECONDS, 0)
+
+
+def get_compact_after_days() -> int | None:
+    'Days after payment a receipt is re-encoded smaller, or None to keep it as rendered'
+    days = get_optional_int(OptionalConfigVars.COMPACT_AFTER_DAYS, 0)
+    return days if days > 0 else None
+
+
+def get_retention_days() -> int | None:
+    'Days after payment a receipt is deleted, or None to keep it forever'
+    days = get_optional_int(OptionalConfigVars.RETENTION_DAYS, 0)
+    return days if days > 0 else None
+
+
 def test() -> None:
     check_env_vars()
     print(f'mail name: {get_mail_bot_name()}')
@@ -60,6 +197,17 @@ def test() -> None:
     print(f'mail dest: {get_destination_email()}')
     print(f'slack ss: {get_slack_signing_secret()}')
     print(f'slack bt: {get_slack_bot_token()}')
+    print(f'storage backend: {get_storage_backend()}')
+    print(f'receipt workers: {get_receipt_workers()}')
+    print(f'receipt queue size: {get_receipt_queue_size()}')
+    print(f'render processes: {get_render_processes()}')
+    print(f'mail coalesce seconds: {get_mail_coalesce_seconds()}')
+    print(f'jpeg byte budget: {get_jpeg_byte_budget()}')
+    print(f'reimbursement channels: {get_reimbursement_channels()}')
+    print(f'confirmation sender: {get_confirmation_sender()}')
+    print(f'slack coalesce seconds: {get_slack_coalesce_seconds()}')
+    print(f'compact after days: {get_compact_after_days()}')
+    print(f'retention days: {get_retention_days()}')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,121 @@
+"""
+Extracts the invoice number and payment ETA from melio payment confirmation emails. The HTML is
+tokenized as a stream and parsing stops as soon as both fields were seen.
+"""
+
+from dataclasses import dataclass
+from datetime import date, datetime
+from html.parser import HTMLParser
+import re
+
+REGEX_SUB_FOR_NL = r"\s*\n+\s*"
+INVOICE_NUMBER_KEY = "Invoice number"
+ETA_KEY = "Payment delivery ETA"
+ETA_DT_FMT = "%a, %B %d, %Y"  # https://docs.python.org/3/library/time.html#time.strftime
+# The text of these tags is not part of the email text
+SKIPPED_TAGS = ("script", "style")
+
+_LINE_SPLIT = re.compile(REGEX_SUB_FOR_NL)
+
+
+class ConfirmationFormatError(ValueError):
+    "Raised when an email does not have the expected fields. The email format may have changed."
+
+
+@dataclass
+class PaymentConfirmation:
+    invoice_number: int
+    # The ETA as written in the email
+    eta_text: str
+    # None if the ETA is not in ETA_DT_FMT
+    eta: date | None
+
+
+class _Done(Exception):
+    "Raised from the parser callbacks to stop tokenizing"
+
+
+class _FieldParser(HTMLParser):
+    """
+    Splits the text of the document into lines the same way as collapsing REGEX_SUB_FOR_NL
+    would, and takes the line after each key as its value
+    """
+
+    def __init__(self, keys: tuple[str, ...]):
+        super().__init__()
+        self.values: dict[str, str] = dict()
+        self._keys = keys
+        self._expecting: str | None = None
+        self._pending = ""
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
+        if tag in SKIPPED_TAGS:
+            self._skip_depth += 1
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in SKIPPED_TAGS and self._skip_depth > 0:
+            self._skip_depth -= 1
+
+    def handle_data(self, data: str) -> None:
+        if self._skip_depth:
+            return
+        self._pending += data
+        # Text after the last newline may continue in the next data
+        cut = self._pending.rfind("\n")
+        if cut == -1:
+            return
+        complete, self._pending = self._pending[:cut], self._pending[cut:]
+        self._lines(complete)
+
+    def close(self) -> None:
+        super().close()
+        self._lines(self._pending)
+        self._pending = ""
+
+    def _lines(self, text: str) -> None:
+        for line in _LINE_SPLIT.split(text.rstrip()):
+            # Collapsed newlines never leave empty lines, except where text was cut
+            if line == "":
+                continue
+            if self._expecting is not None:
+                self.values[self._expecting] = line
+                self._expecting = None
+                if len(self.values) == len(self._keys):
+                    raise _Done()
+            elif line in self._keys and line not in self.values:
+                self._expecting = line
+
+
+def parse_confirmation(html: str) -> PaymentConfirmation:
+    "Get the invoice number and ETA from the HTML of a payment confirmation email"
+    parser = _FieldParser((INVOICE_NUMBER_KEY, ETA_KEY))
+    try:
+        parser.feed(html)
+        parser.close()
+    except _Done:
+        pass
+
+    missing = [k for k in (INVOICE_NUMBER_KEY, ETA_KEY) if k not in parser.values]
+    if missing:
+        raise ConfirmationFormatError(f"Could not find {', '.join(missing)}")
+    try:
+        invoice_number = int(parser.values[INVOICE_NUMBER_KEY])
+    except ValueError:
+        raise ConfirmationFormatError(
+            f"Could not parse invoice number {parser.values[INVOICE_NUMBER_KEY]!r}"
+        )
+
+    eta_text = parser.values[ETA_KEY]
+    try:
+        eta: date | None = datetime.strptime(eta_text, ETA_DT_FMT).date()
+    except ValueError:
+        eta = None
+    return PaymentConfirmation(invoice_number=invoice_number, eta_text=eta_text, eta=eta)
+
+
+if __name__ == "__main__":
+    import sys
+
+    with open(sys.argv[1], "r") as f:
+        print(parse_confirmation(f.read()))
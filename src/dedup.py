@@ -0,0 +1,165 @@
+"""Remembers handled slack events and files so redeliveries are dropped"""
+
+from collections import OrderedDict
+import logging
+import time
+from threading import Event, Lock, Thread
+
+from storage import PersistentTable
+
+logger = logging.getLogger(__name__)
+
+# Slack retries an event for a few minutes. Files are kept longer so a repeated post of the
+# same message is caught too.
+DEDUP_TTL_SECONDS = 24 * 60 * 60
+DEDUP_MAX_SIZE = 100_000
+# New keys are written to disk in a batch this often. A crash loses at most this much.
+DEDUP_FLUSH_SECONDS = 1.0
+# Expired and evicted keys are dropped from the file this often
+DEDUP_PRUNE_SECONDS = 60 * 60
+
+converters = dict(
+    key=None,
+    expires=float,
+)
+
+
+def event_key(body: dict[str, object]) -> str | None:
+    "Key of a slack event delivery, the same for every retry of it"
+    event_id = body.get("event_id")
+    return None if event_id is None else f"event:{event_id}"
+
+
+def file_key(slack_ts: str, file_id: str) -> str:
+    return f"file:{slack_ts}:{file_id}"
+
+
+class DedupCache:
+    """
+    Keys that were already handled, each kept for ttl seconds and at most max_size of them,
+    dropping the oldest first. Adding and checking a key only touch memory. New keys are
+    written to a journaled table by a background thread every DEDUP_FLUSH_SECONDS, or by
+    flush(), and the table is loaded on startup so the cache survives restarts. Expired and
+    evicted keys are dropped from the table on startup and every DEDUP_PRUNE_SECONDS, so it
+    stays under max_size rows.
+    """
+
+    def __init__(
+        self,
+        filename: str | None,
+        ttl: float = DEDUP_TTL_SECONDS,
+        max_size: int = DEDUP_MAX_SIZE,
+    ):
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> wall clock expiry time, oldest first
+        self._keys: OrderedDict[str, float] = OrderedDict()
+        self._lock = Lock()
+        # key -> expiry time not written to the table yet, 0 for discarded keys
+        self._unwritten: dict[str, float] = dict()
+        # Held while writing to the table, never while holding _lock
+        self._write_lock = Lock()
+        self._stop = Event()
+        self._thread: Thread | None = None
+        self.table: PersistentTable | None = None
+
+        if filename is not None:
+            self.table = PersistentTable(
+                filename,
+                fieldnames=list(converters.keys()),
+                converters=converters,
+                journaled=True,
+                unique_indexes=["key"],
+            )
+            now = time.time()
+            for row in sorted(self.table, key=lambda r: r["expires"])[-max_size:]:
+                if row["expires"] > now:
+                    self._keys[row["key"]] = row["expires"]
+            self.prune()
+            self._thread = Thread(target=self._run, name="dedup-writer", daemon=True)
+            self._thread.start()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            expires = self._keys.get(key)
+            return expires is not None and expires > time.time()
+
+    def add(self, key: str) -> bool:
+        "Remember key. Returns False if it was already remembered, so the caller should skip it."
+        now = time.time()
+        with self._lock:
+            expires = self._keys.get(key)
+            if expires is not None and expires > now:
+                return False
+            self._keys[key] = now + self.ttl
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.max_size:
+                evicted, _ = self._keys.popitem(last=False)
+                self._unwritten.pop(evicted, None)
+            if self.table is not None:
+                self._unwritten[key] = now + self.ttl
+        return True
+
+    def discard(self, key: str) -> None:
+        "Forget key, for work that was not done after all and should be retried"
+        with self._lock:
+            if self._keys.pop(key, None) is not None and self.table is not None:
+                self._unwritten[key] = 0.0
+
+    def flush(self) -> None:
+        "Write the keys added or discarded since the last flush to the table"
+        if self.table is None:
+            return
+        with self._write_lock:
+            with self._lock:
+                unwritten, self._unwritten = self._unwritten, dict()
+            for key, expires in unwritten.items():
+                if self.table.get_by("key", key) is not None:
+                    self.table.update(key, expires=expires)
+                elif expires > 0:
+                    self.table.append(key=key, expires=expires)
+
+    def prune(self) -> None:
+        "Drop keys that expired or were evicted from memory from the table"
+        if self.table is None:
+            return
+        with self._write_lock:
+            now = time.time()
+            with self._lock:
+                live = {k: e for k, e in self._keys.items() if e > now}
+                live.update((k, e) for k, e in self._unwritten.items() if e > now)
+            dropped = self.table.retain(lambda r: r["key"] in live)
+        if dropped:
+            logger.info(f"Dropped {dropped} expired keys from {self.table.filename}")
+
+    def _run(self) -> None:
+        next_prune = time.monotonic() + DEDUP_PRUNE_SECONDS
+        while not self._stop.wait(DEDUP_FLUSH_SECONDS):
+            try:
+                self.flush()
+                if time.monotonic() >= next_prune:
+                    next_prune = time.monotonic() + DEDUP_PRUNE_SECONDS
+                    self.prune()
+            except Exception:
+                logger.exception("Writing handled events failed")
+
+    def close(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if self.table is not None:
+            self.flush()
+            self.table.close()
+
+
+if __name__ == "__main__":
+    cache = DedupCache("/tmp/demo_dedup.csv", ttl=60)
+    print("first", cache.add("event:Ev1"), "again", cache.add("event:Ev1"))
+    cache.discard("event:Ev1")
+    print("after discard", cache.add("event:Ev1"), len(cache), "keys")
+    cache.close()
+    print("reloaded", "event:Ev1" in DedupCache("/tmp/demo_dedup.csv"))
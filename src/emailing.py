@@ -1,17 +1,22 @@
 import config
-from slack_handlers import REIMBURSEMENT_CHANNEL, BOT_DISPLAY_NAME, BOT_ICON
-from storage import PersistentTable
+from confirmation_parser import ConfirmationFormatError, parse_confirmation
+from slack_client import get_slack_poster
+import metrics
+from slack_handlers import BOT_DISPLAY_NAME, BOT_ICON
+from storage import PersistentTable, Table, write_atomic
 from imap_tools import MailBox, MailboxLogoutError, MailboxLoginError  # type: ignore
-from imap_tools import A, MailMessage  # type: ignore
+from imap_tools import A, U, MailMessage  # type: ignore
 import time
 from datetime import datetime
 import socket
 import imaplib
-from slack_sdk import WebClient
 import traceback
-from bs4 import BeautifulSoup
-import re
+import json
 import logging
+import os
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Mapping
 
 logger = logging.getLogger(__name__)
 
@@ -20,10 +25,28 @@ RENEW_ACCOUNT_SECONDS = 29 * 60
 IDLE_WAIT_SECONDS = 3 * 60
 IMAP_POLL_PERIOD = 10
 SUBJECT_FILTER_TEXT = "payment is scheduled for"
-REGEX_SUB_FOR_NL = r"\s*\n+\s*"
-INVOICE_NUMBER_KEY = "Invoice number"
-ETA_KEY = "Payment delivery ETA"
-ETA_DT_FMT = "%a, %B %d, %Y"  # https://docs.python.org/3/library/time.html#time.strftime
+CHECKPOINT_PATH = (Path(__file__).parent / "../data/imap_checkpoint.json").resolve()
+
+
+@dataclass
+class ImapCheckpoint:
+    """
+    The last processed message of the inbox. UIDs are only comparable while UIDVALIDITY stays
+    the same.
+    """
+
+    uidvalidity: int
+    last_uid: int
+
+    def save(self, path: str) -> None:
+        write_atomic(path, json.dumps(asdict(self)))
+
+    @classmethod
+    def load(cls, path: str) -> "ImapCheckpoint | None":
+        if not os.access(path, os.R_OK):
+            return None
+        with open(path, "r") as f:
+            return cls(**json.load(f))
 
 
 def test_receive() -> None:
@@ -44,29 +67,79 @@ def test_receive() -> None:
 
 
 def emailing_thread() -> None:
-    from slack_handlers import receipt_table
+    from slack_handlers import get_channel_registry
 
     logger.info("Starting emailing thread...")
+    channels = [c for c in get_channel_registry() if c.id is not None]
+    tables = {c.id: c.table for c in channels}
+    invoices = {c.id: c.invoices for c in channels}
 
     # Restart on unhandled exception
     while True:
         try:
-            wait_for_reimbursement_processed_email(receipt_table)
+            wait_for_reimbursement_processed_email(tables, invoices)
         except BaseException as e:
             logger.error("Unhandled exception in emailing thread! Retrying...")
             logger.info(e)
             time.sleep(10)
 
 
-# https://github.com/ikvk/imap_tools/blob/master/examples/idle.py
-# TODO: check for new emails on starting
-def wait_for_reimbursement_processed_email(table: PersistentTable) -> None:
+# Errors that mean the IMAP connection is gone and should be reopened
+IMAP_CONNECTION_ERRORS = (
+    TimeoutError,
+    ConnectionError,
+    imaplib.IMAP4.abort,
+    MailboxLoginError,
+    MailboxLogoutError,
+    socket.herror,
+    socket.gaierror,
+    socket.timeout,
+)
+
+
+class ConfirmationWatcher:
     """
-    Wait for an email from melio that the payment was processed. Respond to the slack message with
-    the ETA.
+    Processes emails from melio saying that a payment was processed and responds to the slack
+    message with the ETA. tables maps reimbursement channel ids to their receipt tables, and
+    invoices to the invoice numbers each channel hands out. A confirmation goes to the channel
+    whose range holds its invoice number.
+
+    The UID of the last processed email is saved to checkpoint_path. On every connection and
+    IDLE notification, emails after it are processed, so emails that arrived while the bot was
+    down are not missed and no email is processed twice.
+
+    The methods block, so the threaded and the asyncio runtime can both drive them.
     """
 
-    def process_email(msg: MailMessage) -> None:
+    def __init__(
+        self,
+        tables: Mapping[str, Table],
+        invoices: Mapping[str, range] | None = None,
+        checkpoint_path: str = str(CHECKPOINT_PATH),
+    ):
+        self.tables = tables
+        self.invoices = invoices or {}
+        self.checkpoint_path = checkpoint_path
+        self.mbox: MailBox | None = None
+
+    def connect(self) -> None:
+        mbox = MailBox("imap.gmail.com")  # type: ignore
+        mbox.login(config.get_mail_bot_address(), config.get_mail_bot_password(), "INBOX")
+        self.mbox = mbox
+
+    def logout(self) -> None:
+        if self.mbox is not None:
+            self.mbox.logout()
+            self.mbox = None
+
+    def wait(self) -> bool:
+        "Wait in IDLE for new emails. Returns whether the server reported any changes."
+        assert self.mbox is not None
+        with metrics.email_stage_seconds.time("idle_wait"):
+            responses = self.mbox.idle.wait(timeout=IDLE_WAIT_SECONDS)
+        return bool(responses)
+
+    def process_email(self, msg: MailMessage) -> None:
         """
         Parse an email, pull out the invoice number and eta, record the current time to storage,
         respond to slack with the eta
@@ -74,94 +147,130 @@ def wait_for_reimbursement_processed_email(table: PersistentTable) -> None:
         # Check subject line for test string
         if SUBJECT_FILTER_TEXT not in str(msg.subject):
             logger.warning(f"Unhandled email: {msg.from_} | {msg.subject}")
+            metrics.confirmations_total.inc("ignored")
             return
 
         logger.info("New processed reimbursement email")
 
         # This is an email saying that a reimbursement is scheduled
-        soup = BeautifulSoup(str(msg.html), "html.parser")
-        text = soup.get_text()
-        # This removes all the extra newlines and spaces
-        text = re.sub(REGEX_SUB_FOR_NL, r"\n", text)
-        text_split = text.split("\n")
-
-        # try to get the invoice number and eta text.
         try:
-            invoice_num_idx = text_split.index(INVOICE_NUMBER_KEY) + 1
-            eta_idx = text_split.index(ETA_KEY) + 1
-        except ValueError:
+            with metrics.email_stage_seconds.time("parse"):
+                confirmation = parse_confirmation(str(msg.html))
+        except ConfirmationFormatError as e:
             # Email format changed!
-            logger.error("Email format change! Could not find invoice or eta!")
-            logger.error(text)
+            logger.error(f"Email format change! {e}")
+            logger.error(msg.html)
+            metrics.confirmations_total.inc("format_error")
             return
-        invoice_num_s = text_split[invoice_num_idx]
-        eta = text_split[eta_idx]
-
-        # Convert the value to their types
-        try:
-            invoice_num = int(invoice_num_s)
-            # eta_datetime = datetime.strptime(eta, ETA_DT_FMT)
-        except ValueError:
-            # Couldn't convert!
-            logger.error("Email format change! Could not parse invoice number!")
-            logger.error(text)
+        invoice_num = confirmation.invoice_number
+        invoice_num_s = str(invoice_num)
+        eta = confirmation.eta_text
+
+        # find the channel whose range holds the invoice
+        for channel_id, table in self.tables.items():
+            if channel_id in self.invoices and invoice_num not in self.invoices[channel_id]:
+                continue
+            if table.get_by("invoice", invoice_num) is not None:
+                break
+        else:
+            # Invoice number not reported in slack?
+            logger.error(f"Invoice number not reported in slack! {invoice_num_s}")
+            metrics.confirmations_total.inc("unknown_invoice")
             return
 
         # Get table and add eta
-        with table.get_lock():
-            # find invoice row in table
-            row = None
-            for r in table:
-                if r["invoice"] == invoice_num:
-                    row = r
-
+        with metrics.email_stage_seconds.time("table_update"), table.get_lock():
+            row = table.get_by("invoice", invoice_num)
             if row is None:
-                # Invoice number not reported in slack?
                 logger.error(f"Invoice number not reported in slack! {invoice_num_s}")
+                metrics.confirmations_total.inc("unknown_invoice")
                 return
-            row["date_payment_sent"] = datetime.now()
-            # sync because the table does not know the row changed
-            # TODO: make change aware dictionary for table rows
-            table.sync()
+            table.update(invoice_num, date_payment_sent=datetime.now())
 
         # Respond to slack with eta
         slack_ts = row["slack_ts"]
-        client = WebClient(token=config.get_slack_bot_token())
         msg_text = (
             "Your reimbursement has been processed. " f"It should arrive in your account on {eta}."
         )
-        client.chat_postMessage(
-            channel=REIMBURSEMENT_CHANNEL,
+        # Queued so a batch of confirmations does not run into slack's rate limit
+        future = get_slack_poster().post_message(
+            channel_id,
+            msg_text,
             thread_ts=slack_ts,
-            text=msg_text,
             username=BOT_DISPLAY_NAME,
             icon_emoji=BOT_ICON,
         )
+        posted_at = time.perf_counter()
+        future.add_done_callback(
+            lambda _: metrics.email_stage_seconds.observe(
+                time.perf_counter() - posted_at, "slack_post"
+            )
+        )
+        metrics.confirmations_total.inc("ok")
 
         logger.info(f"Processed reimbursement #{invoice_num} to be received by {eta}")
 
-    def do_idle() -> None:
+    def catch_up(self) -> None:
         """
-        Wait for emails and process them as they come
+        Process emails that arrived after the checkpoint. Needs a connection.
         """
+        assert self.mbox is not None
+        mbox = self.mbox
+        status = mbox.folder.status("INBOX", ["UIDVALIDITY", "UIDNEXT"])
+        uidvalidity = int(status["UIDVALIDITY"])
+        checkpoint = ImapCheckpoint.load(self.checkpoint_path)
+
+        # Every email below this existed before the search, so the search covers them all
+        searched_up_to = int(status["UIDNEXT"]) - 1
+
+        # Let the server filter by subject and sender
+        filters = dict(subject=SUBJECT_FILTER_TEXT)
+        sender = config.get_confirmation_sender()
+        if sender:
+            filters["from_"] = sender
+
+        if checkpoint is None or checkpoint.uidvalidity != uidvalidity:
+            # No usable checkpoint, fall back to unseen emails once
+            if checkpoint is not None:
+                logger.warning("Inbox UIDVALIDITY changed, checking unseen emails")
+            checkpoint = ImapCheckpoint(uidvalidity, searched_up_to)
+            criteria = A(seen=False, **filters)
+            min_uid = 0
+        else:
+            criteria = A(uid=U(checkpoint.last_uid + 1, "*"), **filters)
+            min_uid = checkpoint.last_uid + 1
+
+        # Fetch headers first and only download bodies of confirmation emails.
+        # "n:*" always matches the newest email, even if it is older than n.
+        with metrics.email_stage_seconds.time("fetch"):
+            headers = mbox.fetch(criteria, headers_only=True, mark_seen=False, bulk=True)
+            uids = [
+                h.uid
+                for h in headers
+                if int(h.uid) >= min_uid and SUBJECT_FILTER_TEXT in str(h.subject)
+            ]
+            msgs = mbox.fetch(A(uid=uids), mark_seen=True, bulk=True) if uids else []
+
+        for msg in sorted(msgs, key=lambda m: int(m.uid)):
+            self.process_email(msg)
+            checkpoint.last_uid = max(checkpoint.last_uid, int(msg.uid))
+            checkpoint.save(self.checkpoint_path)
+        # Skip over the emails the search filtered out
+        checkpoint.last_uid = max(checkpoint.last_uid, searched_up_to)
+        checkpoint.save(self.checkpoint_path)
 
-        # # Fetch new messages
-        # print('polling for emails...')
-        # for msg in mbox.fetch(A(seen=False), mark_seen=True):
-        #     process_email(msg)
-        # # Wait to poll again
-        # if stop_event is None:
-        #     time.sleep(IMAP_POLL_PERIOD)
-        # else:
-        #     stop_event.wait(IMAP_POLL_PERIOD)
-        #     if stop_event.is_set():
-        #         raise KeyboardInterrupt
-
-        responses = mbox.idle.wait(timeout=IDLE_WAIT_SECONDS)
-        # print(time.asctime(), "IDLE responses:", responses)
-        if responses:
-            for msg in mbox.fetch(A(seen=False), mark_seen=True):
-                process_email(msg)
+
+# https://github.com/ikvk/imap_tools/blob/master/examples/idle.py
+def wait_for_reimbursement_processed_email(
+    tables: Mapping[str, Table],
+    invoices: Mapping[str, range] | None = None,
+    checkpoint_path: str = str(CHECKPOINT_PATH),
+) -> None:
+    """
+    Wait for emails from melio that payments were processed and respond to the slack messages
+    with the ETA. See ConfirmationWatcher.
+    """
+    watcher = ConfirmationWatcher(tables, invoices, checkpoint_path)
 
     logger.info("Watching for emails.")
     # Continue until exited
@@ -171,29 +280,23 @@ def wait_for_reimbursement_processed_email(table: PersistentTable) -> None:
 
         # login and wait for mail. Will fail on connection issue or interrupt
         try:
-            mbox = MailBox("imap.gmail.com")  # type: ignore
-            mbox.login(config.get_mail_bot_address(), config.get_mail_bot_password(), "INBOX")
+            watcher.connect()
+            # Process anything that arrived while disconnected
+            watcher.catch_up()
             # log out every so often to renew the account
             while (time.monotonic() - start_time) < RENEW_ACCOUNT_SECONDS:
                 try:
-                    do_idle()
+                    if watcher.wait():
+                        watcher.catch_up()
                 except KeyboardInterrupt:
                     # Catch this here so we can logout
                     logger.info("Exiting...")
                     done = True
                     break
-            mbox.logout()
-
-        except (
-            TimeoutError,
-            ConnectionError,
-            imaplib.IMAP4.abort,
-            MailboxLoginError,
-            MailboxLogoutError,
-            socket.herror,
-            socket.gaierror,
-            socket.timeout,
-        ) as e:
+            watcher.logout()
+
+        except IMAP_CONNECTION_ERRORS as e:
+            metrics.imap_reconnects_total.inc()
             logger.error(f"Error\n{e}\n{traceback.format_exc()}\nreconnect in a minute...")
             time.sleep(60)
 
@@ -245,10 +348,13 @@ def test() -> None:
         f.write(csv_text)
 
     table = PersistentTable(
-        str(csv_path), fieldnames=list(converters.keys()), converters=converters
+        str(csv_path),
+        fieldnames=list(converters.keys()),
+        converters=converters,
+        unique_indexes=["invoice"],
     )
 
-    wait_for_reimbursement_processed_email(table)
+    wait_for_reimbursement_processed_email({config.DEFAULT_REIMBURSEMENT_CHANNEL: table})
 
     with open(csv_path, "r") as f:
         print(str(f.read()))
@@ -0,0 +1,67 @@
+"""Serves slack events and the metrics on one port"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+from urllib.parse import urlparse
+
+from slack_bolt import App, BoltRequest
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SLACK_EVENTS_PATH = "/slack/events"
+METRICS_PATH = "/metrics"
+
+
+def make_handler(app: App) -> type[BaseHTTPRequestHandler]:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if urlparse(self.path).path != METRICS_PATH:
+                self._send(404, "text/plain", b"Not found")
+                return
+            self._send(200, metrics.CONTENT_TYPE, metrics.registry.render().encode())
+
+        def do_POST(self) -> None:
+            url = urlparse(self.path)
+            if url.path != SLACK_EVENTS_PATH:
+                self._send(404, "text/plain", b"Not found")
+                return
+            length = int(self.headers.get("Content-Length", 0))
+            request = BoltRequest(
+                body=self.rfile.read(length).decode("utf-8"),
+                query=url.query,
+                headers={k.lower(): v for k, v in self.headers.items()},
+            )
+            response = app.dispatch(request)
+
+            self.send_response(response.status)
+            for name, values in response.headers.items():
+                for value in values:
+                    self.send_header(name, value)
+            body = response.body.encode("utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send(self, status: int, content_type: str, body: bytes) -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: object) -> None:
+            logger.debug(format % args)
+
+    return Handler
+
+
+def serve(app: App, port: int = 3000) -> None:
+    """
+    Serve slack events at SLACK_EVENTS_PATH, like App.start does, and the metrics at
+    METRICS_PATH. Each request is handled on its own thread.
+    """
+    server = ThreadingHTTPServer(("0.0.0.0", port), make_handler(app))
+    logger.info(f"Listening for slack events and metrics on port {port}")
+    server.serve_forever()
@@ -0,0 +1,275 @@
+"""Persistent job queue drained by a pool of worker threads"""
+
+import heapq
+import json
+import logging
+import os
+import time
+import uuid
+from dataclasses import dataclass, field
+from threading import Condition, Thread
+from typing import Any, Callable
+
+from storage import write_atomic
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait before the first retry. Doubles for each failed attempt.
+RETRY_DELAY_SECONDS = 10.0
+MAX_RETRY_DELAY_SECONDS = 15 * 60
+
+
+class QueueFull(Exception):
+    "Raised when a job cannot be enqueued because the queue is at its size limit"
+
+
+@dataclass(order=True)
+class Job:
+    # Jobs are ordered by when they can next run, then by when they were enqueued
+    not_before: float
+    id: str
+    payload: dict[str, Any] = field(compare=False)
+    attempts: int = field(default=0, compare=False)
+
+    def to_json(self) -> str:
+        return json.dumps(
+            dict(
+                id=self.id,
+                payload=self.payload,
+                attempts=self.attempts,
+                not_before=self.not_before,
+            )
+        )
+
+    @classmethod
+    def from_json(cls, text: str) -> "Job":
+        d = json.loads(text)
+        return cls(
+            not_before=d["not_before"], id=d["id"], payload=d["payload"], attempts=d["attempts"]
+        )
+
+
+class JobQueue:
+    """
+    Queue of jobs stored as json files so they survive a restart. A job is a file in
+    directory/pending until a worker claims it, then it moves to directory/running. Finished
+    jobs are deleted, failed jobs are retried with exponential backoff and moved to
+    directory/failed after max_attempts. Jobs left in running by a crash are moved back to
+    pending on startup.
+
+    The handler is called with the job payload by one of the worker threads. Job files are
+    written and moved without holding the queue's condition, so an fsync does not hold up
+    the other workers.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        handler: Callable[[dict[str, Any]], None],
+        workers: int = 2,
+        max_size: int = 100,
+        max_attempts: int = 5,
+        retry_delay: float = RETRY_DELAY_SECONDS,
+    ):
+        self.directory = directory
+        self.handler = handler
+        self.workers = workers
+        self.max_size = max_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+        self.pending_dir = os.path.join(directory, "pending")
+        self.running_dir = os.path.join(directory, "running")
+        self.failed_dir = os.path.join(directory, "failed")
+        for d in (self.pending_dir, self.running_dir, self.failed_dir):
+            os.makedirs(d, exist_ok=True)
+
+        self._cond = Condition()
+        self._ready: list[Job] = list()  # heap ordered by not_before
+        self._running = 0
+        # Jobs that have room in the queue and whose files are being written
+        self._enqueuing = 0
+        self._stopping = False
+        self._threads: list[Thread] = list()
+
+        self._recover()
+
+    def _path(self, directory: str, job: Job) -> str:
+        return os.path.join(directory, job.id + ".json")
+
+    def _recover(self) -> None:
+        "Load pending jobs and move jobs that were running when the process stopped to pending"
+        for name in sorted(os.listdir(self.running_dir)):
+            if name.endswith(".json"):
+                os.replace(
+                    os.path.join(self.running_dir, name), os.path.join(self.pending_dir, name)
+                )
+                logger.warning(f"Recovered interrupted job {name}")
+
+        for name in sorted(os.listdir(self.pending_dir)):
+            if not name.endswith(".json"):
+                continue
+            with open(os.path.join(self.pending_dir, name), "r") as f:
+                self._ready.append(Job.from_json(f.read()))
+        heapq.heapify(self._ready)
+        if self._ready:
+            logger.info(f"Loaded {len(self._ready)} pending jobs from {self.directory}")
+
+    def __len__(self) -> int:
+        "Number of jobs waiting or running"
+        with self._cond:
+            return len(self._ready) + self._running + self._enqueuing
+
+    def enqueue(self, payload: dict[str, Any], timeout: float | None = None) -> str:
+        """
+        Add a job and return its id. If the queue is full, wait up to timeout seconds for room
+        and raise QueueFull if there still is none.
+        """
+
+        def has_room() -> bool:
+            return len(self._ready) + self._running + self._enqueuing < self.max_size
+
+        with self._cond:
+            if not self._cond.wait_for(has_room, timeout):
+                raise QueueFull(f"Job queue {self.directory} has {self.max_size} jobs")
+            self._enqueuing += 1
+
+        # ids sort in the order jobs were enqueued
+        job_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        job = Job(not_before=time.time(), id=job_id, payload=payload)
+        try:
+            write_atomic(self._path(self.pending_dir, job), job.to_json())
+        except BaseException:
+            with self._cond:
+                self._enqueuing -= 1
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            self._enqueuing -= 1
+            heapq.heappush(self._ready, job)
+            self._cond.notify_all()
+        return job.id
+
+    def claim(self, timeout: float | None = None) -> Job | None:
+        "Take the next job that is ready to run, waiting up to timeout seconds for one"
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if self._stopping:
+                    return None
+                now = time.time()
+                if self._ready and self._ready[0].not_before <= now:
+                    job = heapq.heappop(self._ready)
+                    self._running += 1
+                    break
+
+                # Wait for a new job, or for the next retry to come due
+                wait = None if not self._ready else self._ready[0].not_before - now
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._cond.wait(wait)
+
+        try:
+            os.replace(self._path(self.pending_dir, job), self._path(self.running_dir, job))
+        except BaseException:
+            with self._cond:
+                self._running -= 1
+                heapq.heappush(self._ready, job)
+                self._cond.notify_all()
+            raise
+        return job
+
+    def complete(self, job: Job) -> None:
+        "Remove a job that finished"
+        try:
+            os.remove(self._path(self.running_dir, job))
+        finally:
+            with self._cond:
+                self._running -= 1
+                self._cond.notify_all()
+
+    def fail(self, job: Job) -> None:
+        "Schedule a failed job to be retried, or move it to the failed directory"
+        job.attempts += 1
+        running_path = self._path(self.running_dir, job)
+        # If moving the file fails, the job stays in running and is recovered on restart
+        retry = False
+        try:
+            if job.attempts < self.max_attempts:
+                delay = min(self.retry_delay * 2 ** (job.attempts - 1), MAX_RETRY_DELAY_SECONDS)
+                job.not_before = time.time() + delay
+                write_atomic(running_path, job.to_json())
+                os.replace(running_path, self._path(self.pending_dir, job))
+                retry = True
+                logger.warning(f"Job {job.id} failed, retrying in {delay:.0f} seconds")
+            else:
+                os.replace(running_path, self._path(self.failed_dir, job))
+                logger.error(f"Job {job.id} failed {job.attempts} times, giving up")
+        finally:
+            with self._cond:
+                if retry:
+                    heapq.heappush(self._ready, job)
+                self._running -= 1
+                self._cond.notify_all()
+
+    def run_job(self, job: Job) -> None:
+        "Run the handler for a claimed job and complete or fail it"
+        try:
+            self.handler(job.payload)
+        except Exception:
+            logger.exception(f"Error handling job {job.id}")
+            self.fail(job)
+        else:
+            self.complete(job)
+
+    def _worker(self) -> None:
+        while True:
+            job = self.claim()
+            if job is None:
+                return
+            self.run_job(job)
+
+    def start(self) -> None:
+        "Start the worker threads"
+        for i in range(self.workers):
+            t = Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self) -> None:
+        "Stop the worker threads after their current jobs finish"
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+        self._threads.clear()
+
+    def join(self, timeout: float | None = None) -> bool:
+        "Wait until there are no waiting or running jobs. Returns False on timeout."
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._ready and not self._running and not self._enqueuing, timeout
+            )
+
+
+if __name__ == "__main__":
+    import random
+
+    logging.basicConfig(level=logging.INFO)
+
+    def flaky(payload: dict[str, Any]) -> None:
+        time.sleep(0.1)
+        if random.random() < 0.3:
+            raise RuntimeError("flaky job")
+        print("handled", payload)
+
+    q = JobQueue("/tmp/demo_jobs", flaky, workers=3, max_size=5, retry_delay=0.5)
+    q.start()
+    for n in range(10):
+        q.enqueue(dict(n=n))
+    q.join()
+    q.stop()
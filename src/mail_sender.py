@@ -0,0 +1,267 @@
+"""Sends email over one long lived SMTP connection"""
+
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from email.message import EmailMessage
+import logging
+import queue
+import smtplib
+import time
+from threading import Lock, Thread
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Check the connection with NOOP if it has been idle for this long
+NOOP_AFTER_IDLE_SECONDS = 30
+# Close the connection if it has been idle for this long. Gmail drops idle connections anyway.
+CLOSE_AFTER_IDLE_SECONDS = 5 * 60
+SEND_ATTEMPTS = 2
+# Seconds to wait for the server, so a dead connection raises instead of hanging
+SMTP_TIMEOUT_SECONDS = 60
+
+
+@dataclass
+class _Outgoing:
+    msg: EmailMessage
+    futures: list[Future[None]] = field(default_factory=list)
+    # Messages with the same group are combined into one email when coalescing
+    group: str | None = None
+
+
+class SmtpSender:
+    """
+    Keeps an authenticated SMTP connection open and sends queued messages over it from a
+    background thread. The connection is checked with NOOP after being idle and reopened if
+    the server closed it.
+
+    If coalesce_seconds is set, messages submitted with the same group within that many
+    seconds of each other are sent as one email with all of their attachments.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        username: str | None = None,
+        password: str | None = None,
+        use_ssl: bool = True,
+        coalesce_seconds: float = 0,
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_ssl = use_ssl
+        self.coalesce_seconds = coalesce_seconds
+
+        self._server: smtplib.SMTP | None = None
+        self._last_used = 0.0
+        self._server_lock = Lock()
+        self._queue: queue.Queue[_Outgoing | None] = queue.Queue()
+        self._thread: Thread | None = None
+        self._thread_lock = Lock()
+
+    def __len__(self) -> int:
+        "Number of messages waiting to be sent"
+        return self._queue.qsize()
+
+    def _connect(self) -> smtplib.SMTP:
+        server: smtplib.SMTP
+        if self.use_ssl:
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=SMTP_TIMEOUT_SECONDS)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT_SECONDS)
+        if self.username is not None and self.password is not None:
+            server.login(self.username, self.password)
+        logger.info(f"Connected to SMTP server {self.host}:{self.port}")
+        return server
+
+    def _get_server(self) -> smtplib.SMTP:
+        "Get a working connection, checking an idle one with NOOP. Hold _server_lock."
+        idle = time.monotonic() - self._last_used
+        if self._server is not None and idle > CLOSE_AFTER_IDLE_SECONDS:
+            self._close()
+        elif self._server is not None and idle > NOOP_AFTER_IDLE_SECONDS:
+            try:
+                code, _ = self._server.noop()
+                if code != 250:
+                    self._close()
+            except (smtplib.SMTPException, OSError):
+                # The socket is dead or timed out, so do not wait for a QUIT reply
+                self._drop()
+        if self._server is None:
+            self._server = self._connect()
+        return self._server
+
+    def _close(self) -> None:
+        "Close the connection, ignoring errors from a connection that is already gone"
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._server = None
+
+    def _drop(self) -> None:
+        "Close the socket of a broken connection without talking to the server"
+        if self._server is None:
+            return
+        try:
+            self._server.close()
+        except OSError:
+            pass
+        self._server = None
+
+    def send_now(self, msg: EmailMessage) -> None:
+        "Send a message on the calling thread, reconnecting once if the connection dropped"
+        with self._server_lock:
+            for attempt in range(SEND_ATTEMPTS):
+                try:
+                    self._get_server().send_message(msg)
+                    self._last_used = time.monotonic()
+                    return
+                except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                    self._drop()
+                    if attempt + 1 == SEND_ATTEMPTS:
+                        raise
+                    logger.warning(f"SMTP connection lost, reconnecting: {e}")
+                except OSError:
+                    # A timeout leaves the connection in an unknown state. The message may have
+                    # been sent, so it is not retried.
+                    self._drop()
+                    raise
+
+    def submit(self, msg: EmailMessage, group: str | None = None) -> Future[None]:
+        "Queue a message to send. The future completes when it was sent."
+        self._start()
+        future: Future[None] = Future()
+        self._queue.put(_Outgoing(msg, [future], group))
+        return future
+
+    def send(self, msg: EmailMessage, group: str | None = None) -> None:
+        "Queue a message and wait until it was sent"
+        self.submit(msg, group).result()
+
+    def _start(self) -> None:
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="smtp-sender", daemon=True)
+                self._thread.start()
+
+    def close(self) -> None:
+        "Send the queued messages and close the connection"
+        with self._thread_lock:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+        with self._server_lock:
+            self._close()
+
+    def _deliver(self, item: _Outgoing) -> None:
+        "Send a message and complete its futures"
+        try:
+            self.send_now(item.msg)
+        except Exception as e:
+            for f in item.futures:
+                f.set_exception(e)
+        else:
+            for f in item.futures:
+                f.set_result(None)
+
+    def _run(self) -> None:
+        # Groups being coalesced: group -> when their window closes and their messages so far.
+        # Only these wait, messages without a group or coalescing are sent right away.
+        groups: dict[str, tuple[float, list[_Outgoing]]] = dict()
+        while True:
+            timeout = None
+            if groups:
+                timeout = max(0.0, min(d for d, _ in groups.values()) - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                pass
+            else:
+                if item is None:
+                    # close() was called, send what is left
+                    for _, batch in groups.values():
+                        self._deliver(_merge(batch))
+                    return
+                if self.coalesce_seconds > 0 and item.group is not None:
+                    deadline = time.monotonic() + self.coalesce_seconds
+                    groups.setdefault(item.group, (deadline, list()))[1].append(item)
+                else:
+                    self._deliver(item)
+
+            now = time.monotonic()
+            for group in [g for g, (d, _) in groups.items() if d <= now]:
+                self._deliver(_merge(groups.pop(group)[1]))
+
+
+def _merge(batch: list[_Outgoing]) -> _Outgoing:
+    "Combine messages into one email with the attachments of all of them"
+    if len(batch) == 1:
+        return batch[0]
+    first = batch[0].msg
+    msg = EmailMessage()
+    for header in ("From", "To"):
+        msg[header] = first[header]
+    msg["Subject"] = ", ".join(str(b.msg["Subject"]) for b in batch)
+
+    bodies = list()
+    for b in batch:
+        body = b.msg.get_body(preferencelist=("plain",))
+        if body is not None:
+            bodies.append(body.get_content())
+    msg.set_content("\n\n".join(bodies))
+    for b in batch:
+        for a in b.msg.iter_attachments():
+            msg.add_attachment(
+                a.get_content(),
+                a.get_content_maintype(),
+                a.get_content_subtype(),
+                filename=a.get_filename(),
+            )
+    return _Outgoing(msg, [f for b in batch for f in b.futures], batch[0].group)
+
+
+_sender: SmtpSender | None = None
+_sender_lock = Lock()
+
+
+def get_mail_sender() -> SmtpSender:
+    "Get the shared sender for the bot's gmail account"
+    global _sender
+    with _sender_lock:
+        if _sender is None:
+            _sender = SmtpSender(
+                "smtp.gmail.com",
+                465,
+                config.get_mail_bot_address(),
+                config.get_mail_bot_password(),
+                coalesce_seconds=config.get_mail_coalesce_seconds(),
+            )
+    return _sender
+
+
+if __name__ == "__main__":
+    # Send to a local test server, for example: python -m aiosmtpd -n -l localhost:1025
+    # tests/test_mail_sender.py runs the sender against a server in the test process instead.
+    logging.basicConfig(level=logging.INFO)
+    sender = SmtpSender("localhost", 1025, use_ssl=False, coalesce_seconds=1)
+    futures = list()
+    for n in range(3):
+        m = EmailMessage()
+        m["From"] = "bot@localhost"
+        m["To"] = "melio@localhost"
+        m["Subject"] = f"receipt_{n:05}.jpg"
+        m.set_content(f"Receipt #{n:05}")
+        m.add_attachment(bytes(100), "image", "jpeg", filename=f"receipt_{n:05}.jpg")
+        futures.append(sender.submit(m, group="post-1"))
+    for f in futures:
+        f.result()
+    sender.close()
+    print("sent")
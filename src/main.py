@@ -1,58 +1,255 @@
 #!/bin/env python3
 
+from __future__ import annotations
+
 import config
-from slack_handlers import handle_message, handle_reimbursement_post
-from emailing import emailing_thread
+from startup_profile import StartupProfile
 
-from slack_bolt import App
-from slack_bolt.context.say.say import Say
+import argparse
+import asyncio
+from datetime import timedelta
 import logging
-from pathlib import Path
-from typing import List, Dict
 from threading import Thread
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from slack_bolt import App
+
+# Subsystems are imported where they are first used, so a command only imports what it needs
+# and the configuration is checked before slow imports.
+#
+# The render process pool starts its workers with spawn, and spawned workers import this file
+# as __mp_main__. Importing it must not do anything: no tables, queues, clients or threads at
+# module level, only inside main().
+
+logger = logging.getLogger(__name__)
+
+# Seconds between runs of the receipt archive policies while the bot is running
+ARCHIVE_MAINTENANCE_INTERVAL_SECONDS = 24 * 60 * 60
+# Imported one at a time by --profile-startup. Each step only counts the modules that were not
+# imported by an earlier one.
+PROFILED_MODULES = (
+    "metrics",
+    "storage",
+    "slack_client",
+    "receipt_render",
+    "channels",
+    "slack_handlers",
+    "user_cache",
+    "slack_bolt",
+    "http_server",
+    "emailing",
+)
+
+
+def run_backfill(oldest: str, latest: str | None, channel_name: str | None) -> None:
+    """
+    Queue receipts from posts the bot missed and wait for them to be processed
+    """
+    from backfill import backfill, parse_ts
+    from slack_client import get_slack_client, get_slack_poster
+    from slack_handlers import get_channel_registry, get_receipt_queue
+
+    channel_registry = get_channel_registry()
+    channel = channel_registry.primary
+    if channel_name is not None:
+        matches = [c for c in channel_registry if channel_name in (c.name, c.id)]
+        if not matches:
+            raise ValueError(f"{channel_name} is not a configured reimbursement channel")
+        channel = matches[0]
+
+    receipt_queue = get_receipt_queue()
+    receipt_queue.start()
+    backfill(
+        get_slack_client(), channel, parse_ts(oldest), None if latest is None else parse_ts(latest)
+    )
+    receipt_queue.join()
+    receipt_queue.stop()
+    get_slack_poster().close()
+
+
+def maintain_archives(live: bool, remove_orphans: bool) -> None:
+    """
+    Shard old receipt files and apply the compaction and retention policies of every channel.
+    With live set the bot is running, so receipts are compacted in a small pool of their own
+    and the render pool is left to new receipts.
+    """
+    from receipt_archive import ARCHIVE_PROCESSES, create_archive_executor
+    from receipt_render import get_render_executor
+    from slack_handlers import get_channel_registry
+
+    compact_after = config.get_compact_after_days()
+    keep_for = config.get_retention_days()
+    if config.get_render_processes() == 0:
+        executor, batch_size = None, 1
+    elif live:
+        executor, batch_size = create_archive_executor(), ARCHIVE_PROCESSES
+    else:
+        executor, batch_size = get_render_executor(), config.get_render_processes()
+    try:
+        for channel in get_channel_registry():
+            # One channel failing does not hold up the others
+            try:
+                channel.archive.maintain(
+                    channel.table,
+                    compact_after=None if compact_after is None else timedelta(days=compact_after),
+                    keep_for=None if keep_for is None else timedelta(days=keep_for),
+                    executor=executor,
+                    batch_size=batch_size,
+                    remove_orphans=remove_orphans,
+                )
+            except Exception:
+                logger.exception(f"Receipt archive maintenance of {channel.name} failed")
+    finally:
+        if live and executor is not None:
+            executor.shutdown()
+
+
+def archive_maintenance_thread() -> None:
+    # Files left by an interrupted compaction are only looked for once, listing every shard
+    # every day would cost as much as the archive is big
+    remove_orphans = True
+    while True:
+        try:
+            maintain_archives(live=True, remove_orphans=remove_orphans)
+            remove_orphans = False
+        except Exception:
+            logger.exception("Receipt archive maintenance failed")
+        time.sleep(ARCHIVE_MAINTENANCE_INTERVAL_SECONDS)
+
+
+def run_emailing() -> None:
+    "Listen for payment confirmations. imap_tools is imported on this thread, not at startup."
+    from emailing import emailing_thread
+
+    emailing_thread()
+
+
+def create_app() -> App:
+    "The slack app with the message and user change listeners"
+    from slack_bolt import App
+
+    from slack_client import get_slack_client
+    from slack_handlers import handle_message
+    from user_cache import user_cache
+
+    app = App(client=get_slack_client(), signing_secret=config.get_slack_signing_secret())
+    app.event({"type": "message"})(handle_message)
+    app.event("user_change")(user_cache.handle_user_change)
+    return app
 
 
+def profile_startup(profile: StartupProfile, asyncio_mode: bool) -> None:
+    "Open what the bot opens lazily and create the app, timing each step, and print the times"
+    from slack_handlers import get_dedup_cache, get_receipt_queue
 
-app = App(token=config.get_slack_bot_token(), signing_secret=config.get_slack_signing_secret())
+    with profile.step("open dedup cache"):
+        get_dedup_cache()
+    with profile.step("load receipt queue"):
+        get_receipt_queue()
+    if asyncio_mode:
+        profile.import_module("async_runtime")
+    else:
+        with profile.step("create slack app"):
+            create_app()
+    print(profile.report())
 
-logging.basicConfig(level=logging.INFO)
 
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Reimbursement slack bot")
+    parser.add_argument(
+        "--backfill",
+        metavar="OLDEST",
+        help="process receipts posted since OLDEST (slack ts or ISO date) and exit, with the bot"
+        " stopped",
+    )
+    parser.add_argument("--until", metavar="LATEST", help="end of the backfill, default now")
+    parser.add_argument("--channel", help="reimbursement channel to backfill, default the first")
+    parser.add_argument(
+        "--asyncio", action="store_true", help="run slack, receipts and email on one event loop"
+    )
+    parser.add_argument(
+        "--maintain-archive",
+        action="store_true",
+        help="shard, compact and expire archived receipts and exit, with the bot stopped",
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="print the time each import and initialization step of startup takes and exit",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    profile = StartupProfile()
+    if args.profile_startup:
+        for module in PROFILED_MODULES:
+            profile.import_module(module)
 
-def handle_by_ts(ts: str) -> None:
-    print("finding message with ts: " + ts)
-    client = app.client
-    result = client.conversations_history(channel="C9NG0FSG4", limit=10)
-    msgs: List[Dict[str,str]] = result.get("messages", [])
-    msg = None
-    for m in msgs:
-        if m["ts"] == ts:
-            msg = m
-            break
+    # Check environment variables
+    with profile.step("check environment"):
+        config.check_env_vars()
+
+    from channels import DATA_DIR
+    from slack_client import get_slack_client
+    from slack_handlers import get_channel_registry, get_receipt_queue, register_gauges
+    from storage import lock_directory
+
+    # Held until the process exits. The bot, --backfill, --maintain-archive and
+    # --profile-startup all open the tables, job queue and sequences in data/, so only one of
+    # them may run at a time.
+    with profile.step("lock data directory"):
+        data_lock = lock_directory(str(DATA_DIR))  # noqa: F841
+
+    with profile.step("open channel tables"):
+        channel_registry = get_channel_registry()
+
+    # Find the ids of the reimbursement channels. Profiling leaves out this slack api call, it
+    # times the network rather than startup.
+    if not args.profile_startup:
+        channel_registry.resolve(get_slack_client())
+    register_gauges()
+
+    if args.profile_startup:
+        profile_startup(profile, args.asyncio)
+        return
 
-    if msg is None:
-        print("ts not found")
+    if args.backfill is not None:
+        run_backfill(args.backfill, args.until, args.channel)
         return
 
-    print("found message from user: " + msg["user"])
-    handle_reimbursement_post(msg, Say(client=client, channel="C9NG0FSG4"), client, msg)
+    if args.maintain_archive:
+        maintain_archives(live=False, remove_orphans=True)
+        return
 
+    # keep the receipt archive within its policies
+    Thread(target=archive_maintenance_thread, daemon=True).start()
 
-def main() -> None:
-    # Create data directory if needed
-    (Path(__file__).parent / ("../data/receipts/")).resolve().mkdir(parents=True, exist_ok=True)
+    if args.asyncio:
+        from async_runtime import run
 
-    # Check environment variables
-    config.check_env_vars()
+        asyncio.run(run(port=3000))
+        return
+
+    from http_server import serve
+    from user_cache import user_cache
+
+    app = create_app()
 
     # listen for emails
-    t = Thread(target=emailing_thread, daemon=True)
+    t = Thread(target=run_emailing, daemon=True)
     t.start()
 
-    # add slack listener
-    app.event({"type": "message"})(handle_message)
-    app.start(port=3000)
+    # process queued receipts, including any left over from the last run
+    get_receipt_queue().start()
+
+    # cache user names so receipts do not wait on users_info
+    Thread(target=user_cache.warm, args=(app.client,), daemon=True).start()
+
+    # slack events and /metrics on the same port
+    serve(app, port=3000)
 
 
 if __name__ == "__main__":
-    # handle_by_ts("1693522991.907009")
     main()
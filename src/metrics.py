@@ -0,0 +1,228 @@
+"""
+Counters, gauges and histograms for the receipt and email pipelines, rendered in the
+Prometheus text format. Recording a value takes a lock and a few additions, so it can be
+done on every request.
+"""
+
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+import math
+import time
+from threading import Lock
+from typing import Callable, Iterator
+
+# Seconds, from a table lookup to an IDLE wait
+DEFAULT_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0
+)
+
+
+def _format_labels(labelnames: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric(ABC):
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._lock = Lock()
+
+    def _check_labels(self, values: tuple[str, ...]) -> None:
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} has labels {self.labelnames}, got {values}")
+
+    @abstractmethod
+    def samples(self) -> Iterator[str]:
+        "The sample lines of the metric in the text format"
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines) + "\n"
+
+
+class Counter(_Metric):
+    "A value that only goes up"
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple[str, ...], float] = dict() if labelnames else {(): 0.0}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._check_labels(labels)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    "A value read when the metrics are rendered, from a function for each set of labels"
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self._functions: dict[tuple[str, ...], Callable[[], float]] = dict()
+
+    def set_function(self, function: Callable[[], float], *labels: str) -> None:
+        self._check_labels(labels)
+        with self._lock:
+            self._functions[labels] = function
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            functions = sorted(self._functions.items())
+        for labels, function in functions:
+            value = function()
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    "Counts of observed values in buckets, with their sum"
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> (count in each bucket and +Inf, sum)
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = dict()
+
+    def observe(self, value: float, *labels: str) -> None:
+        self._check_labels(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][i] += 1
+            entry[1][0] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        "Observe the seconds the block took"
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def count(self, *labels: str) -> int:
+        entry = self._values.get(labels)
+        return 0 if entry is None else sum(entry[0])
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted((k, (list(c), s[0])) for k, (c, s) in self._values.items())
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                le = _format_labels(self.labelnames, labels, f'le="{_format_value(bound)}"')
+                yield f"{self.name}_bucket{le} {cumulative}"
+            suffix = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{suffix} {_format_value(total)}"
+            yield f"{self.name}_count{suffix} {cumulative}"
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: list[_Metric] = list()
+
+    def register(self, metric: _Metric) -> None:
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        return "".join(m.render() for m in self.metrics)
+
+
+registry = Registry()
+
+
+def counter(name: str, help: str, labelnames: tuple[str, ...] = ()) -> Counter:
+    c = Counter(name, help, labelnames)
+    registry.register(c)
+    return c
+
+
+def gauge(name: str, help: str, labelnames: tuple[str, ...] = ()) -> Gauge:
+    g = Gauge(name, help, labelnames)
+    registry.register(g)
+    return g
+
+
+def histogram(
+    name: str,
+    help: str,
+    labelnames: tuple[str, ...] = (),
+    buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+) -> Histogram:
+    h = Histogram(name, help, labelnames, buckets)
+    registry.register(h)
+    return h
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+receipt_stage_seconds = histogram(
+    "receipt_stage_seconds", "Seconds spent in each stage of processing a receipt", ("stage",)
+)
+receipts_total = counter("receipts_total", "Receipts processed by result", ("result",))
+email_stage_seconds = histogram(
+    "email_stage_seconds",
+    "Seconds spent in each stage of handling payment confirmation emails",
+    ("stage",),
+)
+confirmations_total = counter(
+    "confirmations_total", "Payment confirmation emails handled by result", ("result",)
+)
+duplicates_total = counter(
+    "duplicates_total", "Slack event deliveries and files dropped as duplicates", ("kind",)
+)
+imap_reconnects_total = counter("imap_reconnects_total", "IMAP connections lost and reopened")
+queue_depth = gauge("queue_depth", "Items waiting or in progress in each queue", ("queue",))
+table_rows = gauge("table_rows", "Rows in each receipt table", ("channel",))
+archive_bytes = gauge("archive_bytes", "Bytes of receipt files kept on disk", ("channel",))
+
+
+if __name__ == "__main__":
+    import random
+
+    for _ in range(1000):
+        receipt_stage_seconds.observe(random.expovariate(2), "render")
+    receipts_total.inc("ok")
+    queue_depth.set_function(lambda: 3, "receipts")
+    print(registry.render())
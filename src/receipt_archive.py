@@ -0,0 +1,379 @@
+"""
+Archive of rendered receipts on disk. Receipts are kept in shards of ARCHIVE_SHARD_SIZE, as
+receipts/<shard>/receipt_<number>.jpg, so no directory holds more than a thousand receipts
+however many there are, and a manifest table records where each receipt is and how it is
+stored. Paid receipts can be re-encoded smaller with a thumbnail and deleted after a while.
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import datetime, timedelta
+from enum import StrEnum
+from io import BytesIO
+import logging
+import multiprocessing
+import os
+from pathlib import Path
+import re
+from threading import Lock
+from typing import TYPE_CHECKING, Iterator
+
+import config
+from storage import Row, Table, open_table
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_SHARD_SIZE = 1000
+MANIFEST_FILE = "manifest.csv"
+THUMBNAIL_DIR = "thumbnails"
+# Paid receipts are re-encoded to this width. The header is still legible at it.
+COMPACT_WIDTH = 1200
+COMPACT_QUALITY = 60
+# About a third smaller than a JPEG of the same quality. Pillow's wheels include libwebp.
+COMPACT_FORMAT = "WEBP"
+COMPACT_SUFFIX = ".webp"
+THUMBNAIL_WIDTH = 256
+# Receipts re-encoded at a time. Only this many are waiting in the executor or held in memory.
+COMPACT_BATCH_SIZE = 4
+# Processes re-encoding receipts while the bot runs, apart from the render pool so live
+# receipts do not wait behind a compaction
+ARCHIVE_PROCESSES = 1
+THUMBNAIL_QUALITY = 70
+# Receipts saved before the archive was sharded, directly in the receipts directory
+FLAT_FILE_PATTERN = re.compile(r"^receipt_(\d+)\.jpg$")
+SHARD_PATTERN = re.compile(r"^\d{3,}$")
+
+
+class Tier(StrEnum):
+    # As rendered and emailed
+    FULL = "full"
+    # Re-encoded with COMPACT_FORMAT at COMPACT_WIDTH, with a thumbnail
+    COMPACT = "compact"
+    # Deleted by the retention policy. The manifest row is kept as a record.
+    EXPIRED = "expired"
+
+
+converters = dict(
+    invoice=int,
+    # Relative to the archive root, empty once expired
+    path=None,
+    thumbnail=None,
+    tier=Tier,
+    bytes=int,
+    date_archived=datetime.fromisoformat,
+)
+
+
+def receipt_file_name(receipt_number: int) -> str:
+    return f"receipt_{receipt_number:05}.jpg"
+
+
+def shard_name(receipt_number: int) -> str:
+    "Zero padded so shards list in order"
+    return f"{receipt_number // ARCHIVE_SHARD_SIZE:03}"
+
+
+def write_file_atomic(path: Path, data: bytes) -> None:
+    "Write data next to path and move it over path, so a crash never leaves half a file"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tempname = path.with_name(path.name + ".tmp")
+    tempname.write_bytes(data)
+    os.replace(tempname, path)
+
+
+def _resized(img: Image.Image, width: int) -> Image.Image:
+    from PIL import Image
+
+    if img.width <= width:
+        return img
+    return img.resize((width, round(img.height * width / img.width)), Image.Resampling.LANCZOS)
+
+
+def create_archive_executor() -> Executor:
+    "A small process pool for compacting receipts while the bot runs. Shut it down after use."
+    # spawn for the same reason as the render pool
+    return ProcessPoolExecutor(
+        max_workers=ARCHIVE_PROCESSES, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def compact_file(filename: str) -> tuple[bytes, bytes]:
+    """
+    Re-encode a rendered receipt for the compact tier. Returns the compact image and a JPEG
+    thumbnail. Takes and returns plain data so it can run in the render process pool.
+    """
+    from PIL import Image
+
+    with Image.open(filename) as img:
+        # Lets the JPEG decoder skip detail that would be scaled away
+        img.draft("RGB", (COMPACT_WIDTH, round(img.height * COMPACT_WIDTH / img.width)))
+        compact = _resized(img.convert("RGB"), COMPACT_WIDTH)
+    thumbnail = _resized(compact, THUMBNAIL_WIDTH)
+
+    compact_data = BytesIO()
+    compact.save(compact_data, COMPACT_FORMAT, quality=COMPACT_QUALITY, method=4)
+    thumbnail_data = BytesIO()
+    thumbnail.save(thumbnail_data, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+    return compact_data.getvalue(), thumbnail_data.getvalue()
+
+
+class ReceiptArchive:
+    """
+    The rendered receipts of one channel. Saving a receipt writes one file into its shard and
+    adds a manifest row. maintain() moves old flat files into shards and applies the
+    compaction and retention policies to paid receipts.
+    """
+
+    def __init__(self, root: Path, manifest: Table):
+        self.root = root
+        self.manifest = manifest
+        self._bytes = sum(r["bytes"] for r in manifest)
+        self._bytes_lock = Lock()
+
+    @classmethod
+    def open(cls, root: Path) -> "ReceiptArchive":
+        root.mkdir(parents=True, exist_ok=True)
+        manifest = open_table(
+            str(root / MANIFEST_FILE),
+            config.get_storage_backend(),
+            fieldnames=list(converters.keys()),
+            converters=converters,
+            unique_indexes=["invoice"],
+        )
+        return cls(root, manifest)
+
+    def __len__(self) -> int:
+        return len(self.manifest)
+
+    def disk_bytes(self) -> int:
+        "Bytes used by the receipts and thumbnails in the archive"
+        return self._bytes
+
+    def receipt_path(self, receipt_number: int) -> Path:
+        "Where a full size receipt is saved"
+        return self.root / shard_name(receipt_number) / receipt_file_name(receipt_number)
+
+    def find(self, receipt_number: int) -> Path | None:
+        "The file of an archived receipt, or None if it is not archived or expired"
+        row = self.manifest.get_by("invoice", receipt_number)
+        if row is None or not row["path"]:
+            return None
+        return self.root / row["path"]
+
+    def save(self, receipt_number: int, jpeg: bytes) -> Path:
+        "Write a rendered receipt and record it in the manifest"
+        path = self.receipt_path(receipt_number)
+        write_file_atomic(path, jpeg)
+        self._record(receipt_number, path, len(jpeg))
+        return path
+
+    def _record(self, receipt_number: int, path: Path, size: int) -> None:
+        fields = dict(
+            path=str(path.relative_to(self.root)),
+            thumbnail="",
+            tier=Tier.FULL,
+            bytes=size,
+            date_archived=datetime.now(),
+        )
+        with self.manifest.get_lock():
+            row = self.manifest.get_by("invoice", receipt_number)
+            if row is None:
+                self.manifest.append(invoice=receipt_number, **fields)
+                self._add_bytes(size)
+            else:
+                # A retried job saves the receipt again over the same file
+                self._add_bytes(size - row["bytes"])
+                self.manifest.update(receipt_number, **fields)
+
+    def _add_bytes(self, amount: int) -> None:
+        with self._bytes_lock:
+            self._bytes += amount
+
+    def migrate(self) -> int:
+        "Move receipts saved directly in the archive root into their shards"
+        moved = 0
+        with os.scandir(self.root) as entries:
+            flat = [(e.name, e.path) for e in entries if e.is_file()]
+        for name, path in flat:
+            match = FLAT_FILE_PATTERN.match(name)
+            if match is None:
+                continue
+            receipt_number = int(match.group(1))
+            if self.manifest.get_by("invoice", receipt_number) is not None:
+                # Already archived again since, the flat file is the older copy
+                os.remove(path)
+                continue
+            new_path = self.receipt_path(receipt_number)
+            new_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(path, new_path)
+            self._record(receipt_number, new_path, new_path.stat().st_size)
+            moved += 1
+        return moved
+
+    def remove_orphans(self) -> int:
+        """
+        Delete full size receipts left in the shards by a compaction that stopped before
+        deleting them. Lists every shard, so it is only run at startup and from the command line.
+        """
+        removed = 0
+        with os.scandir(self.root) as entries:
+            shards = [e.path for e in entries if e.is_dir() and SHARD_PATTERN.match(e.name)]
+        for shard in shards:
+            with os.scandir(shard) as entries:
+                names = [e.name for e in entries if e.is_file()]
+            for name in names:
+                match = FLAT_FILE_PATTERN.match(name)
+                if match is None:
+                    continue
+                row = self.manifest.get_by("invoice", int(match.group(1)))
+                if row is not None and row["tier"] != Tier.FULL:
+                    os.remove(os.path.join(shard, name))
+                    removed += 1
+        return removed
+
+    def _paid_before(self, receipts: Table, tier: Tier, before: datetime) -> Iterator[Row]:
+        "Manifest rows in tier whose receipt was paid before the given time"
+        for row in list(self.manifest):
+            if row["tier"] != tier:
+                continue
+            receipt = receipts.get_by("invoice", row["invoice"])
+            paid = None if receipt is None else receipt["date_payment_sent"]
+            if paid is not None and paid < before:
+                yield row
+
+    def compact(
+        self,
+        receipts: Table,
+        paid_before: datetime,
+        executor: Executor | None = None,
+        batch_size: int = COMPACT_BATCH_SIZE,
+    ) -> int:
+        """
+        Re-encode full size receipts paid before paid_before into the compact tier. The
+        re-encoding runs in executor if one is given, batch_size receipts at a time. A receipt
+        that fails is logged and left in the full tier. Returns the number of receipts compacted.
+        """
+        rows = list(self._paid_before(receipts, Tier.FULL, paid_before))
+        compacted = 0
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start : start + batch_size]
+            futures = None
+            if executor is not None:
+                futures = [executor.submit(compact_file, str(self.root / r["path"])) for r in batch]
+            for i, row in enumerate(batch):
+                try:
+                    if futures is None:
+                        compact, thumbnail = compact_file(str(self.root / row["path"]))
+                    else:
+                        compact, thumbnail = futures[i].result()
+                except Exception:
+                    logger.exception(f"Could not compact receipt #{row['invoice']:05}")
+                    continue
+                if self._save_compact(row, compact, thumbnail):
+                    compacted += 1
+        return compacted
+
+    def _save_compact(self, row: Row, compact: bytes, thumbnail: bytes) -> bool:
+        "Replace a full size receipt with its compact copy. Returns False if it changed meanwhile."
+        old_path = self.root / row["path"]
+        path = old_path.with_suffix(COMPACT_SUFFIX)
+        thumbnail_path = self.root / THUMBNAIL_DIR / row["path"]
+        write_file_atomic(thumbnail_path, thumbnail)
+        write_file_atomic(path, compact)
+        size = len(compact) + len(thumbnail)
+        with self.manifest.get_lock():
+            current = self.manifest.get_by("invoice", row["invoice"])
+            if current is None or current["tier"] != Tier.FULL:
+                return False
+            self._add_bytes(size - current["bytes"])
+            self.manifest.update(
+                row["invoice"],
+                path=str(path.relative_to(self.root)),
+                thumbnail=str(thumbnail_path.relative_to(self.root)),
+                tier=Tier.COMPACT,
+                bytes=size,
+            )
+        # A crash before this leaves the old file, remove_orphans() deletes it
+        old_path.unlink(missing_ok=True)
+        return True
+
+    def expire(self, receipts: Table, paid_before: datetime) -> int:
+        "Delete the files of receipts paid before paid_before, keeping their manifest rows"
+        expired = 0
+        for tier in (Tier.FULL, Tier.COMPACT):
+            for row in self._paid_before(receipts, tier, paid_before):
+                for name in (row["path"], row["thumbnail"]):
+                    if name:
+                        (self.root / name).unlink(missing_ok=True)
+                with self.manifest.get_lock():
+                    self._add_bytes(-row["bytes"])
+                    self.manifest.update(
+                        row["invoice"], path="", thumbnail="", tier=Tier.EXPIRED, bytes=0
+                    )
+                expired += 1
+        return expired
+
+    def maintain(
+        self,
+        receipts: Table,
+        compact_after: timedelta | None,
+        keep_for: timedelta | None,
+        executor: Executor | None = None,
+        batch_size: int = COMPACT_BATCH_SIZE,
+        remove_orphans: bool = False,
+    ) -> None:
+        """
+        Move flat files into shards, then compact receipts paid more than compact_after ago
+        and delete those paid more than keep_for ago. None turns a policy off. remove_orphans
+        also sweeps the shards for files left by an interrupted compaction.
+        """
+        now = datetime.now()
+        moved = self.migrate()
+        if moved:
+            logger.info(f"Moved {moved} receipts in {self.root} into shards")
+        if remove_orphans:
+            removed = self.remove_orphans()
+            if removed:
+                logger.info(f"Deleted {removed} receipts in {self.root} that were compacted")
+        if keep_for is not None:
+            expired = self.expire(receipts, now - keep_for)
+            if expired:
+                logger.info(f"Deleted {expired} receipts paid over {keep_for.days} days ago")
+        if compact_after is not None:
+            compacted = self.compact(receipts, now - compact_after, executor, batch_size)
+            if compacted:
+                logger.info(
+                    f"Compacted {compacted} receipts paid over {compact_after.days} days ago"
+                )
+
+    def close(self) -> None:
+        self.manifest.close()
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    from PIL import Image
+
+    from storage import PersistentTable
+
+    root = Path(tempfile.mkdtemp())
+    Image.new("RGB", (3000, 4000), "white").save(root / "receipt_00007.jpg")
+    receipts = PersistentTable(
+        str(root / "reimbursements.csv"),
+        ["invoice", "date_payment_sent"],
+        dict(invoice=int, date_payment_sent=datetime.fromisoformat),
+        journaled=True,
+        unique_indexes=["invoice"],
+    )
+    receipts.append(invoice=7, date_payment_sent=datetime.now() - timedelta(days=60))
+    archive = ReceiptArchive.open(root)
+    print("saved", archive.save(123_456, (root / "receipt_00007.jpg").read_bytes()))
+    archive.maintain(receipts, compact_after=timedelta(days=30), keep_for=None)
+    for row in archive.manifest:
+        print(dict(row))
+    print(archive.disk_bytes(), "bytes")
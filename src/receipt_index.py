@@ -0,0 +1,109 @@
+"""
+Index of the pictures of processed receipts, to find receipts that were submitted before.
+Each receipt has the sha256 of its file, for exact copies, and a 64 bit difference hash of the
+picture, for copies that were re-encoded, resized or screenshotted.
+"""
+
+from dataclasses import dataclass
+import hashlib
+from typing import Any
+
+import config
+from storage import Table, open_table
+
+# Pictures whose difference hashes differ in at most this many bits are likely the same
+DHASH_MAX_DISTANCE = 6
+DHASH_BITS = 64
+# The hash is split into bands, each indexed on its own. Two hashes within DHASH_MAX_DISTANCE
+# bits share at least one band exactly when there are more bands than differing bits.
+DHASH_BANDS = DHASH_MAX_DISTANCE + 1
+BAND_FIELDS = [f"band{i}" for i in range(DHASH_BANDS)]
+
+converters: dict[str, Any] = dict(
+    invoice=int,
+    sha256=None,
+    dhash=None,
+    **{f: None for f in BAND_FIELDS},
+)
+
+
+def file_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def bands(dhash: int) -> list[str]:
+    "Split a hash into DHASH_BANDS runs of bits, each tagged with its position"
+    result = list()
+    for i in range(DHASH_BANDS):
+        start = i * DHASH_BITS // DHASH_BANDS
+        stop = (i + 1) * DHASH_BITS // DHASH_BANDS
+        value = (dhash >> start) & ((1 << (stop - start)) - 1)
+        result.append(f"{i}:{value:x}")
+    return result
+
+
+@dataclass
+class ReceiptMatch:
+    invoice: int
+    # Bits that differ between the difference hashes, 0 for the same file
+    distance: int
+
+
+class ReceiptIndex:
+    """
+    Hashes of the receipts of one channel. Lookups use the indexes of the table, so they take
+    the same time however many receipts there are.
+    """
+
+    def __init__(self, table: Table):
+        self.table = table
+
+    @classmethod
+    def open(cls, csv_filename: str) -> "ReceiptIndex":
+        return cls(
+            open_table(
+                csv_filename,
+                config.get_storage_backend(),
+                fieldnames=list(converters.keys()),
+                converters=converters,
+                unique_indexes=["invoice"],
+                indexes=["sha256", *BAND_FIELDS],
+            )
+        )
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def find_exact(self, sha256: str) -> int | None:
+        "The invoice of a receipt with exactly this file, if there is one"
+        row = self.table.get_by("sha256", sha256)
+        return None if row is None else int(row["invoice"])
+
+    def find_similar(
+        self, dhash: int, max_distance: int = DHASH_MAX_DISTANCE
+    ) -> list[ReceiptMatch]:
+        "Receipts whose pictures differ from dhash in at most max_distance bits, closest first"
+        candidates: dict[int, int] = dict()
+        for field, band in zip(BAND_FIELDS, bands(dhash)):
+            for row in self.table.get_all_by(field, band):
+                candidates[int(row["invoice"])] = int(row["dhash"], 16)
+        matches = [
+            ReceiptMatch(invoice, (dhash ^ other).bit_count())
+            for invoice, other in candidates.items()
+        ]
+        return sorted(
+            (m for m in matches if m.distance <= max_distance), key=lambda m: m.distance
+        )
+
+    def add(self, invoice: int, sha256: str, dhash: int) -> None:
+        "Add a receipt, unless one with this invoice was added before"
+        # Check under the lock, so two workers adding the same invoice cannot both append
+        with self.table.get_lock():
+            if self.table.get_by("invoice", invoice) is not None:
+                return
+            self.table.append(
+                invoice=invoice,
+                sha256=sha256,
+                dhash=f"{dhash:016x}",
+                **dict(zip(BAND_FIELDS, bands(dhash))),
+            )
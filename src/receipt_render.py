@@ -0,0 +1,322 @@
+"""
+Rendering of receipt images. Rendering is CPU bound, so it runs in a process pool and only
+takes and returns plain data. Pillow is imported when the first receipt is rendered.
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import date
+from functools import cache, lru_cache
+from io import BytesIO
+import multiprocessing
+from threading import Lock
+import time
+from typing import TYPE_CHECKING
+
+import config
+
+if TYPE_CHECKING:
+    from PIL import Image, ImageDraw, ImageFont
+
+RECEIPT_MOD_MARGIN_HEIGHT = 600
+# Receipts wider than this are scaled down to it. Smaller receipts are never scaled up.
+RECEIPT_RESIZE_WIDTH = 3000
+# The output is at least this wide so the header stays legible on small screenshots
+RECEIPT_MIN_WIDTH = 1200
+# Header sizes for a RECEIPT_RESIZE_WIDTH wide output. They scale with the output width.
+HEADER_FONT_SIZE = 170
+HEADER_PADDING = 20
+HEADER_FONT = "LiberationSans-Regular.ttf"
+# Side of the thumbnail compared for the difference hash
+DHASH_SIZE = 8
+# Pictures with more pixels than this are refused before they are decoded
+MAX_SOURCE_PIXELS = 100_000_000
+# EXIF orientations that swap width and height
+EXIF_ORIENTATION_TAG = 0x0112
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+# Same as the Pillow default
+JPEG_QUALITY = 75
+# Lowest quality the byte budget search will go to. Text gets hard to read below this.
+JPEG_MIN_QUALITY = 40
+# Full chroma keeps colored text and stamps sharp. It is used when it fits the byte budget.
+JPEG_FULL_CHROMA = "4:4:4"
+JPEG_HALF_CHROMA = "4:2:0"
+
+
+class ReceiptTooLarge(ValueError):
+    "Raised when a receipt file or picture is too large to process"
+
+
+@dataclass
+class ReceiptLayout:
+    # Width of the output image
+    width: int
+    # Size of the receipt picture inside it
+    image_width: int
+    image_height: int
+    font_size: int
+    padding: int
+    margin_height: int
+
+
+def choose_layout(source_width: int, source_height: int) -> ReceiptLayout:
+    """
+    Pick the output size for a receipt picture. The picture is scaled down to at most
+    RECEIPT_RESIZE_WIDTH and never up. The output is at least RECEIPT_MIN_WIDTH wide so the
+    header is legible, and the header is scaled to the output width.
+    """
+    image_width = min(source_width, RECEIPT_RESIZE_WIDTH)
+    image_height = max(1, round(source_height * image_width / source_width))
+    width = max(image_width, RECEIPT_MIN_WIDTH)
+    scale = width / RECEIPT_RESIZE_WIDTH
+    return ReceiptLayout(
+        width=width,
+        image_width=image_width,
+        image_height=image_height,
+        font_size=max(1, round(HEADER_FONT_SIZE * scale)),
+        padding=round(HEADER_PADDING * scale),
+        margin_height=round(RECEIPT_MOD_MARGIN_HEIGHT * scale),
+    )
+
+
+@dataclass
+class RenderedReceipt:
+    # Encoded JPEG of the receipt with its header
+    jpeg: bytes
+    # The header text, also used as the email body
+    header_text: str
+    # Seconds spent in each stage of rendering
+    timings: dict[str, float] = field(default_factory=dict)
+    # Difference hash of the receipt picture, see dhash()
+    dhash: int = 0
+
+
+def render_receipt(
+    image_data: bytes,
+    uploader_name: str,
+    receipt_number: int,
+    message: str,
+    date_requested: date,
+    byte_budget: int | None = None,
+) -> RenderedReceipt:
+    """
+    Add a text header to the picture in image_data and encode it as a JPEG, trying to keep it
+    under byte_budget bytes if given
+    """
+
+    from PIL import Image, ImageDraw, ImageOps
+
+    start = time.perf_counter()
+    # Create image object and scale
+    with BytesIO(image_data) as bio:
+        im = Image.open(bio)
+        source_width, source_height = im.size
+        if source_width * source_height > MAX_SOURCE_PIXELS:
+            raise ReceiptTooLarge(f"Picture is {source_width}x{source_height} pixels")
+
+        # Phones store rotation in EXIF rather than rotating the pixels
+        transposed = im.getexif().get(EXIF_ORIENTATION_TAG) in TRANSPOSED_ORIENTATIONS
+        if transposed:
+            layout = choose_layout(source_height, source_width)
+            draft_size = (layout.image_height, layout.image_width)
+        else:
+            layout = choose_layout(source_width, source_height)
+            draft_size = (layout.image_width, layout.image_height)
+        if im.format == "JPEG":
+            # Let the decoder downscale by up to 8x so the full resolution is never in memory
+            im.draft("RGB", draft_size)
+        ImageOps.exif_transpose(im, in_place=True)
+        if im.mode != "RGB":
+            im_rgb = im.convert("RGB")
+            im.close()
+        else:
+            # Read the pixels before bio is closed
+            im.load()
+            im_rgb = im
+        if im_rgb.size != (layout.image_width, layout.image_height):
+            im_scaled = im_rgb.resize((layout.image_width, layout.image_height))
+            im_rgb.close()
+        else:
+            im_scaled = im_rgb
+    width = layout.width
+    picture_hash = dhash(im_scaled)
+    decoded = time.perf_counter()
+
+    # Lay out the header before allocating the output so it is only drawn once
+    font = get_font(layout.font_size)
+    lines = [
+        "Pay to: " + uploader_name,
+        f"Receipt #{receipt_number:05}",
+        f"Date requested: {date_requested}",
+        get_wrapped_text("Message: " + message, font, width - 2 * layout.padding),
+    ]
+    all_text = "\n".join(lines)
+    text_height = measure_text_height(all_text, font, layout.padding)
+    # The header is at least margin_height tall
+    text_height = max(text_height, layout.margin_height)
+
+    # Make new image with the header text and the receipt
+    joined_img = Image.new(
+        im_scaled.mode, (width, layout.image_height + text_height), (255, 255, 255)
+    )
+    ImageDraw.Draw(joined_img).text(
+        xy=(layout.padding, 0), text=all_text, fill=(0, 0, 0), font=font
+    )
+    # Center receipts narrower than the header
+    joined_img.paste(im_scaled, ((width - layout.image_width) // 2, text_height))
+    im_scaled.close()
+    drawn = time.perf_counter()
+
+    jpeg = encode_jpeg(joined_img, byte_budget)
+    joined_img.close()
+    timings = dict(
+        decode=decoded - start, header=drawn - decoded, encode=time.perf_counter() - drawn
+    )
+    return RenderedReceipt(
+        jpeg=jpeg, header_text=all_text, timings=timings, dhash=picture_hash
+    )
+
+
+def dhash(img: Image.Image) -> int:
+    """
+    64 bit difference hash of a picture: whether each pixel of a 9x8 grayscale thumbnail is
+    brighter than its right neighbour. Re-encoding, resizing and small edits change few bits.
+    """
+    from PIL import Image
+
+    small = img.convert("L").resize((DHASH_SIZE + 1, DHASH_SIZE), Image.Resampling.BILINEAR)
+    pixels = list(small.getdata())
+    bits = 0
+    for y in range(DHASH_SIZE):
+        row = pixels[y * (DHASH_SIZE + 1) : (y + 1) * (DHASH_SIZE + 1)]
+        for left, right in zip(row, row[1:]):
+            bits = bits << 1 | (left > right)
+    return bits
+
+
+def _encode(
+    img: Image.Image, quality: int, progressive: bool, subsampling: str = JPEG_HALF_CHROMA
+) -> bytes:
+    with BytesIO() as bio:
+        img.save(
+            bio,
+            format="JPEG",
+            quality=quality,
+            optimize=True,
+            progressive=progressive,
+            subsampling=subsampling,
+        )
+        return bio.getvalue()
+
+
+def encode_jpeg(img: Image.Image, byte_budget: int | None = None) -> bytes:
+    """
+    Encode img as a JPEG with optimized huffman tables. With a byte budget, progressive
+    encoding is used, with full chroma resolution if that fits at the default quality. If the
+    default quality is over budget even with half chroma resolution, the highest quality that
+    fits is searched for. If nothing fits, the smallest allowed quality is returned.
+    """
+    if byte_budget is None:
+        return _encode(img, JPEG_QUALITY, progressive=False)
+
+    for subsampling in (JPEG_FULL_CHROMA, JPEG_HALF_CHROMA):
+        data = _encode(img, JPEG_QUALITY, progressive=True, subsampling=subsampling)
+        if len(data) <= byte_budget:
+            return data
+
+    # Binary search for the highest quality under budget
+    best: bytes | None = None
+    low, high = JPEG_MIN_QUALITY, JPEG_QUALITY - 1
+    while low <= high:
+        quality = (low + high) // 2
+        data = _encode(img, quality, progressive=True)
+        if len(data) <= byte_budget:
+            best = data
+            low = quality + 1
+        else:
+            high = quality - 1
+    # When nothing fits, the last quality tried was the minimum
+    return best if best is not None else data
+
+
+@lru_cache(maxsize=8)
+def get_font(size: int) -> ImageFont.FreeTypeFont:
+    "Load the header font. Sizes only vary with the output width, so few are cached."
+    from PIL import ImageFont
+
+    return ImageFont.truetype(HEADER_FONT, size=size)
+
+
+@cache
+def _measuring_draw() -> ImageDraw.ImageDraw:
+    "Text bounding boxes do not depend on the image, so a 1x1 image is enough to measure"
+    from PIL import Image, ImageDraw
+
+    return ImageDraw.Draw(Image.new("RGB", (1, 1)))
+
+
+def measure_text_height(text: str, font: ImageFont.FreeTypeFont, padding: int) -> int:
+    "Height of the header needed for text drawn at (padding, 0), including bottom padding"
+    return int(_measuring_draw().textbbox(xy=(padding, 0), text=text, font=font)[3]) + padding
+
+
+def get_wrapped_text(text: str, font: ImageFont.FreeTypeFont, line_length: int) -> str:
+    """
+    Wrap text into lines at most line_length pixels long. Each word is measured once and line
+    lengths are summed, so this is linear in the length of the text. A word longer than a line
+    gets a line to itself.
+    """
+    space = font.getlength(" ")
+    lines: list[list[str]] = [[]]
+    length = 0.0
+    for word in text.split():
+        word_length = font.getlength(word)
+        if lines[-1] and length + space + word_length > line_length:
+            lines.append([])
+            length = 0.0
+        if lines[-1]:
+            length += space
+        lines[-1].append(word)
+        length += word_length
+    return "\n".join(" ".join(line) for line in lines)
+
+
+_executor: Executor | None = None
+_executor_lock = Lock()
+
+
+def get_render_executor() -> Executor | None:
+    """
+    Get the process pool for rendering, or None if rendering should happen in the calling
+    thread
+    """
+    global _executor
+    processes = config.get_render_processes()
+    if processes == 0:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            # spawn so the workers do not inherit the threads and sockets of the bot. Workers
+            # import the __main__ module of the bot, so it must not open anything on import.
+            _executor = ProcessPoolExecutor(
+                max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+            )
+    return _executor
+
+
+def render_receipt_in_pool(
+    image_data: bytes,
+    uploader_name: str,
+    receipt_number: int,
+    message: str,
+    date_requested: date,
+    byte_budget: int | None = None,
+) -> RenderedReceipt:
+    "Run render_receipt in the render process pool and wait for the result"
+    args = (image_data, uploader_name, receipt_number, message, date_requested, byte_budget)
+    executor = get_render_executor()
+    if executor is None:
+        return render_receipt(*args)
+    return executor.submit(render_receipt, *args).result()
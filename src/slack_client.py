@@ -0,0 +1,283 @@
+"""
+The shared slack client and a queue for outgoing messages that keeps to slack's rate limits
+"""
+
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+import logging
+import queue
+import time
+from threading import Lock, Thread, local
+from typing import Any
+
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+from slack_sdk.http_retry import HttpRequest, HttpResponse, RetryState
+from slack_sdk.http_retry.builtin_handlers import (
+    ConnectionErrorRetryHandler,
+    RateLimitErrorRetryHandler,
+)
+from slack_sdk.web import SlackResponse
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Retries of rate limited calls made directly on the client. Slack says how long to wait.
+RATE_LIMIT_RETRIES = 3
+CONNECTION_RETRIES = 2
+# Seconds between calls of a method to one channel. chat.postMessage allows about one
+# message a second per channel, other methods are assumed to be tier 3 (50 a minute).
+METHOD_INTERVAL_SECONDS = {"chat_postMessage": 1.0}
+DEFAULT_METHOD_INTERVAL_SECONDS = 60 / 50
+# Times a queued call is retried after slack answered 429
+POST_ATTEMPTS = 5
+
+
+_client: WebClient | None = None
+_client_lock = Lock()
+# Set while SlackPoster makes a call, on its thread
+_poster_call = local()
+
+
+class _RateLimitRetryHandler(RateLimitErrorRetryHandler):
+    """
+    Retries rate limited calls after the Retry-After slack sends, except calls made by
+    SlackPoster. Retrying sleeps, which on the poster thread would hold up every queued call,
+    so SlackPoster pauses only the rate limited method and channel instead.
+    """
+
+    def _can_retry(
+        self,
+        *,
+        state: RetryState,
+        request: HttpRequest,
+        response: HttpResponse | None = None,
+        error: Exception | None = None,
+    ) -> bool:
+        if getattr(_poster_call, "active", False):
+            return False
+        return super()._can_retry(state=state, request=request, response=response, error=error)
+
+
+def get_slack_client() -> WebClient:
+    """
+    Get the slack client shared by the whole bot. Rate limited calls are retried after the
+    Retry-After slack sends, unless SlackPoster made them.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = WebClient(
+                token=config.get_slack_bot_token(),
+                retry_handlers=[
+                    ConnectionErrorRetryHandler(max_retry_count=CONNECTION_RETRIES),
+                    _RateLimitRetryHandler(max_retry_count=RATE_LIMIT_RETRIES),
+                ],
+            )
+    return _client
+
+
+@dataclass
+class _Outgoing:
+    method: str
+    kwargs: dict[str, Any]
+    futures: list[Future[SlackResponse]] = field(default_factory=list)
+    # Messages with the same group are combined into one message when coalescing
+    group: str | None = None
+    # Times slack answered 429
+    attempts: int = 0
+
+    @property
+    def key(self) -> tuple[str, str | None]:
+        "Calls with the same key are spaced and paused together"
+        return (self.method, self.kwargs.get("channel"))
+
+
+def retry_after(e: SlackApiError) -> float | None:
+    "Seconds slack asked to wait if the call was rate limited, otherwise None"
+    if e.response.status_code != 429:
+        return None
+    return float(e.response.headers.get("Retry-After", 1))
+
+
+class SlackPoster:
+    """
+    Makes slack calls from a background thread, spacing calls of each method to each channel
+    by METHOD_INTERVAL_SECONDS. When slack answers 429 the method is paused for that channel
+    for the Retry-After it sent and the call is retried. Calls to other channels go ahead
+    meanwhile, calls with the same method and channel keep their order.
+
+    If coalesce_seconds is set, messages posted to the same thread within that many seconds of
+    each other are sent as one message.
+    """
+
+    def __init__(self, client: WebClient, coalesce_seconds: float = 0):
+        self.client = client
+        self.coalesce_seconds = coalesce_seconds
+
+        # (method, channel) -> monotonic time the next call can be made
+        self._next_call: dict[tuple[str, str | None], float] = dict()
+        self._queue: queue.Queue[_Outgoing | None] = queue.Queue()
+        self._thread: Thread | None = None
+        self._thread_lock = Lock()
+
+    def __len__(self) -> int:
+        "Number of calls waiting to be made"
+        return self._queue.qsize()
+
+    def submit(
+        self, method: str, group: str | None = None, **kwargs: Any
+    ) -> Future[SlackResponse]:
+        "Queue a call of a WebClient method. The future completes with its response."
+        self._start()
+        future: Future[SlackResponse] = Future()
+        self._queue.put(_Outgoing(method, kwargs, [future], group))
+        return future
+
+    def post_message(
+        self, channel: str, text: str, thread_ts: str | None = None, **kwargs: Any
+    ) -> Future[SlackResponse]:
+        "Queue a chat_postMessage. Messages to the same thread can be coalesced."
+        group = None if thread_ts is None else f"{channel}/{thread_ts}"
+        return self.submit(
+            "chat_postMessage",
+            group=group,
+            channel=channel,
+            text=text,
+            thread_ts=thread_ts,
+            **kwargs,
+        )
+
+    def _start(self) -> None:
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="slack-poster", daemon=True)
+                self._thread.start()
+
+    def close(self) -> None:
+        "Send the queued calls and stop the thread"
+        with self._thread_lock:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+
+    def _attempt(self, c: _Outgoing) -> bool:
+        """
+        Make a call once and complete its futures. Returns False if slack rate limited it and
+        it should be made again once its method and channel are no longer paused.
+        """
+        interval = METHOD_INTERVAL_SECONDS.get(c.method, DEFAULT_METHOD_INTERVAL_SECONDS)
+        self._next_call[c.key] = time.monotonic() + interval
+        try:
+            _poster_call.active = True
+            try:
+                response: SlackResponse = getattr(self.client, c.method)(**c.kwargs)
+            finally:
+                _poster_call.active = False
+        except Exception as e:
+            delay = retry_after(e) if isinstance(e, SlackApiError) else None
+            c.attempts += 1
+            if delay is not None and c.attempts < POST_ATTEMPTS:
+                logger.warning(f"Slack rate limited {c.method}, retrying in {delay} seconds")
+                self._next_call[c.key] = time.monotonic() + delay
+                return False
+            logger.error(f"Slack {c.method} to {c.kwargs.get('channel')} failed: {e}")
+            for f in c.futures:
+                f.set_exception(e)
+        else:
+            for f in c.futures:
+                f.set_result(response)
+        return True
+
+    def _ready(self, pending: list[_Outgoing]) -> _Outgoing | None:
+        "The first pending call that can be made now and has no earlier call with its key"
+        now = time.monotonic()
+        seen = set()
+        for c in pending:
+            if c.key not in seen and self._next_call.get(c.key, 0) <= now:
+                return c
+            seen.add(c.key)
+        return None
+
+    def _collect(self, first: _Outgoing) -> tuple[list[_Outgoing], bool]:
+        """
+        Gather messages in the same group as first that arrive within the coalesce window.
+        Returns the calls to make and whether close() was called meanwhile.
+        """
+        batch = [first]
+        others: list[_Outgoing] = list()
+        stopping = False
+        deadline = time.monotonic() + self.coalesce_seconds
+        while not stopping:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                stopping = True
+            elif item.group == first.group and item.method == first.method:
+                batch.append(item)
+            else:
+                others.append(item)
+        return [_merge(batch), *others], stopping
+
+    def _run(self) -> None:
+        # Calls taken off the queue, in the order they were submitted. The thread never sleeps
+        # for one paused call while others could be made.
+        pending: list[_Outgoing] = list()
+        stopping = False
+        while pending or not stopping:
+            c = self._ready(pending)
+            if c is not None:
+                if self._attempt(c):
+                    pending.remove(c)
+                continue
+
+            # Wait for a new call or until the first paused call can be made
+            timeout = None
+            if pending:
+                due = min(self._next_call.get(p.key, 0) for p in pending)
+                timeout = max(0, due - time.monotonic())
+            if stopping:
+                time.sleep(timeout or 0)
+                continue
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            if item is None:
+                stopping = True
+            elif self.coalesce_seconds > 0 and item.group is not None:
+                calls, stopping = self._collect(item)
+                pending.extend(calls)
+            else:
+                pending.append(item)
+
+
+def _merge(batch: list[_Outgoing]) -> _Outgoing:
+    "Combine messages into one with the text of all of them"
+    if len(batch) == 1:
+        return batch[0]
+    kwargs = dict(batch[0].kwargs)
+    kwargs["text"] = "\n".join(str(b.kwargs["text"]) for b in batch)
+    return _Outgoing(batch[0].method, kwargs, [f for b in batch for f in b.futures], batch[0].group)
+
+
+_poster: SlackPoster | None = None
+_poster_lock = Lock()
+
+
+def get_slack_poster() -> SlackPoster:
+    "Get the shared queue for outgoing slack messages"
+    global _poster
+    with _poster_lock:
+        if _poster is None:
+            _poster = SlackPoster(
+                get_slack_client(), coalesce_seconds=config.get_slack_coalesce_seconds()
+            )
+    return _poster
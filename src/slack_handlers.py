@@ -1,47 +1,82 @@
-from typing import Dict, Any
-from slack_bolt.context.say.say import Say
-from slack_sdk import WebClient
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Dict, Any
 import logging
 import json
 from datetime import datetime
 from pathlib import Path
-from storage import PersistentTable
-import requests
-from PIL import Image, ImageDraw, ImageFont
+from threading import Lock
+from channels import DATA_DIR, ChannelRegistry, ReimbursementChannel
+from dedup import DedupCache, event_key, file_key
+from storage import Table
+from job_queue import JobQueue
+from receipt_render import render_receipt_in_pool, ReceiptTooLarge, RenderedReceipt
+from mail_sender import get_mail_sender
+from receipt_archive import ReceiptArchive, receipt_file_name
+from receipt_index import ReceiptIndex, file_hash
+from slack_client import get_slack_client, get_slack_poster
+from user_cache import user_cache
+import metrics
 from io import BytesIO
-import smtplib
 from email.message import EmailMessage
 import config
 
+if TYPE_CHECKING:
+    # Only used in annotations. Importing slack_bolt takes a while.
+    from slack_bolt.context.say.say import Say
+    from slack_sdk import WebClient
+
 
-RECEIPT_MOD_MARGIN_HEIGHT = 600
-RECEIPT_RESIZE_WIDTH = 3000
 BOT_DISPLAY_NAME = "Reimbursement Bot"
 BOT_ICON = ":money_with_wings:"
-REIMBURSEMENT_CHANNEL = "C9NG0FSG4"
+# Seconds handle_message waits for room in a full receipt queue before giving up
+ENQUEUE_TIMEOUT_SECONDS = 1
+# Seconds to wait for slack to accept the connection and then between bytes of the download
+DOWNLOAD_TIMEOUT_SECONDS = (10, 60)
+MAX_DOWNLOAD_BYTES = 50 * 1024 * 1024
+DOWNLOAD_CHUNK_BYTES = 256 * 1024
 
 logger = logging.getLogger(__name__)
 
 
-def convert_date(s: str) -> None | datetime:
-    if s == "":
-        return None
-    else:
-        return datetime.fromisoformat(s)
-
-
-converters = dict(
-    invoice=int,
-    slack_ts=None,
-    date_requested=convert_date,
-    date_payment_sent=convert_date,
-)
-csv_path = (Path(__file__).parent / "../data/reimbursements.csv").resolve()
-# with open(csv_path, 'r') as f:
-#     print(f.read())
-receipt_table = PersistentTable(
-    str(csv_path), fieldnames=list(converters.keys()), converters=converters
-)
+# Opened on first use rather than on import, so importing is fast and the configuration is
+# checked before any table is read
+_channel_registry: ChannelRegistry | None = None
+_dedup_cache: DedupCache | None = None
+_receipt_queue: JobQueue | None = None
+_open_lock = Lock()
+
+
+def get_channel_registry() -> ChannelRegistry:
+    "Get the configured reimbursement channels, opening their tables the first time"
+    global _channel_registry
+    with _open_lock:
+        if _channel_registry is None:
+            _channel_registry = ChannelRegistry.from_config()
+    return _channel_registry
+
+
+def get_dedup_cache() -> DedupCache:
+    "Get the event deliveries and files already handled, so slack's retries are dropped"
+    global _dedup_cache
+    with _open_lock:
+        if _dedup_cache is None:
+            _dedup_cache = DedupCache(str(DATA_DIR / "processed_events.csv"))
+    return _dedup_cache
+
+
+def get_receipt_queue() -> JobQueue:
+    "Get the queue of receipts to process, loading the jobs left from the last run the first time"
+    global _receipt_queue
+    with _open_lock:
+        if _receipt_queue is None:
+            _receipt_queue = JobQueue(
+                str((Path(__file__).parent / "../data/jobs").resolve()),
+                handle_receipt_job,
+                workers=config.get_receipt_workers(),
+                max_size=config.get_receipt_queue_size(),
+            )
+    return _receipt_queue
 
 
 def handle_message(
@@ -50,108 +85,274 @@ def handle_message(
     """
     pass this function to App.event to handle slack messages
     """
-    if is_reimbursement_channel(message):
-        handle_reimbursement_post(message, say, client, body)
-    elif is_im(message):
-        handle_im(message, say)
-    else:
-        print(json.dumps(message, indent=4))
-        logger.info(
-            f'Unhandled message from user {message["user"]} \
-            on channel {message["channel"]}'
-        )
+    if is_duplicate_event(body):
+        return
+    try:
+        if get_channel_registry().get(message.get("channel")) is not None:
+            handle_reimbursement_post(message, say, client, body)
+        elif is_im(message):
+            handle_im(message, say)
+        else:
+            print(json.dumps(message, indent=4))
+            logger.info(
+                f'Unhandled message from user {message["user"]} \
+                on channel {message["channel"]}'
+            )
+    except BaseException:
+        # Let slack's retry of this event through
+        forget_event(body)
+        raise
+
+
+def is_duplicate_event(body: Dict[str, Any]) -> bool:
+    "Check whether this event was delivered before, and remember it if not"
+    key = event_key(body)
+    if key is None or get_dedup_cache().add(key):
+        return False
+    logger.info(f'Dropping repeated delivery of event {body["event_id"]}')
+    metrics.duplicates_total.inc("event")
+    return True
+
+
+def forget_event(body: Dict[str, Any]) -> None:
+    key = event_key(body)
+    if key is not None:
+        get_dedup_cache().discard(key)
 
 
 def handle_reimbursement_post(
-    message: Dict[str, Any], say: Say, client: WebClient, body: Dict[str, Any]
+    message: Dict[str, Any],
+    say: Say,
+    client: WebClient,
+    body: Dict[str, Any],
+    enqueue_timeout: float | None = ENQUEUE_TIMEOUT_SECONDS,
 ) -> None:
     """
-    Handle a post to the reimbursement channel
+    Handle a post to the reimbursement channel. Waits up to enqueue_timeout seconds for room
+    in the receipt queue, or forever if None.
     """
     logger.info(f'Received reimbursement post from user {message["user"]}')
+    channel = get_channel_registry().get(message["channel"])
+    if channel is None:
+        logger.error(f'Channel {message["channel"]} is not a reimbursement channel')
+        return
 
     # If it has an attachment jpg or png, reply with invoice number and email attachment
     if "files" in message:
-        logger.info("Post has attachment(s)")
-        for attachment in message["files"]:
-            if attachment["mimetype"] not in ["image/jpg", "image/jpeg", "image/png"]:
-                continue
+        queue_receipts(message, enqueue_timeout)
+
+    # Otherwise, if it is top level comment, reply asking for a receipt
+    elif "thread_ts" not in message:
+        get_slack_poster().post_message(
+            message["channel"],
+            "Please post the receipt",
+            thread_ts=message["ts"],
+            username=BOT_DISPLAY_NAME,
+            icon_emoji=BOT_ICON,
+        )
+
+    print("\body:\n", json.dumps(body, indent=4))
+
+
+def receipt_files(message: Dict[str, Any]) -> list[Dict[str, Any]]:
+    "The pictures attached to a post, each of which becomes a receipt"
+    return [
+        a
+        for a in message.get("files", [])
+        if a["mimetype"] in ["image/jpg", "image/jpeg", "image/png"]
+    ]
 
-            # increment receipt number
-            try:
-                receipt_num: int = receipt_table[-1]["invoice"] + 1
-            except IndexError:
-                receipt_num = 1
 
+def queue_receipts(message: Dict[str, Any], enqueue_timeout: float | None) -> list[int]:
+    """
+    Queue the pictures attached to a reimbursement post for processing and return their
+    receipt numbers
+    """
+    logger.info("Post has attachment(s)")
+    attachments = receipt_files(message)
+    channel = get_channel_registry().get(message["channel"])
+    if channel is None:
+        return []
+
+    # Skip files of this post that were queued before
+    new_attachments = list()
+    for a in attachments:
+        if get_dedup_cache().add(file_key(message["ts"], a["id"])):
+            new_attachments.append(a)
+        else:
+            logger.info(f'Skipping file {a["id"]} of post {message["ts"]}, it was queued before')
+            metrics.duplicates_total.inc("file")
+    if not new_attachments:
+        return []
+    # Write the file keys before the jobs, so a crash never leaves queued files that a
+    # redelivery of the post would queue again
+    get_dedup_cache().flush()
+
+    queued = 0
+    try:
+        # reserve a receipt number for each attachment
+        receipt_nums = channel.sequence.reserve(len(new_attachments))
+        for attachment, receipt_num in zip(new_attachments, receipt_nums):
             # Extract message text
             try:
                 message_text = message["text"]
             except KeyError:
                 message_text = "No message text"
 
-            # Get user's name
-            resp = client.users_info(user=message["user"])
-            user_dict = resp["user"]
-            if user_dict is None:
-                uname = "Error getting user"
-            elif user_dict["real_name"] is not None:
-                uname = user_dict["real_name"]
-            else:
-                uname = user_dict["name"]
-
-            # handle the receipt
-            process_receipt(
-                download_url=attachment["url_private"],
-                receipt_number=receipt_num,
-                uploader_name=uname,
-                message=message_text,
+            # Process the receipt on a worker so slack gets its acknowledgement right away
+            get_receipt_queue().enqueue(
+                dict(
+                    receipt_number=receipt_num,
+                    download_url=attachment["url_private"],
+                    user=message["user"],
+                    message=message_text,
+                    channel=message["channel"],
+                    ts=message["ts"],
+                ),
+                timeout=enqueue_timeout,
             )
+            queued += 1
+            logger.info(f"Queued receipt #{receipt_num:05}")
+    except BaseException:
+        # The files that were not queued, for example because no receipt numbers were left,
+        # can be queued by a retry
+        for a in new_attachments[queued:]:
+            get_dedup_cache().discard(file_key(message["ts"], a["id"]))
+        raise
+    return list(receipt_nums)
 
-            # Respond with receipt number
-            say(
-                f"Thank you, your reimbursement is being processed. Receipt #{receipt_num:05}.",
-                thread_ts=message["ts"],
-                username=BOT_DISPLAY_NAME,
-                icon_emoji=BOT_ICON,
-            )
-            logger.info(f"Processing receipt #{receipt_num:05}")
 
-            with receipt_table.get_lock():
-                receipt_table.append(
-                    invoice=receipt_num,
-                    slack_ts=message["ts"],
-                    date_requested=datetime.now(),  # type: ignore
-                    date_payment_sent=None,
-                )
+def receipt_reply(receipt_num: int) -> str:
+    return f"Thank you, your reimbursement is being processed. Receipt #{receipt_num:05}."
 
-    # Otherwise, if it is top level comment, reply asking for a receipt
-    elif "thread_ts" not in message:
-        say(
-            "Please post the receipt",
-            thread_ts=message["ts"],
-            username=BOT_DISPLAY_NAME,
-            icon_emoji=BOT_ICON,
+
+def too_large_reply(e: ReceiptTooLarge) -> str:
+    return f"Sorry, this receipt is too large to process ({e}). Please post a smaller picture."
+
+
+def duplicate_reply(original: int) -> str:
+    return (
+        f"This picture was already submitted as Receipt #{original:05}, so it was not sent"
+        " again."
+    )
+
+
+def similar_note(hashes: ReceiptIndex, receipt_num: int, dhash: int) -> str:
+    "A warning to add to the reply if the picture looks like earlier receipts, otherwise empty"
+    matches = [m for m in hashes.find_similar(dhash) if m.invoice != receipt_num]
+    if not matches:
+        return ""
+    metrics.duplicates_total.inc("similar_receipt")
+    numbers = ", ".join(f"#{m.invoice:05}" for m in matches)
+    return (
+        f"\nThis looks like Receipt {numbers}. If it is the same receipt, please let the"
+        " treasurer know so it is not paid twice."
+    )
+
+
+def record_receipt(table: Table, receipt_num: int, slack_ts: str) -> None:
+    "Add a processed receipt to its channel's table"
+    with table.get_lock():
+        table.append(
+            invoice=receipt_num,
+            slack_ts=slack_ts,
+            date_requested=datetime.now(),  # type: ignore
+            date_payment_sent=None,
         )
 
-    print("\body:\n", json.dumps(body, indent=4))
 
+def handle_receipt_job(job: Dict[str, Any]) -> None:
+    """
+    Process a receipt queued by handle_reimbursement_post. Jobs can be retried, so a receipt
+    that was already recorded only gets its reply.
+    """
+    client = get_slack_client()
+    receipt_num: int = job["receipt_number"]
+    channel = get_channel_registry().get(job["channel"])
+    if channel is None:
+        raise ValueError(f'Receipt #{receipt_num:05} is from unknown channel {job["channel"]}')
+    text = receipt_reply(receipt_num)
+
+    if channel.table.get_by("invoice", receipt_num) is None:
+        # Get user's name
+        with metrics.receipt_stage_seconds.time("user_lookup"):
+            uname = user_cache.get(client, job["user"])
+
+        # handle the receipt
+        logger.info(f"Processing receipt #{receipt_num:05}")
+        try:
+            with metrics.receipt_stage_seconds.time("download"):
+                file_data = download_file(job["download_url"])
+            text = process_job_data(job, channel, file_data, uname)
+        except ReceiptTooLarge as e:
+            text = receipt_too_large(receipt_num, e)
+        except Exception:
+            metrics.receipts_total.inc("error")
+            raise
+
+    # Respond with receipt number
+    with metrics.receipt_stage_seconds.time("reply"):
+        reply_in_thread(job, text)
+
+
+def process_job_data(
+    job: Dict[str, Any], channel: ReimbursementChannel, file_data: bytes, uploader_name: str
+) -> str:
+    """
+    The part of handling a receipt job after the download, shared by the threaded and the
+    asyncio runtime: a picture that was submitted before is not processed again, others are
+    rendered, saved, emailed and recorded, and one that looks like an earlier receipt is
+    flagged. Returns the reply for the thread. Blocks, the asyncio runtime runs it in a thread.
+    """
+    receipt_num: int = job["receipt_number"]
+    sha256 = file_hash(file_data)
+    original = channel.hashes.find_exact(sha256)
+    if original is not None and original != receipt_num:
+        logger.info(f"Receipt #{receipt_num:05} is a copy of receipt #{original:05}")
+        metrics.receipts_total.inc("duplicate")
+        return duplicate_reply(original)
+
+    rendered = process_receipt_data(
+        file_data,
+        receipt_number=receipt_num,
+        uploader_name=uploader_name,
+        message=job["message"],
+        post_ts=job["ts"],
+        archive=channel.archive,
+    )
 
-def handle_im(message: Dict[str, Any], say: Say) -> None:
-    say("I am Reimbursement bot. Fight me.")
+    with metrics.receipt_stage_seconds.time("record"):
+        record_receipt(channel.table, receipt_num, job["ts"])
+        text = receipt_reply(receipt_num)
+        text += similar_note(channel.hashes, receipt_num, rendered.dhash)
+        channel.hashes.add(receipt_num, sha256, rendered.dhash)
+    metrics.receipts_total.inc("ok")
+    return text
+
+
+def receipt_too_large(receipt_num: int, e: ReceiptTooLarge) -> str:
+    "Record a receipt that is too large to process and return its reply. Retrying will not help."
+    logger.error(f"Receipt #{receipt_num:05} is too large: {e}")
+    metrics.receipts_total.inc("too_large")
+    return too_large_reply(e)
 
 
-# TODO: get list of channels and get chan ID from there, rather than magic number
-def is_reimbursement_channel(message: Dict[str, Any]) -> bool:
+def reply_in_thread(job: Dict[str, Any], text: str) -> None:
     """
-    True if the message is from the reimbursement channel
+    Reply in the thread of a receipt job. Waiting for the reply lets the job be retried if
+    slack never takes it.
     """
-    try:
-        chan: str = message["channel"]
-    except KeyError:
-        return False
+    get_slack_poster().post_message(
+        job["channel"],
+        text,
+        thread_ts=job["ts"],
+        username=BOT_DISPLAY_NAME,
+        icon_emoji=BOT_ICON,
+    ).result()
 
-    # return chan == "C05CF7LFU5U"
-    return chan == REIMBURSEMENT_CHANNEL
+
+def handle_im(message: Dict[str, Any], say: Say) -> None:
+    say("I am Reimbursement bot. Fight me.")
 
 
 def is_im(message: Dict[str, Any]) -> bool:
@@ -159,105 +360,130 @@ def is_im(message: Dict[str, Any]) -> bool:
     return ch_type == "im"
 
 
+def download_file(download_url: str) -> bytes:
+    """
+    Download a file from slack in chunks, refusing files larger than MAX_DOWNLOAD_BYTES
+    """
+    import requests
+
+    slack_bot_token = config.get_slack_bot_token()
+    with requests.get(
+        download_url,
+        headers={"Authorization": f"Bearer {slack_bot_token}"},
+        stream=True,
+        timeout=DOWNLOAD_TIMEOUT_SECONDS,
+    ) as r:
+        r.raise_for_status()
+        length = r.headers.get("Content-Length")
+        if length is not None and int(length) > MAX_DOWNLOAD_BYTES:
+            raise ReceiptTooLarge(f"File is {int(length) // 2**20} MB")
+
+        data = bytearray()
+        for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+            data += chunk
+            if len(data) > MAX_DOWNLOAD_BYTES:
+                raise ReceiptTooLarge(f"File is over {MAX_DOWNLOAD_BYTES // 2**20} MB")
+    return bytes(data)
+
+
 def process_receipt(
-    download_url: str, uploader_name: str, receipt_number: int, message: str, show: bool = False
-) -> None:
+    download_url: str,
+    uploader_name: str,
+    receipt_number: int,
+    message: str,
+    show: bool = False,
+    post_ts: str | None = None,
+    archive: ReceiptArchive | None = None,
+) -> RenderedReceipt:
     """
     Download the picture, add a text header to the picture, and email the picture to the
-    payment processor
+    payment processor. Receipts with the same post_ts may be combined into one email.
     """
 
-    # Download file
-    slack_bot_token = config.get_slack_bot_token()
-    r = requests.get(download_url, headers={"Authorization": f"Bearer {slack_bot_token}"})
-    r.raise_for_status()
-    file_data = r.content
-
-    # Create image object and scale
-    with BytesIO(file_data) as bio:
-        im = Image.open(bio)
-        # Scale image to constant width
-        width, height = im.size
-        scale_height = int(height * RECEIPT_RESIZE_WIDTH / width)
-        im_scaled = im.convert("RGB").resize((RECEIPT_RESIZE_WIDTH, scale_height))
-        im.close()
-
-    # Create header text
-    header_img = Image.new(
-        im_scaled.mode, (RECEIPT_RESIZE_WIDTH, RECEIPT_RESIZE_WIDTH), (255, 255, 255)
-    )
-    font = ImageFont.truetype("LiberationSans-Regular.ttf", size=170)
-    imdr = ImageDraw.Draw(header_img)
-    text_1 = "Pay to: " + uploader_name
-    text_2 = f"Receipt #{receipt_number:05}"
-    text_3 = f"Date requested: {datetime.now().date()}"
-    text_4 = get_wrapped_text("Message: " + message, font, RECEIPT_RESIZE_WIDTH)
-    all_text = "\n".join([text_1, text_2, text_3, text_4])
-    text_height = imdr.textbbox(xy=(20, 0), text=all_text, font=font)[3]
-    text_height += 20
-    if text_height > RECEIPT_RESIZE_WIDTH:
-        # resize
-        temp_im = header_img.resize((RECEIPT_RESIZE_WIDTH, text_height))
-        header_img.close()
-        header_img = temp_im
-        imdr = ImageDraw.Draw(header_img)
-    imdr.text(xy=(20, 0), text=all_text, fill=(0, 0, 0), font=font)
-
-    # Resize to text
-    header_img_crop = header_img.crop((0, 0, RECEIPT_RESIZE_WIDTH, text_height))
-    header_img.close()
-
-    # Make new image to paste text and receipt
-    joined_img = Image.new(
-        im_scaled.mode, (RECEIPT_RESIZE_WIDTH, scale_height + text_height), (255, 255, 255)
+    with metrics.receipt_stage_seconds.time("download"):
+        file_data = download_file(download_url)
+    return process_receipt_data(
+        file_data,
+        uploader_name,
+        receipt_number,
+        message,
+        show=show,
+        post_ts=post_ts,
+        archive=archive,
     )
-    joined_img.paste(header_img_crop, (0, 0))
-    header_img_crop.close()
-    joined_img.paste(im_scaled, (0, text_height))
-    im_scaled.close()
 
-    # Save file to disk
-    directory = "../data/receipts/"
-    file_name = f"receipt_{receipt_number:05}.jpg"
-    file_path = (Path(__file__).parent / (directory + file_name)).resolve()
-    joined_img.save(file_path, format="JPEG")
+
+def process_receipt_data(
+    file_data: bytes,
+    uploader_name: str,
+    receipt_number: int,
+    message: str,
+    show: bool = False,
+    post_ts: str | None = None,
+    archive: ReceiptArchive | None = None,
+) -> RenderedReceipt:
+    """
+    The part of process_receipt after the download. The receipt is saved in archive, by
+    default the first channel's.
+    """
+
+    # Render in the process pool so several receipts can use several cores
+    with metrics.receipt_stage_seconds.time("render"):
+        rendered = render_receipt_in_pool(
+            file_data,
+            uploader_name,
+            receipt_number,
+            message,
+            datetime.now().date(),
+            byte_budget=config.get_jpeg_byte_budget(),
+        )
+    observe_render_timings(rendered)
+
+    # Save file to disk. The same encoded bytes are attached to the email.
+    file_name = receipt_file_name(receipt_number)
+    with metrics.receipt_stage_seconds.time("save"):
+        (archive or get_channel_registry().primary.archive).save(receipt_number, rendered.jpeg)
 
     if show:
-        joined_img.show()
+        from PIL import Image
+
+        Image.open(BytesIO(rendered.jpeg)).show()
+
+    # Send email with file. Reuses the open SMTP connection.
+    with metrics.receipt_stage_seconds.time("email"):
+        get_mail_sender().send(receipt_email(rendered, file_name), group=post_ts)
+    return rendered
+
+
+def observe_render_timings(rendered: RenderedReceipt) -> None:
+    "Record the stages timed inside the render process"
+    for stage, seconds in rendered.timings.items():
+        metrics.receipt_stage_seconds.observe(seconds, f"render_{stage}")
+
 
-    with BytesIO() as bio:
-        joined_img.save(bio, format="JPEG")
-        filedata = bio.getvalue()
+def register_gauges() -> None:
+    "Report the queue depths and table sizes in the metrics"
+    metrics.queue_depth.set_function(lambda: len(get_receipt_queue()), "receipts")
+    metrics.queue_depth.set_function(lambda: len(get_mail_sender()), "mail")
+    metrics.queue_depth.set_function(lambda: len(get_slack_poster()), "slack")
+    for channel in get_channel_registry():
+        metrics.table_rows.set_function(lambda t=channel.table: len(t), channel.name)
+        metrics.archive_bytes.set_function(channel.archive.disk_bytes, channel.name)
 
-    # Send email with file
+
+def receipt_email(rendered: RenderedReceipt, file_name: str) -> EmailMessage:
+    "The email to the payment processor with the rendered receipt attached"
     msg = EmailMessage()
     mail_name = config.get_mail_bot_name()
     mail_addr = config.get_mail_bot_address()
     mail_dest = config.get_destination_email()
-    mail_password = config.get_mail_bot_password()
     msg["From"] = f"{mail_name} <{mail_addr}>"
     msg["To"] = mail_dest
     msg["Subject"] = file_name
-    msg.set_content("\n".join([text_1, text_2, text_3, text_4]))
-
-    msg.add_attachment(filedata, "image", "jpeg", filename=file_name)
-
-    server = smtplib.SMTP_SSL("smtp.gmail.com", 465)
-    server.login(mail_addr, mail_password)
-    server.send_message(msg)
-    server.quit()
+    msg.set_content(rendered.header_text)
 
-
-# https://stackoverflow.com/a/67203353
-def get_wrapped_text(text: str, font: ImageFont.FreeTypeFont, line_length: int) -> str:
-    lines = [""]
-    for word in text.split():
-        line = f"{lines[-1]} {word}".strip()
-        if font.getlength(line) <= line_length:
-            lines[-1] = line
-        else:
-            lines.append(word)
-    return "\n".join(lines)
+    msg.add_attachment(rendered.jpeg, "image", "jpeg", filename=file_name)
+    return msg
 
 
 if __name__ == "__main__":
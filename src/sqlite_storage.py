@@ -0,0 +1,346 @@
+"""SQLite implementation of the PersistentTable interface"""
+
+import csv
+import logging
+import os
+import sqlite3
+from threading import Lock, local
+from typing import Any, Callable, Iterable, Iterator, Mapping, Self
+
+from storage import PersistentTable, Row, to_csv_value
+
+logger = logging.getLogger(__name__)
+
+TABLE_NAME = "rows"
+# Rows fetched from sqlite at a time while iterating
+ITER_BATCH_SIZE = 1000
+
+
+def to_sql_value(value: Any) -> Any:
+    """
+    Convert a value to what is stored in the database. Numbers are stored natively so they sort
+    as numbers, everything else is stored as the same string the csv file would hold.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return to_csv_value(value)
+
+
+class SqliteTable:
+    """
+    Persistent table-like storage using a sqlite database in WAL mode. It has the same interface
+    as PersistentTable, and values are converted back with the same converters.
+
+    Row positions map to the integer primary key, so indexing by position is a key lookup.
+    Unique indexes and indexes become sqlite indexes.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        fieldnames: list[str],
+        converters: Mapping[str, Callable[[str], Any] | None],
+        create_new: bool = False,
+        unique_indexes: Iterable[str] = (),
+        indexes: Iterable[str] = (),
+    ):
+        self.filename = filename
+        self.fieldnames = fieldnames
+        self.converters = converters
+        self.unique_indexes = list(unique_indexes)
+        self.indexes = list(indexes)
+        for f in [*self.unique_indexes, *self.indexes]:
+            if f not in fieldnames:
+                raise ValueError(f"Cannot index {f}, it is not a column of {filename}")
+
+        # Create lock for thread safety
+        self.lock = Lock()
+
+        # Each thread gets its own connection. They are only shared to close them.
+        self._local = local()
+        self._connections: list[sqlite3.Connection] = list()
+        self._connections_lock = Lock()
+        self._write_lock = Lock()
+        # row id -> changed fields and values since the last sync
+        self._dirty: dict[int, dict[str, Any]] = dict()
+        # Unique fields the database could not index as unique because of old duplicates
+        self._checked_unique: list[str] = list()
+
+        if create_new and os.access(filename, os.F_OK):
+            os.remove(filename)
+        self._create_schema()
+        self._len: int = self._conn().execute(f"SELECT COUNT(*) FROM {TABLE_NAME}").fetchone()[0]
+
+        self._columns = ", ".join(f'"{f}"' for f in fieldnames)
+        self._insert = f"INSERT INTO {TABLE_NAME} VALUES (?{', ?' * len(fieldnames)})"
+
+    def _conn(self) -> sqlite3.Connection:
+        "Get the connection for the current thread"
+        conn: sqlite3.Connection | None = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.filename, isolation_level=None, timeout=30, check_same_thread=False
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _create_schema(self) -> None:
+        conn = self._conn()
+        columns = ", ".join(f'"{f}"' for f in self.fieldnames)
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {TABLE_NAME} (id INTEGER PRIMARY KEY, {columns})")
+
+        # ensure columns match
+        existing = [r[1] for r in conn.execute(f"PRAGMA table_info({TABLE_NAME})")][1:]
+        if existing != self.fieldnames:
+            raise ValueError(
+                f"Data file {self.filename} has columns {existing} but expected {self.fieldnames}"
+            )
+
+        for f in self.unique_indexes:
+            try:
+                conn.execute(
+                    f'CREATE UNIQUE INDEX IF NOT EXISTS "uidx_{f}" ON {TABLE_NAME} ("{f}")'
+                )
+            except sqlite3.IntegrityError:
+                # Rows migrated from a csv file can have duplicates, written before numbers
+                # were reserved. Look ups find the first of them and append checks new rows.
+                duplicates = [
+                    r[0]
+                    for r in conn.execute(
+                        f'SELECT "{f}" FROM {TABLE_NAME} GROUP BY "{f}" HAVING COUNT(*) > 1'
+                    )
+                ]
+                logger.error(
+                    f"Duplicate {f} {duplicates} in table {self.filename}, looking them up"
+                    " finds the first row"
+                )
+                conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{f}" ON {TABLE_NAME} ("{f}")')
+                self._checked_unique.append(f)
+        for f in self.indexes:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{f}" ON {TABLE_NAME} ("{f}")')
+
+    def _make_row(self, record: tuple[Any, ...]) -> Row:
+        "Make a row from (id, *fields) as selected from the database"
+        d = dict()
+        for k, v in zip(self.fieldnames, record[1:]):
+            f = self.converters[k]
+            d[k] = f(str(v)) if f is not None else str(v)
+        return Row(d, self._row_changed, record[0])
+
+    def _row_changed(self, row: Row, field: str, value: Any) -> None:
+        "Called by a row before one of its fields is set"
+        if field not in self.fieldnames:
+            raise KeyError(f"{field} is not a column of table {self.filename}")
+        with self._write_lock:
+            self._dirty.setdefault(row.key, dict())[field] = value
+
+    def _select(self, where: str = "", params: Iterable[Any] = ()) -> list[Row]:
+        cur = self._conn().execute(f"SELECT id, {self._columns} FROM {TABLE_NAME} {where}", params)
+        return [self._make_row(r) for r in cur.fetchall()]
+
+    def _check_columns(self, kwargs: Mapping[str, Any]) -> None:
+        if not set(kwargs) <= set(self.fieldnames):
+            raise ValueError(
+                f"Attempt to update invalid columns {sorted(set(kwargs) - set(self.fieldnames))}"
+                f" in table {self.filename}"
+            )
+
+    def _write_fields(self, row_id: int, fields: Mapping[str, Any]) -> None:
+        "Update fields of a row. Hold _write_lock."
+        assignments = ", ".join(f'"{f}" = ?' for f in fields)
+        params = [to_sql_value(v) for v in fields.values()]
+        try:
+            self._conn().execute(
+                f"UPDATE {TABLE_NAME} SET {assignments} WHERE id = ?", [*params, row_id]
+            )
+        except sqlite3.IntegrityError as e:
+            raise ValueError(f"Could not update row in table {self.filename}: {e}")
+
+    def sync(self) -> None:
+        "Write rows that were changed in place"
+        with self._write_lock:
+            dirty, self._dirty = self._dirty, dict()
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for row_id, fields in sorted(dirty.items()):
+                    self._write_fields(row_id, fields)
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def export_csv(self, filename: str) -> None:
+        "Write the current contents of the table to a csv file"
+        tempname = filename + ".tmp"
+        with open(tempname, "w", newline="") as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=self.fieldnames)
+            writer.writeheader()
+            writer.writerows(self)
+        os.replace(tempname, filename)
+
+    def import_rows(self, rows: Iterable[Mapping[str, Any]]) -> None:
+        "Append many rows in one transaction"
+        with self._write_lock:
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                start = self._len
+                count = 0
+                for count, r in enumerate(rows, start=1):
+                    conn.execute(
+                        self._insert,
+                        [start + count, *[to_sql_value(r[f]) for f in self.fieldnames]],
+                    )
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            self._len = start + count
+
+    def close(self) -> None:
+        self.sync()
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = local()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __getitem__(self, key: int) -> Row:
+        pos = range(self._len)[key]
+        return self._select("WHERE id = ?", [pos + 1])[0]
+
+    def __str__(self) -> str:
+        return str(list(self))
+
+    def __iter__(self) -> Iterator[Row]:
+        # Fetch in batches so iterating does not hold the whole table in memory
+        last_id = 0
+        while True:
+            rows = self._select("WHERE id > ? ORDER BY id LIMIT ?", [last_id, ITER_BATCH_SIZE])
+            yield from rows
+            if len(rows) < ITER_BATCH_SIZE:
+                return
+            last_id = rows[-1].key
+
+    def append(self, **kwargs: Any) -> None:
+        if set(kwargs) != set(self.fieldnames):
+            raise ValueError(
+                f"Attempt to append invalid row to table {self.filename}. Columns "
+                f"are {sorted(kwargs)} and should be {sorted(self.fieldnames)}"
+            )
+        with self._write_lock:
+            for f in self._checked_unique:
+                if self.get_by(f, kwargs[f]) is not None:
+                    raise ValueError(f"Duplicate {f} {kwargs[f]} in table {self.filename}")
+            params = [self._len + 1, *[to_sql_value(kwargs[f]) for f in self.fieldnames]]
+            try:
+                self._conn().execute(self._insert, params)
+            except sqlite3.IntegrityError as e:
+                raise ValueError(f"Could not append row to table {self.filename}: {e}")
+            self._len += 1
+
+    def get_by(self, field: str, value: Any) -> Row | None:
+        "Get the first row where field equals value"
+        rows = self._select(f'WHERE "{field}" = ? ORDER BY id LIMIT 1', [to_sql_value(value)])
+        return rows[0] if rows else None
+
+    def get_all_by(self, field: str, value: Any) -> list[Row]:
+        "Get all rows where field equals value"
+        return self._select(f'WHERE "{field}" = ? ORDER BY id', [to_sql_value(value)])
+
+    def update(self, key: Any, **kwargs: Any) -> None:
+        """
+        Set fields of the row whose value in the first unique index is key and persist the
+        change
+        """
+        if not self.unique_indexes:
+            raise KeyError(f"Table {self.filename} has no unique index to update by")
+        field = self.unique_indexes[0]
+        row = self.get_by(field, key)
+        if row is None:
+            raise KeyError(f"No row with {field} {key} in table {self.filename}")
+        self._check_columns(kwargs)
+        with self._write_lock:
+            self._write_fields(row.key, kwargs)
+
+    def update_row(self, index: int, **kwargs: Any) -> None:
+        "Set fields of the row at index and persist the change"
+        self._check_columns(kwargs)
+        pos = range(self._len)[index]
+        with self._write_lock:
+            self._write_fields(pos + 1, kwargs)
+
+    def select_range(self, field: str, start: Any = None, stop: Any = None) -> list[Row]:
+        "Get rows where start <= field < stop, ordered by field. None leaves a side open."
+        conditions = [f'"{field}" != ""']
+        params = []
+        if start is not None:
+            conditions.append(f'"{field}" >= ?')
+            params.append(to_sql_value(start))
+        if stop is not None:
+            conditions.append(f'"{field}" < ?')
+            params.append(to_sql_value(stop))
+        return self._select(f'WHERE {" AND ".join(conditions)} ORDER BY "{field}", id', params)
+
+    def get_lock(self) -> Lock:
+        return self.lock
+
+
+def migrate_csv(
+    csv_filename: str,
+    db_filename: str,
+    fieldnames: list[str],
+    converters: Mapping[str, Callable[[str], Any] | None],
+) -> None:
+    "Copy the rows of a PersistentTable csv file into a new sqlite database"
+    if os.access(db_filename, os.F_OK):
+        raise ValueError(f"Database {db_filename} already exists")
+    # The csv backend is journaled, so rows appended since the last snapshot are only in the
+    # journal. Opening it journaled replays them into the rows that are copied.
+    with PersistentTable(csv_filename, fieldnames, converters, journaled=True) as source:
+        tempname = db_filename + ".tmp"
+        with SqliteTable(tempname, fieldnames, converters, create_new=True) as dest:
+            dest.import_rows(source)
+    # Only move into place once all rows are copied so a failed migration is retried
+    for suffix in ("-wal", "-shm"):
+        if os.access(tempname + suffix, os.F_OK):
+            os.remove(tempname + suffix)
+    os.replace(tempname, db_filename)
+    logger.info(f"Migrated {len(source)} rows from {csv_filename} to {db_filename}")
+
+
+if __name__ == "__main__":
+    import random
+
+    converters = dict(
+        text=None,
+        number=int,
+        random=float,
+    )
+    keys = list(converters.keys())
+    with SqliteTable(
+        "/tmp/demo1.db", keys, converters=converters, unique_indexes=["number"], indexes=["random"]
+    ) as t:
+        print(t, "start")
+        t.append(text="hi", number=len(t), random=random.random())
+        print(t, "updated")
+        t.update(0, random=random.random())
+        r = t[-1]
+        r["text"] = "changed"
+        t.sync()
+        print("t[-1]", t[-1])
+        print("random < 0.5", t.select_range("random", stop=0.5))
@@ -0,0 +1,69 @@
+"""
+Timing of the steps of starting the bot, printed by --profile-startup. Each step records the
+seconds it took and the packages it imported for the first time.
+"""
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+import importlib
+import sys
+import time
+from typing import Iterator
+
+# Imported packages listed for each step in the report, the rest are counted
+REPORT_MAX_PACKAGES = 6
+
+
+@dataclass
+class StartupStep:
+    name: str
+    seconds: float
+    # Top level packages first imported during the step
+    packages: list[str]
+
+
+class StartupProfile:
+    "The steps of one startup, in the order they ran"
+
+    def __init__(self) -> None:
+        self.steps: list[StartupStep] = list()
+
+    @contextmanager
+    def step(self, name: str) -> Iterator[None]:
+        "Time the block as a step called name"
+        before = set(sys.modules)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            packages = {m.partition(".")[0] for m in sys.modules.keys() - before}
+            # Leave out the C parts of the standard library
+            packages = {p for p in packages if not p.startswith("_")}
+            self.steps.append(StartupStep(name, seconds, sorted(packages)))
+
+    def import_module(self, name: str) -> None:
+        "Import a module as its own step, so it is timed without the modules imported before it"
+        with self.step(f"import {name}"):
+            importlib.import_module(name)
+
+    def report(self) -> str:
+        width = max((len(s.name) for s in self.steps), default=0)
+        lines = list()
+        for s in self.steps:
+            packages = ", ".join(s.packages[:REPORT_MAX_PACKAGES])
+            if len(s.packages) > REPORT_MAX_PACKAGES:
+                packages += f" and {len(s.packages) - REPORT_MAX_PACKAGES} more"
+            lines.append(f"{s.name:<{width}}  {s.seconds * 1000:8.1f} ms  {packages}".rstrip())
+        total = sum(s.seconds for s in self.steps)
+        lines.append(f"{'total':<{width}}  {total * 1000:8.1f} ms")
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    profile = StartupProfile()
+    for module in ("json", "email.message", "sqlite3"):
+        profile.import_module(module)
+    with profile.step("sleep"):
+        time.sleep(0.01)
+    print(profile.report())
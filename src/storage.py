@@ -1,9 +1,123 @@
+from bisect import bisect_left, insort
 from io import TextIOWrapper
 import csv
+import fcntl
+import json
+import logging
 import os
-import shutil
-from typing import Any, Iterable, Callable, Mapping, Self, Type, Iterator
-from threading import Lock
+from typing import Any, Iterable, Callable, Mapping, Self, Type, Iterator, Protocol
+from threading import Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+# Number of journal records before the journal is folded into the csv snapshot
+JOURNAL_COMPACT_THRESHOLD = 1000
+# Locked by the process using a data directory, holds its pid
+LOCK_FILE = ".lock"
+
+
+def to_csv_value(value: Any) -> str:
+    "Convert a value to the string stored in the csv file, the same way csv.DictWriter does"
+    return "" if value is None else str(value)
+
+
+def write_atomic(filename: str, data: str) -> None:
+    "Write data to a temporary file, flush it to disk and move it over filename"
+    tempname = filename + ".tmp"
+    with open(tempname, "w") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tempname, filename)  # atomic
+
+
+def lock_directory(directory: str) -> TextIOWrapper:
+    """
+    Take an exclusive lock on a data directory. Tables replay and rewrite their journals when
+    opened and sequences only read their file once, so two processes must never use the same
+    directory. Raises RuntimeError right away if another process holds the lock. The lock is
+    released when the returned file is closed or the process exits.
+    """
+    os.makedirs(directory, exist_ok=True)
+    f = open(os.path.join(directory, LOCK_FILE), "a+")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.seek(0)
+        pid = f.read().strip() or "unknown"
+        f.close()
+        raise RuntimeError(
+            f"{directory} is in use by another process (pid {pid}). Stop the bot first."
+        )
+    f.truncate(0)
+    f.write(str(os.getpid()))
+    f.flush()
+    return f
+
+
+class Sequence:
+    """
+    Hands out increasing numbers, such as invoice numbers, and persists the highest number
+    handed out so numbers are never reused after a restart.
+
+    Reserving only holds a lock for a counter increment and a write of the number to a small
+    file, so callers do not need to hold a table lock to get a unique number. Numbers past end
+    are never handed out.
+    """
+
+    def __init__(self, filename: str, start: int = 1, end: int | None = None):
+        self.filename = filename
+        self.lock = Lock()
+        self.end = end
+        self._next = start
+        if os.access(filename, os.R_OK):
+            with open(filename, "r") as f:
+                try:
+                    self._next = max(start, int(f.read()) + 1)
+                except ValueError as e:
+                    raise ValueError(f"Sequence file {filename} not formatted correctly: {e}")
+
+    def reserve(self, count: int = 1) -> range:
+        "Reserve count consecutive numbers"
+        if count < 1:
+            raise ValueError(f"Cannot reserve {count} numbers")
+        with self.lock:
+            first = self._next
+            if self.end is not None and first + count - 1 > self.end:
+                raise ValueError(f"Sequence {self.filename} has no numbers left up to {self.end}")
+            write_atomic(self.filename, str(first + count - 1))
+            self._next = first + count
+        return range(first, first + count)
+
+    def next(self) -> int:
+        "Reserve one number"
+        return self.reserve()[0]
+
+
+class Row(dict[str, Any]):
+    """
+    Table row that reports changes to its table so the table knows which rows to persist
+    """
+
+    def __init__(
+        self, data: Mapping[str, Any], on_change: Callable[["Row", str, Any], None], key: Any
+    ):
+        super().__init__(data)
+        self._on_change = on_change
+        # position or id of the row in its table
+        self.key = key
+
+    def __setitem__(self, field: str, value: Any) -> None:
+        # Let the table validate and record the change before it is made
+        self._on_change(self, field, value)
+        super().__setitem__(field, value)
+
+    def update(self, *args: Any, **kwargs: Any) -> None:  # type: ignore[override]
+        for field, value in dict(*args, **kwargs).items():
+            self[field] = value
+
+    def __delitem__(self, field: str) -> None:
+        raise TypeError("Fields cannot be deleted from a table row")
 
 
 class PersistentTable:
@@ -11,6 +125,15 @@ class PersistentTable:
     Persistent table-like storage using a csv file
 
     based on: https://code.activestate.com/recipes/576642/
+
+    In journaled mode the csv file is a snapshot. Inserts and updates are appended to a
+    journal file next to it, and the journal is folded into the snapshot in the background
+    once it gets long. On startup the snapshot is loaded and the journal is replayed.
+
+    Fields listed in unique_indexes or indexes can be looked up with get_by() without
+    scanning the table, and select_range() on a field in indexes bisects its sorted values.
+    The first unique index is the key used by update(). Rows track their own changes, so
+    sync() in journaled mode only writes rows that were modified.
     """
 
     def __init__(
@@ -19,29 +142,79 @@ class PersistentTable:
         fieldnames: list[str],
         converters: Mapping[str, Callable[[str], Any] | None],
         create_new: bool = False,
+        journaled: bool = False,
+        compact_threshold: int = JOURNAL_COMPACT_THRESHOLD,
+        unique_indexes: Iterable[str] = (),
+        indexes: Iterable[str] = (),
     ):
         self.filename = filename
         self.fieldnames = fieldnames
         self.converters = converters
-        self.items: list[dict[str, Any]] = list()
+        self.items: list[Row] = list()
+        self.journaled = journaled
+        self.journal_filename = filename + ".journal"
+        self.compact_threshold = compact_threshold
 
         # Create lock for thread safety
         self.lock = Lock()
 
+        # Internal locks so the journal does not depend on callers holding self.lock
+        self._journal_lock = Lock()
+        self._compact_lock = Lock()
+        self._journal: TextIOWrapper | None = None
+        self._journal_len = 0
+        self._compactor: Thread | None = None
+
+        # field -> value -> row position. Unique indexes map to one position.
+        self.unique_indexes: dict[str, dict[Any, int]] = {f: dict() for f in unique_indexes}
+        self.indexes: dict[str, dict[Any, list[int]]] = {f: dict() for f in indexes}
+        # field -> the values in self.indexes[field] except None, sorted, for select_range
+        self._sorted_values: dict[str, list[Any]] = {f: list() for f in self.indexes}
+        for f in [*self.unique_indexes, *self.indexes]:
+            if f not in fieldnames:
+                raise ValueError(f"Cannot index {f}, it is not a column of {filename}")
+        # row position -> fields changed since the last sync
+        self._dirty: dict[int, set[str]] = dict()
+
         if not create_new and os.access(filename, os.R_OK):
             with open(filename, "r", newline="") as csvfile:
                 self.load(csvfile)
 
+        if journaled:
+            self._open_journal(replay=not create_new)
+
+        for pos, row in enumerate(self.items):
+            self._index_row(pos, row, existing=True)
+        self._sort_values()
+
     def sync(self) -> None:
         "Open file and write items"
-        tempname = self.filename + ".tmp"
-        with open(tempname, "w", newline="") as csvfile:
-            try:
-                self.dump(csvfile)
-            except Exception:
-                os.remove(tempname)
-                raise
-            shutil.move(tempname, self.filename)  # atomic
+        if self.journaled:
+            # Only rows that changed need to be written
+            with self._journal_lock:
+                dirty, self._dirty = self._dirty, dict()
+                for pos, fields in sorted(dirty.items()):
+                    row = self.items[pos]
+                    self._log(dict(op="update", pos=pos, fields={f: row[f] for f in fields}))
+            self._maybe_compact()
+        else:
+            self._dirty.clear()
+            self._write_csv(self.filename, self.items)
+
+    def _write_csv(self, filename: str, rows: Iterable[Mapping[str, Any]]) -> None:
+        "Write rows to a temporary file and move it over filename"
+        tempname = filename + ".tmp"
+        try:
+            with open(tempname, "w", newline="") as csvfile:
+                writer = csv.DictWriter(csvfile, fieldnames=self.fieldnames)
+                writer.writeheader()
+                writer.writerows(rows)
+                csvfile.flush()
+                os.fsync(csvfile.fileno())
+        except Exception:
+            os.remove(tempname)
+            raise
+        os.replace(tempname, filename)  # atomic
 
     def dump(self, csvfile: TextIOWrapper) -> None:
         "write items to file"
@@ -49,8 +222,19 @@ class PersistentTable:
         writer.writeheader()
         writer.writerows(self.items)
 
+    def export_csv(self, filename: str) -> None:
+        "Write the current contents of the table to a csv file"
+        with self._journal_lock:
+            rows = [dict(r) for r in self.items]
+        self._write_csv(filename, rows)
+
     def close(self) -> None:
         self.sync()
+        self.compact()
+        if self._journal is not None:
+            with self._journal_lock:
+                self._journal.close()
+                self._journal = None
 
     def __enter__(self) -> Self:
         return self
@@ -71,25 +255,120 @@ class PersistentTable:
 
             # convert strings back to original types
             for d in reader:
-                d2 = dict()
-                for k in d:
-                    f = self.converters[k]
-                    d2[k] = f(d[k]) if f is not None else d[k]
-                self.items.append(d2)
+                self.items.append(self._make_row(len(self.items), self._convert(d)))
 
         except Exception as e:
             raise ValueError(f"Data file {self.filename} not formatted correctly or something: {e}")
 
+    def _convert(self, d: Mapping[str, str]) -> dict[str, Any]:
+        "Convert a row of strings back to the original types"
+        d2 = dict()
+        for k in d:
+            f = self.converters[k]
+            d2[k] = f(d[k]) if f is not None else d[k]
+        return d2
+
+    def _make_row(self, pos: int, d: Mapping[str, Any]) -> Row:
+        return Row(d, self._row_changed, pos)
+
+    def _row_changed(self, row: Row, field: str, value: Any) -> None:
+        "Called by a row before one of its fields is set"
+        if field not in self.fieldnames:
+            raise KeyError(f"{field} is not a column of table {self.filename}")
+        with self._journal_lock:
+            self._reindex(row.key, field, row[field], value)
+            self._dirty.setdefault(row.key, set()).add(field)
+
+    def _index_row(self, pos: int, row: Mapping[str, Any], existing: bool = False) -> None:
+        """
+        Add a row to the indexes. Raises ValueError if a unique value is already used by a new
+        row. Rows already in the file can have duplicates, written before numbers were
+        reserved, so for those the duplicate is logged and the first row keeps the value.
+        """
+        duplicates = [
+            f for f, index in self.unique_indexes.items() if index.get(row[f], pos) != pos
+        ]
+        if duplicates and not existing:
+            f = duplicates[0]
+            raise ValueError(f"Duplicate {f} {row[f]} in table {self.filename}")
+        for f in duplicates:
+            logger.error(
+                f"Duplicate {f} {row[f]} in row {pos} of table {self.filename}, looking it up"
+                f" finds row {self.unique_indexes[f][row[f]]}"
+            )
+        for f, index in self.unique_indexes.items():
+            index.setdefault(row[f], pos)
+        for f, multi_index in self.indexes.items():
+            positions = multi_index.setdefault(row[f], [])
+            if not positions and not existing:
+                self._add_sorted_value(f, row[f])
+            positions.append(pos)
+
+    def _sort_values(self) -> None:
+        "Build the sorted values of every index from scratch, after indexing rows in bulk"
+        for f, multi_index in self.indexes.items():
+            self._sorted_values[f] = sorted(v for v in multi_index if v is not None)
+
+    def _add_sorted_value(self, field: str, value: Any) -> None:
+        if value is not None:
+            insort(self._sorted_values[field], value)
+
+    def _remove_sorted_value(self, field: str, value: Any) -> None:
+        if value is not None:
+            values = self._sorted_values[field]
+            del values[bisect_left(values, value)]
+
+    def _reindex(self, pos: int, field: str, old: Any, new: Any) -> None:
+        "Move a row to a new value in the index on field, if there is one"
+        if old == new:
+            return
+        if field in self.unique_indexes:
+            index = self.unique_indexes[field]
+            if new in index:
+                raise ValueError(f"Duplicate {field} {new} in table {self.filename}")
+            # A duplicate loaded from the file is not in the index, the first row with its
+            # value is
+            if index.get(old) == pos:
+                del index[old]
+            index[new] = pos
+        elif field in self.indexes:
+            multi_index = self.indexes[field]
+            multi_index[old].remove(pos)
+            if not multi_index[old]:
+                del multi_index[old]
+                self._remove_sorted_value(field, old)
+            if new not in multi_index:
+                self._add_sorted_value(field, new)
+            multi_index.setdefault(new, []).append(pos)
+            multi_index[new].sort()
+
+    def get_by(self, field: str, value: Any) -> Row | None:
+        "Get the first row where field equals value using the index on field"
+        if field in self.unique_indexes:
+            pos = self.unique_indexes[field].get(value)
+            return None if pos is None else self.items[pos]
+        rows = self.get_all_by(field, value)
+        return rows[0] if rows else None
+
+    def get_all_by(self, field: str, value: Any) -> list[Row]:
+        "Get all rows where field equals value using the index on field"
+        if field in self.unique_indexes:
+            row = self.get_by(field, value)
+            return [] if row is None else [row]
+        if field not in self.indexes:
+            raise KeyError(f"There is no index on {field} in table {self.filename}")
+        return [self.items[pos] for pos in self.indexes[field].get(value, [])]
+
     def __len__(self) -> int:
         return len(self.items)
 
-    def __getitem__(self, key: int) -> dict[str, Any]:
+    def __getitem__(self, key: int) -> Row:
         return self.items[key]
 
     def __str__(self) -> str:
         return str(self.items)
 
-    def __iter__(self) -> Iterator[dict[str,Any]]:
+    def __iter__(self) -> Iterator[Row]:
         return iter(self.items)
 
     def append(self, **kwargs: Any) -> None:
@@ -99,12 +378,282 @@ class PersistentTable:
                 f"are {sorted(kwargs)} and should be {sorted(self.fieldnames)}"
             )
         # TODO: check types against converter outputs?
-        self.items.append(kwargs)
-        self.sync()
+        with self._journal_lock:
+            pos = len(self.items)
+            self._index_row(pos, kwargs)
+            if self.journaled:
+                self._log(dict(op="insert", pos=pos, row=kwargs))
+            self.items.append(self._make_row(pos, kwargs))
+        if self.journaled:
+            self._maybe_compact()
+        else:
+            self.sync()
+
+    def update(self, key: Any, **kwargs: Any) -> None:
+        """
+        Set fields of the row whose value in the first unique index is key and persist the
+        change
+        """
+        if not self.unique_indexes:
+            raise KeyError(f"Table {self.filename} has no unique index to update by")
+        field = next(iter(self.unique_indexes))
+        pos = self.unique_indexes[field].get(key)
+        if pos is None:
+            raise KeyError(f"No row with {field} {key} in table {self.filename}")
+        self.update_row(pos, **kwargs)
+
+    def update_row(self, index: int, **kwargs: Any) -> None:
+        "Set fields of the row at index and persist the change"
+        if not set(kwargs) <= set(self.fieldnames):
+            raise ValueError(
+                f"Attempt to update invalid columns {sorted(set(kwargs) - set(self.fieldnames))}"
+                f" in table {self.filename}"
+            )
+        with self._journal_lock:
+            pos = range(len(self.items))[index]
+            row = self.items[pos]
+            # Check every field before touching the indexes, so a duplicate leaves them as
+            # they were
+            for f, v in kwargs.items():
+                if f in self.unique_indexes and v != row[f] and v in self.unique_indexes[f]:
+                    raise ValueError(f"Duplicate {f} {v} in table {self.filename}")
+            for f, v in kwargs.items():
+                self._reindex(pos, f, row[f], v)
+            if self.journaled:
+                self._log(dict(op="update", pos=pos, fields=kwargs))
+            dict.update(row, kwargs)
+        if self.journaled:
+            self._maybe_compact()
+        else:
+            self.sync()
+
+    def select_range(self, field: str, start: Any = None, stop: Any = None) -> list[Row]:
+        """
+        Get rows where start <= field < stop, ordered by field and then position. None leaves
+        a side open. Fields in indexes are looked up in their sorted values, others are scanned.
+        """
+        if field in self.indexes:
+            values = self._sorted_values[field]
+            first = 0 if start is None else bisect_left(values, start)
+            last = len(values) if stop is None else bisect_left(values, stop)
+            multi_index = self.indexes[field]
+            return [self.items[pos] for v in values[first:last] for pos in multi_index[v]]
+        rows = [
+            r
+            for r in self.items
+            if r[field] is not None
+            and (start is None or r[field] >= start)
+            and (stop is None or r[field] < stop)
+        ]
+        rows.sort(key=lambda r: r[field])
+        return rows
 
     def get_lock(self) -> Lock:
         return self.lock
 
+    def retain(self, keep: Callable[[Row], bool]) -> int:
+        """
+        Drop the rows keep returns False for and rewrite the file. Rows after a dropped row
+        move to a lower position. Returns the number of rows dropped.
+        """
+        with self._compact_lock, self._journal_lock:
+            kept = [dict(r) for r in self.items if keep(r)]
+            dropped = len(self.items) - len(kept)
+            if not dropped:
+                return 0
+
+            if self._journal is not None:
+                # Journal records hold positions in the old rows, so fold them in before the
+                # positions change. A crash at any point leaves a snapshot and journal that
+                # agree.
+                self._write_csv(self.filename, [dict(r) for r in self.items])
+                self._journal.close()
+                self._journal = open(self.journal_filename, "w", newline="")
+                self._journal_len = 0
+
+            self.items = [self._make_row(pos, d) for pos, d in enumerate(kept)]
+            self._dirty.clear()
+            for unique_index in self.unique_indexes.values():
+                unique_index.clear()
+            for multi_index in self.indexes.values():
+                multi_index.clear()
+            for pos, row in enumerate(self.items):
+                self._index_row(pos, row, existing=True)
+            self._sort_values()
+            self._write_csv(self.filename, self.items)
+        return dropped
+
+    def _open_journal(self, replay: bool) -> None:
+        "Replay any existing journal files, fold them into the snapshot, and open the journal"
+        compacting = self.journal_filename + ".compacting"
+        replayed = 0
+        for name in (compacting, self.journal_filename):
+            if not os.access(name, os.R_OK):
+                continue
+            if replay:
+                with open(name, "r", newline="") as f:
+                    replayed += self._replay(name, f)
+            else:
+                os.remove(name)
+
+        if replayed:
+            logger.info(f"Replayed {replayed} journal records into {self.filename}")
+            self._write_csv(self.filename, self.items)
+        for name in (compacting, self.journal_filename):
+            if os.access(name, os.F_OK):
+                os.remove(name)
+
+        self._journal = open(self.journal_filename, "a", newline="")
+
+    def _replay(self, name: str, lines: Iterable[str]) -> int:
+        """
+        Apply journal records to items. Records hold the row position so replaying a record
+        that is already in the snapshot is harmless.
+        """
+        count = 0
+        pending_error: Exception | None = None
+        for line in lines:
+            if not line.strip():
+                continue
+            if pending_error is not None:
+                # Only the last record can be torn by a crash
+                raise ValueError(f"Journal {name} is corrupt: {pending_error}")
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                pending_error = e
+                continue
+
+            pos: int = record["pos"]
+            if record["op"] == "insert":
+                row = self._make_row(pos, self._convert(record["row"]))
+                if pos < len(self.items):
+                    self.items[pos] = row
+                elif pos == len(self.items):
+                    self.items.append(row)
+                else:
+                    raise ValueError(f"Journal {name} inserts row {pos} past end of table")
+            elif record["op"] == "update":
+                dict.update(self.items[pos], self._convert(record["fields"]))
+            else:
+                raise ValueError(f"Journal {name} has unknown operation {record['op']}")
+            count += 1
+
+        if pending_error is not None:
+            logger.warning(f"Ignoring incomplete last record in journal {name}")
+        return count
+
+    def _log(self, record: dict[str, Any]) -> None:
+        "Append a record to the journal and flush it to disk. Hold _journal_lock."
+        if self._journal is None:
+            raise ValueError(f"Table {self.filename} is closed")
+        for key in ("row", "fields"):
+            if key in record:
+                record[key] = {k: to_csv_value(v) for k, v in record[key].items()}
+        self._journal.write(json.dumps(record) + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._journal_len += 1
+
+    def _maybe_compact(self) -> None:
+        "Start a background compaction if the journal is long enough"
+        if self._journal_len < self.compact_threshold:
+            return
+        with self._journal_lock:
+            if self._compactor is not None and self._compactor.is_alive():
+                return
+            self._compactor = Thread(target=self.compact, daemon=True)
+            self._compactor.start()
+
+    def compact(self) -> None:
+        "Fold the journal into the csv snapshot"
+        if not self.journaled:
+            return
+        compacting = self.journal_filename + ".compacting"
+        with self._compact_lock:
+            # Swap in a new journal and copy the rows so writers are only blocked briefly
+            with self._journal_lock:
+                if self._journal is None:
+                    return
+                self._journal.close()
+                os.replace(self.journal_filename, compacting)
+                self._journal = open(self.journal_filename, "a", newline="")
+                self._journal_len = 0
+                rows = [dict(r) for r in self.items]
+
+            self._write_csv(self.filename, rows)
+            os.remove(compacting)
+
+
+class Table(Protocol):
+    "The interface shared by the table backends"
+
+    fieldnames: list[str]
+
+    def __len__(self) -> int: ...
+
+    def __getitem__(self, key: int) -> Row: ...
+
+    def __iter__(self) -> Iterator[Row]: ...
+
+    def append(self, **kwargs: Any) -> None: ...
+
+    def get_by(self, field: str, value: Any) -> Row | None: ...
+
+    def get_all_by(self, field: str, value: Any) -> list[Row]: ...
+
+    def update(self, key: Any, **kwargs: Any) -> None: ...
+
+    def update_row(self, index: int, **kwargs: Any) -> None: ...
+
+    def select_range(self, field: str, start: Any = None, stop: Any = None) -> list[Row]: ...
+
+    def sync(self) -> None: ...
+
+    def close(self) -> None: ...
+
+    def get_lock(self) -> Lock: ...
+
+
+def open_table(
+    csv_filename: str,
+    backend: str,
+    fieldnames: list[str],
+    converters: Mapping[str, Callable[[str], Any] | None],
+    unique_indexes: Iterable[str] = (),
+    indexes: Iterable[str] = (),
+) -> Table:
+    """
+    Open a table with the given backend, "csv" or "sqlite". The sqlite database is stored next
+    to the csv file and is created from the csv file the first time it is opened.
+    """
+    if backend == "csv":
+        return PersistentTable(
+            csv_filename,
+            fieldnames,
+            converters,
+            journaled=True,
+            unique_indexes=unique_indexes,
+            indexes=indexes,
+        )
+    elif backend == "sqlite":
+        from sqlite_storage import SqliteTable, migrate_csv
+
+        db_filename = os.path.splitext(csv_filename)[0] + ".db"
+        # A csv table that was never compacted only has its journal
+        has_csv = any(os.access(f, os.R_OK) for f in (csv_filename, csv_filename + ".journal"))
+        if not os.access(db_filename, os.F_OK) and has_csv:
+            migrate_csv(csv_filename, db_filename, fieldnames, converters)
+        return SqliteTable(
+            db_filename,
+            fieldnames,
+            converters,
+            unique_indexes=unique_indexes,
+            indexes=indexes,
+        )
+    else:
+        raise ValueError(f"Unknown storage backend {backend}")
+
 
 if __name__ == "__main__":
     import random
@@ -121,9 +670,24 @@ if __name__ == "__main__":
         print(t, "updated")
         t[2]['random'] = random.random()
         print("t[2]", t[2])
+        t.sync()
 
         for r in t:
             print(r)
 
     with open("/tmp/demo1.csv", "r") as f:
         print("\n", f.read())
+
+    # Journaled table, left open to show that the journal is replayed on the next start
+    t = PersistentTable(
+        "/tmp/demo2.csv", keys, converters=converters, journaled=True, unique_indexes=["number"]
+    )
+    print(t, "start journaled")
+    t.append(text="hi", number=len(t), random=random.random())
+    t.update(0, random=random.random())
+    print("number 0", t.get_by("number", 0))
+    with open("/tmp/demo2.csv.journal", "r") as f:
+        print("\n", f.read())
+
+    seq = Sequence("/tmp/demo_seq.txt", start=len(t))
+    print("reserved", seq.next(), list(seq.reserve(3)))
@@ -0,0 +1,109 @@
+"""Cache of slack user display names"""
+
+from collections import OrderedDict
+import logging
+import time
+from threading import Lock
+from typing import Any
+
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+
+logger = logging.getLogger(__name__)
+
+USER_CACHE_TTL_SECONDS = 12 * 60 * 60
+USER_CACHE_MAX_SIZE = 5000
+USERS_LIST_PAGE_SIZE = 200
+
+
+def display_name(user_dict: dict[str, Any] | None) -> str:
+    "The name to put on a receipt for a slack user object"
+    if user_dict is None:
+        return "Error getting user"
+    elif user_dict.get("real_name") is not None:
+        return str(user_dict["real_name"])
+    else:
+        return str(user_dict["name"])
+
+
+class UserCache:
+    """
+    Display names of slack users with a time to live, evicting the least recently used user
+    when full. Entries are replaced when slack reports a user_change event.
+    """
+
+    def __init__(self, ttl: float = USER_CACHE_TTL_SECONDS, max_size: int = USER_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        # user id -> (expiry time, display name)
+        self._names: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def put(self, user_dict: dict[str, Any]) -> None:
+        with self._lock:
+            self._names[user_dict["id"]] = (time.monotonic() + self.ttl, display_name(user_dict))
+            self._names.move_to_end(user_dict["id"])
+            while len(self._names) > self.max_size:
+                self._names.popitem(last=False)
+
+    def get_cached(self, user: str) -> str | None:
+        "Get the display name if it is cached and not expired"
+        with self._lock:
+            entry = self._names.get(user)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._names[user]
+                return None
+            self._names.move_to_end(user)
+            return entry[1]
+
+    def get(self, client: WebClient, user: str) -> str:
+        "Get the display name, asking slack if it is not cached"
+        name = self.get_cached(user)
+        if name is not None:
+            return name
+        resp = client.users_info(user=user)
+        user_dict = resp["user"]
+        if user_dict is None:
+            return display_name(None)
+        self.put(user_dict)
+        return display_name(user_dict)
+
+    def invalidate(self, user: str) -> None:
+        with self._lock:
+            self._names.pop(user, None)
+
+    def handle_user_change(self, event: dict[str, Any]) -> None:
+        "Pass to App.event('user_change'). The event has the updated user."
+        user_dict = event.get("user")
+        if isinstance(user_dict, dict):
+            self.put(user_dict)
+        elif isinstance(user_dict, str):
+            self.invalidate(user_dict)
+
+    def warm(self, client: WebClient) -> None:
+        "Fill the cache from the paginated user list"
+        cursor = None
+        count = 0
+        while True:
+            try:
+                resp = client.users_list(limit=USERS_LIST_PAGE_SIZE, cursor=cursor)
+            except SlackApiError as e:
+                logger.error(f"Could not list slack users, cached {count}: {e}")
+                return
+            for user_dict in resp.get("members", []):
+                if user_dict.get("deleted") or user_dict.get("is_bot"):
+                    continue
+                self.put(user_dict)
+                count += 1
+            cursor = resp.get("response_metadata", {}).get("next_cursor")
+            if not cursor:
+                break
+        logger.info(f"Cached {count} slack users")
+
+
+user_cache = UserCache()
@@ -0,0 +1,162 @@
+"""JobQueue ordering, backoff and recovering jobs after a crash"""
+
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+from typing import Any, Callable
+import unittest
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+sys.path.insert(0, str(SRC))
+
+from job_queue import MAX_RETRY_DELAY_SECONDS, JobQueue, QueueFull  # noqa: E402
+
+
+def ignore(payload: dict[str, Any]) -> None:
+    pass
+
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+
+    def open_queue(
+        self, handler: Callable[[dict[str, Any]], None] = ignore, **kwargs: Any
+    ) -> JobQueue:
+        queue = JobQueue(self.directory, handler, **kwargs)
+        self.addCleanup(queue.stop)
+        return queue
+
+    def files(self, subdirectory: str) -> list[str]:
+        return sorted(os.listdir(os.path.join(self.directory, subdirectory)))
+
+    def test_jobs_are_claimed_in_order_and_removed_when_complete(self) -> None:
+        queue = self.open_queue()
+        ids = [queue.enqueue(dict(n=n)) for n in range(3)]
+        self.assertEqual(self.files("pending"), [i + ".json" for i in ids])
+
+        job = queue.claim(timeout=0)
+        self.assertEqual(job.payload, dict(n=0))
+        self.assertEqual(self.files("running"), [job.id + ".json"])
+        queue.complete(job)
+        self.assertEqual(self.files("running"), [])
+        self.assertEqual([queue.claim(timeout=0).payload["n"] for _ in range(2)], [1, 2])
+        self.assertIsNone(queue.claim(timeout=0))
+
+    def test_enqueue_raises_when_full(self) -> None:
+        queue = self.open_queue(max_size=2)
+        queue.enqueue(dict(n=0))
+        job = queue.claim(timeout=0)
+        queue.enqueue(dict(n=1))
+        # A running job still takes up room
+        with self.assertRaises(QueueFull):
+            queue.enqueue(dict(n=2), timeout=0.01)
+
+        threading.Timer(0.05, queue.complete, [job]).start()
+        queue.enqueue(dict(n=2), timeout=5)
+        self.assertEqual(len(queue), 2)
+
+    def test_failed_job_is_retried_with_backoff(self) -> None:
+        queue = self.open_queue(retry_delay=60, max_attempts=20)
+        queue.enqueue(dict(n=0))
+        delays = list()
+        for _ in range(3):
+            job = queue.claim(timeout=0)
+            before = time.time()
+            queue.fail(job)
+            delays.append(job.not_before - before)
+            # Not ready until its delay is over
+            self.assertIsNone(queue.claim(timeout=0))
+            # Make it due now instead of waiting
+            job.not_before = time.time()
+        for got, expected in zip(delays, [60, 120, 240]):
+            self.assertAlmostEqual(got, expected, delta=1)
+
+        # The delay is capped
+        job.attempts = 10
+        queue.claim(timeout=0)
+        queue.fail(job)
+        self.assertAlmostEqual(job.not_before - time.time(), MAX_RETRY_DELAY_SECONDS, delta=1)
+
+    def test_job_is_moved_to_failed_after_max_attempts(self) -> None:
+        queue = self.open_queue(max_attempts=2, retry_delay=0)
+        job_id = queue.enqueue(dict(n=0))
+        queue.fail(queue.claim(timeout=0))
+        queue.fail(queue.claim(timeout=0))
+        self.assertEqual(self.files("failed"), [job_id + ".json"])
+        self.assertEqual(self.files("pending"), [])
+        self.assertEqual(len(queue), 0)
+
+    def test_retry_survives_reopen(self) -> None:
+        queue = self.open_queue(retry_delay=60)
+        queue.enqueue(dict(n=0))
+        queue.fail(queue.claim(timeout=0))
+        [name] = self.files("pending")
+        with open(os.path.join(self.directory, "pending", name)) as f:
+            self.assertEqual(json.load(f)["attempts"], 1)
+
+        reopened = self.open_queue()
+        self.assertEqual(len(reopened), 1)
+        # Still waiting out the delay after the restart
+        self.assertIsNone(reopened.claim(timeout=0))
+
+    def test_running_jobs_are_recovered_after_a_crash(self) -> None:
+        code = f"""
+            import os
+            from job_queue import JobQueue
+            q = JobQueue({self.directory!r}, print)
+            for n in range(3):
+                q.enqueue(dict(n=n))
+            q.claim()
+            q.claim()
+            os._exit(0)
+            """
+        result = subprocess.run(
+            [sys.executable, "-c", textwrap.dedent(code)],
+            cwd=SRC,
+            capture_output=True,
+            text=True,
+            timeout=30,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(len(self.files("running")), 2)
+
+        handled = list()
+        with self.assertLogs("job_queue", "WARNING"):
+            queue = self.open_queue(lambda payload: handled.append(payload["n"]))
+        self.assertEqual(self.files("running"), [])
+        queue.start()
+        self.assertTrue(queue.join(timeout=5))
+        self.assertEqual(sorted(handled), [0, 1, 2])
+        self.assertEqual(self.files("pending"), [])
+
+    def test_workers_run_jobs_and_fail_on_errors(self) -> None:
+        attempts: dict[int, int] = dict()
+        lock = threading.Lock()
+
+        def flaky(payload: dict[str, Any]) -> None:
+            with lock:
+                attempts[payload["n"]] = attempts.get(payload["n"], 0) + 1
+                if payload["n"] % 2 and attempts[payload["n"]] == 1:
+                    raise RuntimeError("flaky job")
+
+        queue = self.open_queue(flaky, workers=3, retry_delay=0.01)
+        queue.start()
+        with self.assertLogs("job_queue", "ERROR"):
+            for n in range(6):
+                queue.enqueue(dict(n=n))
+            self.assertTrue(queue.join(timeout=5))
+        self.assertEqual(attempts, {0: 1, 1: 2, 2: 1, 3: 2, 4: 1, 5: 2})
+        self.assertEqual(self.files("failed"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,196 @@
+"""SmtpSender against an SMTP server running in the test process"""
+
+from email import message_from_bytes, policy
+from email.message import EmailMessage
+from pathlib import Path
+import socket
+import socketserver
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import mail_sender  # noqa: E402
+from mail_sender import SmtpSender  # noqa: E402
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    "Enough of SMTP for smtplib: greeting, EHLO, MAIL, RCPT, DATA, NOOP, RSET and QUIT"
+
+    server: "LocalSmtpServer"
+
+    def reply(self, line: str) -> None:
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self) -> None:
+        self.server.connections += 1
+        self.server.open_sockets.append(self.connection)
+        self.reply("220 localhost test server")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip().split(" ", 1)[0].upper()
+            if command in ("EHLO", "HELO"):
+                self.reply("250 localhost")
+            elif command in ("MAIL", "RCPT", "RSET", "NOOP"):
+                self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = bytearray()
+                while True:
+                    line = self.rfile.readline()
+                    if line in (b".\r\n", b""):
+                        break
+                    # Undo dot stuffing
+                    data += line[1:] if line.startswith(b"..") else line
+                self.server.messages.append(
+                    message_from_bytes(bytes(data), policy=policy.default)  # type: ignore
+                )
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class LocalSmtpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), _SmtpHandler)
+        self.messages: list[EmailMessage] = list()
+        self.connections = 0
+        self.open_sockets: list = list()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def port(self) -> int:
+        return int(self.server_address[1])
+
+    def drop_connections(self) -> None:
+        "Close every open connection from the server side, like an idle timeout would"
+        for s in self.open_sockets:
+            try:
+                # shutdown rather than close, the handler thread still holds the socket
+                s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.open_sockets.clear()
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def make_message(n: int) -> EmailMessage:
+    m = EmailMessage()
+    m["From"] = "bot@localhost"
+    m["To"] = "melio@localhost"
+    m["Subject"] = f"receipt_{n:05}.jpg"
+    m.set_content(f"Receipt #{n:05}")
+    m.add_attachment(bytes(100), "image", "jpeg", filename=f"receipt_{n:05}.jpg")
+    return m
+
+
+class SmtpSenderTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = LocalSmtpServer()
+        self.addCleanup(self.server.stop)
+
+    def sender(self, coalesce_seconds: float = 0) -> SmtpSender:
+        sender = SmtpSender(
+            "127.0.0.1", self.server.port, use_ssl=False, coalesce_seconds=coalesce_seconds
+        )
+        self.addCleanup(sender.close)
+        return sender
+
+    def test_messages_share_one_connection(self) -> None:
+        sender = self.sender()
+        for n in range(3):
+            sender.send(make_message(n))
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_coalesces_messages_of_one_group(self) -> None:
+        sender = self.sender(coalesce_seconds=0.5)
+        futures = [sender.submit(make_message(n), group="post-1") for n in range(3)]
+        for f in futures:
+            f.result(timeout=10)
+        self.assertEqual(len(self.server.messages), 1)
+        msg = self.server.messages[0]
+        self.assertEqual(len(list(msg.iter_attachments())), 3)
+        self.assertEqual(
+            msg["Subject"], "receipt_00000.jpg, receipt_00001.jpg, receipt_00002.jpg"
+        )
+
+    def test_only_the_coalesced_group_waits(self) -> None:
+        sender = self.sender(coalesce_seconds=1)
+        start = time.monotonic()
+        grouped = [sender.submit(make_message(n), group="post-1") for n in range(2)]
+        other_group = sender.submit(make_message(2), group="post-2")
+        ungrouped = sender.submit(make_message(3))
+
+        ungrouped.result(timeout=10)
+        self.assertLess(time.monotonic() - start, 0.5)
+        for f in [*grouped, other_group]:
+            f.result(timeout=10)
+        self.assertEqual(
+            [m["Subject"] for m in self.server.messages],
+            ["receipt_00003.jpg", "receipt_00000.jpg, receipt_00001.jpg", "receipt_00002.jpg"],
+        )
+
+    def test_close_sends_groups_still_coalescing(self) -> None:
+        sender = self.sender(coalesce_seconds=60)
+        future = sender.submit(make_message(1), group="post-1")
+        sender.close()
+        self.assertIsNone(future.result(timeout=0))
+        self.assertEqual(len(self.server.messages), 1)
+
+    def test_reconnects_after_server_closed_connection(self) -> None:
+        sender = self.sender()
+        sender.send_now(make_message(1))
+        self.server.drop_connections()
+        time.sleep(0.1)
+        sender.send_now(make_message(2))
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_noop_timeout_reconnects_and_closes_old_socket(self) -> None:
+        sender = self.sender()
+        sender.send_now(make_message(1))
+        old = sender._server
+        assert old is not None
+
+        def timeout() -> tuple[int, bytes]:
+            raise TimeoutError("timed out")
+
+        old.noop = timeout  # type: ignore[method-assign]
+        sender._last_used = time.monotonic() - mail_sender.NOOP_AFTER_IDLE_SECONDS - 1
+        sender.send_now(make_message(2))
+        self.assertIsNot(sender._server, old)
+        self.assertIsNone(old.sock)
+        self.assertEqual(len(self.server.messages), 2)
+
+    def test_connection_error_closes_socket_and_resends(self) -> None:
+        sender = self.sender()
+        sender.send_now(make_message(1))
+        old = sender._server
+        assert old is not None
+
+        def reset(*args: object, **kwargs: object) -> None:
+            raise ConnectionResetError("reset by peer")
+
+        old.send_message = reset  # type: ignore[method-assign]
+        sender.send_now(make_message(2))
+        self.assertIsNone(old.sock)
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(self.server.connections, 2)
+
+if __name__ == "__main__":
+    unittest.main()
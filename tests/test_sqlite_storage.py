@@ -0,0 +1,144 @@
+"""SqliteTable, migrating csv tables to it and range queries on both backends"""
+
+import os
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from sqlite_storage import SqliteTable, migrate_csv  # noqa: E402
+from storage import PersistentTable, open_table  # noqa: E402
+from test_storage import CONVERTERS, FIELDNAMES, crash_after  # noqa: E402
+
+RANGE_FIELDNAMES = ["invoice", "amount"]
+RANGE_CONVERTERS = dict(invoice=int, amount=float)
+
+
+class SqliteTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+        self.csv_filename = os.path.join(self.directory, "table.csv")
+        self.db_filename = os.path.join(self.directory, "table.db")
+
+    def open_db(self, **kwargs: object) -> SqliteTable:
+        table = SqliteTable(
+            self.db_filename, FIELDNAMES, CONVERTERS, unique_indexes=["invoice"], **kwargs
+        )
+        self.addCleanup(table.close)
+        return table
+
+    def test_rows_persist_across_reopen(self) -> None:
+        table = self.open_db()
+        for n in range(3):
+            table.append(invoice=n, name=f"receipt {n}")
+        table.update(1, name="paid")
+        table[2]["name"] = "changed"
+        table.close()
+
+        table = self.open_db()
+        self.assertEqual(len(table), 3)
+        self.assertEqual(
+            [(r["invoice"], r["name"]) for r in table],
+            [(0, "receipt 0"), (1, "paid"), (2, "changed")],
+        )
+        self.assertEqual(table[-1]["invoice"], 2)
+
+    def test_duplicate_unique_value_is_refused(self) -> None:
+        table = self.open_db()
+        table.append(invoice=1, name="a")
+        table.append(invoice=2, name="b")
+        with self.assertRaises(ValueError):
+            table.append(invoice=1, name="c")
+        with self.assertRaises(ValueError):
+            table.update(2, invoice=1)
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.get_by("invoice", 2)["name"], "b")
+
+    def test_columns_must_match(self) -> None:
+        self.open_db().close()
+        with self.assertRaises(ValueError):
+            SqliteTable(self.db_filename, ["invoice", "other"], dict(invoice=int, other=None))
+
+    def test_migrate_replays_journal_left_by_crash(self) -> None:
+        crash_after(
+            self.csv_filename,
+            """
+            t.compact()
+            t.append(invoice=1, name="a")
+            t.append(invoice=2, name="b")
+            t.update(2, name="c")
+            """,
+        )
+        migrate_csv(self.csv_filename, self.db_filename, FIELDNAMES, CONVERTERS)
+        table = self.open_db()
+        self.assertEqual([(r["invoice"], r["name"]) for r in table], [(1, "a"), (2, "c")])
+        self.assertFalse(os.path.exists(self.db_filename + ".tmp"))
+
+    def test_migrate_refuses_existing_database(self) -> None:
+        self.open_db().close()
+        with self.assertRaises(ValueError):
+            migrate_csv(self.csv_filename, self.db_filename, FIELDNAMES, CONVERTERS)
+
+    def test_migrated_duplicates_keep_the_first_row(self) -> None:
+        with open(self.csv_filename, "w") as f:
+            f.write("invoice,name\n1,first\n1,second\n")
+        migrate_csv(self.csv_filename, self.db_filename, FIELDNAMES, CONVERTERS)
+        with self.assertLogs("sqlite_storage", "ERROR"):
+            table = self.open_db()
+        self.assertEqual(table.get_by("invoice", 1)["name"], "first")
+        with self.assertRaises(ValueError):
+            table.append(invoice=1, name="third")
+
+    def test_open_table_migrates_once(self) -> None:
+        crash_after(self.csv_filename, 't.append(invoice=1, name="a")')
+        table = open_table(
+            self.csv_filename, "sqlite", FIELDNAMES, CONVERTERS, unique_indexes=["invoice"]
+        )
+        self.assertIsInstance(table, SqliteTable)
+        table.append(invoice=2, name="b")
+        table.close()
+
+        # The database is kept, the csv file is not copied again
+        table = open_table(
+            self.csv_filename, "sqlite", FIELDNAMES, CONVERTERS, unique_indexes=["invoice"]
+        )
+        self.addCleanup(table.close)
+        self.assertEqual([r["invoice"] for r in table], [1, 2])
+
+    def test_select_range_matches_on_both_backends(self) -> None:
+        amounts = [5.0, 1.5, 3.0, 1.5, 8.25, 3.0]
+        tables = [
+            PersistentTable(
+                self.csv_filename, RANGE_FIELDNAMES, RANGE_CONVERTERS, indexes=["amount"]
+            ),
+            SqliteTable(
+                self.db_filename, RANGE_FIELDNAMES, RANGE_CONVERTERS, indexes=["amount"]
+            ),
+        ]
+        for table in tables:
+            self.addCleanup(table.close)
+            for n, amount in enumerate(amounts):
+                table.append(invoice=n, amount=amount)
+            table.update_row(0, amount=2.0)
+            table[4]["amount"] = 1.0
+            table.sync()
+
+        for start, stop in [(None, None), (1.5, 3.0), (2.0, None), (None, 1.5), (9.0, None)]:
+            expected = sorted(
+                (r["amount"], r["invoice"])
+                for r in tables[0]
+                if (start is None or r["amount"] >= start) and (stop is None or r["amount"] < stop)
+            )
+            for table in tables:
+                with self.subTest(table=type(table).__name__, start=start, stop=stop):
+                    rows = table.select_range("amount", start, stop)
+                    self.assertEqual([(r["amount"], r["invoice"]) for r in rows], expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,327 @@
+"""PersistentTable, Sequence and the data directory lock, including reopening after a crash"""
+
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import unittest
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+sys.path.insert(0, str(SRC))
+
+from storage import PersistentTable, Sequence, lock_directory  # noqa: E402
+
+FIELDNAMES = ["invoice", "name"]
+CONVERTERS = dict(invoice=int, name=None)
+
+
+def run_in_subprocess(code: str) -> subprocess.CompletedProcess:
+    "Run code in another process with src on the path"
+    return subprocess.run(
+        [sys.executable, "-c", textwrap.dedent(code)],
+        cwd=SRC,
+        capture_output=True,
+        text=True,
+        timeout=30,
+    )
+
+
+def lock_in_subprocess(directory: str) -> subprocess.CompletedProcess:
+    "Try to lock directory from another process, like a second bot or --backfill would"
+    return run_in_subprocess(f"import storage; storage.lock_directory({directory!r})")
+
+
+def crash_after(filename: str, code: str) -> None:
+    """
+    Open a journaled table in another process, run code with it as t and kill the process
+    without closing the table
+    """
+    preamble = textwrap.dedent(
+        f"""
+        import os
+        from storage import PersistentTable
+        t = PersistentTable(
+            {filename!r}, {FIELDNAMES!r}, dict(invoice=int, name=None), journaled=True,
+            unique_indexes=["invoice"],
+        )
+        """
+    )
+    result = run_in_subprocess(preamble + textwrap.dedent(code) + "\nos._exit(0)\n")
+    if result.returncode != 0:
+        raise AssertionError(result.stderr)
+
+
+class TempDirTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+        self.filename = os.path.join(self.directory, "table.csv")
+
+    def open_table(self, **kwargs: object) -> PersistentTable:
+        table = PersistentTable(
+            self.filename, FIELDNAMES, CONVERTERS, unique_indexes=["invoice"], **kwargs
+        )
+        self.addCleanup(table.close)
+        return table
+
+
+class JournalTest(TempDirTest):
+    def test_reopen_after_crash_replays_journal(self) -> None:
+        crash_after(
+            self.filename,
+            """
+            for n in range(3):
+                t.append(invoice=n, name=f"receipt {n}")
+            t.update(1, name="paid")
+            """,
+        )
+        self.assertTrue(os.path.exists(self.filename + ".journal"))
+        table = self.open_table(journaled=True)
+        self.assertEqual([r["invoice"] for r in table], [0, 1, 2])
+        self.assertEqual(table.get_by("invoice", 1)["name"], "paid")
+
+    def test_replay_is_written_to_the_snapshot(self) -> None:
+        crash_after(self.filename, 't.append(invoice=1, name="a")')
+        self.open_table(journaled=True)
+        # Opened without the journal, the snapshot alone has the row
+        self.assertEqual(len(PersistentTable(self.filename, FIELDNAMES, CONVERTERS)), 1)
+
+    def test_torn_last_record_is_ignored(self) -> None:
+        crash_after(self.filename, 't.append(invoice=1, name="a")')
+        with open(self.filename + ".journal", "a") as f:
+            f.write('{"op": "insert", "pos": 1, "ro')
+        table = self.open_table(journaled=True)
+        self.assertEqual([r["invoice"] for r in table], [1])
+
+    def test_corrupt_record_before_the_end_raises(self) -> None:
+        crash_after(self.filename, 't.append(invoice=1, name="a")')
+        with open(self.filename + ".journal", "a") as f:
+            f.write("not json\n")
+            f.write('{"op": "update", "pos": 0, "fields": {"name": "b"}}\n')
+        with self.assertRaises(ValueError):
+            PersistentTable(self.filename, FIELDNAMES, CONVERTERS, journaled=True)
+
+    def test_crash_during_compaction_replays_both_journals(self) -> None:
+        # The journal was swapped out and the snapshot written, but the old journal was not
+        # deleted yet. Replaying records that are already in the snapshot is harmless.
+        crash_after(
+            self.filename,
+            """
+            t.append(invoice=1, name="a")
+            t.append(invoice=2, name="b")
+            os.replace(t.journal_filename, t.journal_filename + ".compacting")
+            t._journal = open(t.journal_filename, "a")
+            t.export_csv(t.filename)
+            t.update(2, name="c")
+            """,
+        )
+        table = self.open_table(journaled=True)
+        self.assertEqual([(r["invoice"], r["name"]) for r in table], [(1, "a"), (2, "c")])
+        self.assertFalse(os.path.exists(self.filename + ".journal.compacting"))
+
+    def test_compaction_folds_journal_into_snapshot(self) -> None:
+        table = PersistentTable(
+            self.filename, FIELDNAMES, CONVERTERS, journaled=True, compact_threshold=5
+        )
+        for n in range(12):
+            table.append(invoice=n, name="")
+        table.close()
+        self.assertEqual(os.path.getsize(self.filename + ".journal"), 0)
+        self.assertEqual(len(PersistentTable(self.filename, FIELDNAMES, CONVERTERS)), 12)
+
+    def test_create_new_discards_journal(self) -> None:
+        crash_after(self.filename, 't.append(invoice=1, name="a")')
+        table = self.open_table(journaled=True, create_new=True)
+        self.assertEqual(len(table), 0)
+
+
+class IndexTest(TempDirTest):
+    def open_indexed(self, **kwargs: object) -> PersistentTable:
+        table = PersistentTable(
+            self.filename,
+            ["invoice", "slack_ts", "name"],
+            dict(invoice=int, slack_ts=None, name=None),
+            unique_indexes=["invoice"],
+            indexes=["slack_ts"],
+            **kwargs,
+        )
+        self.addCleanup(table.close)
+        return table
+
+    def test_lookups_follow_updates(self) -> None:
+        table = self.open_indexed(journaled=True)
+        table.append(invoice=1, slack_ts="100.1", name="a")
+        table.append(invoice=2, slack_ts="100.1", name="b")
+        table.append(invoice=3, slack_ts="200.2", name="c")
+        self.assertEqual([r["invoice"] for r in table.get_all_by("slack_ts", "100.1")], [1, 2])
+
+        table.update(2, slack_ts="200.2", invoice=20)
+        self.assertIsNone(table.get_by("invoice", 2))
+        self.assertEqual(table.get_by("invoice", 20)["name"], "b")
+        self.assertEqual([r["invoice"] for r in table.get_all_by("slack_ts", "100.1")], [1])
+        self.assertEqual([r["invoice"] for r in table.get_all_by("slack_ts", "200.2")], [20, 3])
+
+    def test_duplicate_unique_value_is_refused(self) -> None:
+        table = self.open_indexed()
+        table.append(invoice=1, slack_ts="", name="a")
+        with self.assertRaises(ValueError):
+            table.append(invoice=1, slack_ts="", name="b")
+        self.assertEqual(len(table), 1)
+
+    def test_failed_update_leaves_indexes_unchanged(self) -> None:
+        table = PersistentTable(
+            self.filename,
+            ["invoice", "receipt", "name"],
+            dict(invoice=int, receipt=int, name=None),
+            unique_indexes=["invoice", "receipt"],
+        )
+        table.append(invoice=1, receipt=10, name="a")
+        table.append(invoice=2, receipt=20, name="b")
+        with self.assertRaises(ValueError):
+            # invoice would be free, receipt is taken
+            table.update(1, invoice=5, receipt=20)
+        self.assertEqual(table.get_by("invoice", 1)["receipt"], 10)
+        self.assertIsNone(table.get_by("invoice", 5))
+        self.assertEqual(table.get_by("receipt", 20)["invoice"], 2)
+
+    def test_duplicates_already_in_the_file_keep_the_first_row(self) -> None:
+        with open(self.filename, "w") as f:
+            f.write("invoice,slack_ts,name\n1,,first\n1,,second\n2,,other\n")
+        with self.assertLogs("storage", "ERROR"):
+            table = self.open_indexed()
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.get_by("invoice", 1)["name"], "first")
+        # Moving the duplicate away does not drop the first row from the index
+        table.update_row(1, invoice=3)
+        self.assertEqual(table.get_by("invoice", 1)["name"], "first")
+        self.assertEqual(table.get_by("invoice", 3)["name"], "second")
+
+    def test_row_changes_are_journaled_by_sync(self) -> None:
+        table = self.open_indexed(journaled=True)
+        for n in range(3):
+            table.append(invoice=n, slack_ts="", name="")
+        table.compact()
+        with table.get_lock():
+            table[1]["name"] = "changed"
+            table.get_by("invoice", 2)["slack_ts"] = "300.3"
+            table.sync()
+        with open(self.filename + ".journal") as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(
+            records,
+            [
+                dict(op="update", pos=1, fields=dict(name="changed")),
+                dict(op="update", pos=2, fields=dict(slack_ts="300.3")),
+            ],
+        )
+        self.assertEqual(table.get_by("slack_ts", "300.3")["invoice"], 2)
+
+    def test_row_changes_survive_a_crash_after_sync(self) -> None:
+        crash_after(
+            self.filename,
+            """
+            t.append(invoice=1, name="a")
+            t.get_by("invoice", 1)["name"] = "b"
+            t.sync()
+            """,
+        )
+        table = self.open_table(journaled=True)
+        self.assertEqual(table.get_by("invoice", 1)["name"], "b")
+
+    def test_rows_refuse_unknown_and_deleted_fields(self) -> None:
+        table = self.open_indexed()
+        table.append(invoice=1, slack_ts="", name="a")
+        with self.assertRaises(KeyError):
+            table[0]["missing"] = 1
+        with self.assertRaises(TypeError):
+            del table[0]["name"]
+
+
+class SequenceTest(TempDirTest):
+    def setUp(self) -> None:
+        super().setUp()
+        self.filename = os.path.join(self.directory, "invoice.seq")
+
+    def test_reserve_hands_out_consecutive_ranges(self) -> None:
+        sequence = Sequence(self.filename, start=10)
+        self.assertEqual(sequence.reserve(3), range(10, 13))
+        self.assertEqual(sequence.next(), 13)
+        self.assertEqual(sequence.reserve(2), range(14, 16))
+        with self.assertRaises(ValueError):
+            sequence.reserve(0)
+
+    def test_numbers_are_not_reused_after_a_crash(self) -> None:
+        result = run_in_subprocess(
+            f"""
+            import os
+            from storage import Sequence
+            Sequence({self.filename!r}).reserve(5)
+            os._exit(0)
+            """
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(Sequence(self.filename).next(), 6)
+        # A later start wins over the file, an earlier one does not
+        self.assertEqual(Sequence(self.filename, start=100).next(), 100)
+        self.assertEqual(Sequence(self.filename, start=1).next(), 101)
+
+    def test_end_is_never_handed_out_past(self) -> None:
+        sequence = Sequence(self.filename, start=1, end=5)
+        self.assertEqual(sequence.reserve(4), range(1, 5))
+        with self.assertRaises(ValueError):
+            sequence.reserve(2)
+        # A failed reservation does not use up numbers
+        self.assertEqual(sequence.next(), 5)
+        with self.assertRaises(ValueError):
+            sequence.next()
+        self.assertEqual(Sequence(self.filename).next(), 6)
+
+    def test_concurrent_reservations_do_not_overlap(self) -> None:
+        sequence = Sequence(self.filename)
+        reserved: list[range] = list()
+
+        def reserve() -> None:
+            for _ in range(50):
+                reserved.append(sequence.reserve(3))
+
+        threads = [threading.Thread(target=reserve) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        numbers = sorted(n for r in reserved for n in r)
+        self.assertEqual(numbers, list(range(1, 601)))
+        self.assertEqual(Sequence(self.filename).next(), 601)
+
+    def test_bad_file_raises(self) -> None:
+        with open(self.filename, "w") as f:
+            f.write("not a number")
+        with self.assertRaises(ValueError):
+            Sequence(self.filename)
+
+
+class LockDirectoryTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+
+    def test_second_process_fails_while_locked(self) -> None:
+        lock = lock_directory(self.directory)
+        self.addCleanup(lock.close)
+        result = lock_in_subprocess(self.directory)
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn("Stop the bot first", result.stderr)
+
+    def test_lock_is_released_on_close(self) -> None:
+        lock_directory(self.directory).close()
+        self.assertEqual(lock_in_subprocess(self.directory).returncode, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()